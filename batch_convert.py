@@ -0,0 +1,225 @@
+"""Headless batch converter: scale images and convert them to map art without the GUI
+
+Example:
+    python batch_convert.py submissions/ "extra/*.png" -W 4 -H 3 -j 8 -o out
+"""
+import argparse
+import glob
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from typing import Dict, Iterable, Iterator, List
+
+from PIL import Image
+
+from bill_of_materials import MaterialEstimator
+from color_metrics import DEFAULT_METRIC, METRICS
+from dithering import DITHER_MODES
+from image_utils import ImageProcessor
+from map_exporter import MapDataExporter
+from minecraft_map_processor import MinecraftMapProcessor
+from palette_quantizer import get_quantizer
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.gif', '.bmp')
+
+
+def iter_input_files(inputs: Iterable[str]) -> Iterator[str]:
+    """Yield image files from paths, directories and glob patterns, lazily and without duplicates"""
+    seen = set()
+    for pattern in inputs:
+        if os.path.isdir(pattern):
+            candidates = (
+                os.path.join(pattern, name) for name in sorted(os.listdir(pattern))
+            )
+        elif glob.has_magic(pattern):
+            candidates = glob.iglob(pattern, recursive=True)
+        else:
+            candidates = [pattern]
+
+        for path in candidates:
+            if not os.path.isfile(path) or not path.lower().endswith(IMAGE_EXTENSIONS):
+                continue
+            key = os.path.abspath(path)
+            if key not in seen:
+                seen.add(key)
+                yield path
+
+
+def convert_file(path: str, output_dir: str, width_multiple: int, height_multiple: int,
+                 output_format: str, mode: str, dither: str = 'none',
+                 metric: str = DEFAULT_METRIC, dat: bool = False, first_map_id: int = 0,
+                 bom: bool = False, rewrite: bool = False) -> Dict:
+    """Scale and quantize one file; runs inside a pool worker"""
+    result = {'path': path, 'outputs': [], 'error': None}
+    try:
+        started = time.perf_counter()
+        target_size = (128 * width_multiple, 128 * height_multiple)
+        with ImageProcessor.open_image(path, target_size) as image:
+            image.load()
+            loaded = time.perf_counter()
+            # Large murals are resampled into a memory-mapped buffer instead of the heap
+            scaled_pixels = ImageProcessor.scale_image(
+                image, width_multiple, height_multiple, out=ImageProcessor.output_buffer(*target_size)
+            )
+        scaled = time.perf_counter()
+
+        stem = os.path.splitext(os.path.basename(path))[0]
+        suffix = f"{target_size[0]}x{target_size[1]}"
+        if mode in ('scaled', 'both'):
+            scaled_path = os.path.join(output_dir, f"scaled_{stem}_{suffix}.{output_format}")
+            Image.fromarray(scaled_pixels).save(scaled_path)
+            result['outputs'].append(scaled_path)
+
+        quantized = scaled
+        if mode in ('map', 'both') or dat or bom:
+            map_preview, index_map = MinecraftMapProcessor.quantize_image(scaled_pixels, dither=dither, metric=metric)
+            quantized = time.perf_counter()
+            if mode in ('map', 'both'):
+                map_path = os.path.join(output_dir, f"map_{stem}_{suffix}.{output_format}")
+                ImageProcessor.save_image(map_preview, map_path)
+                result['outputs'].append(map_path)
+            if dat:
+                # Files are already spread across the pool, so tiles are written serially here
+                maps_dir = os.path.join(output_dir, f"{stem}_maps")
+                exported = MapDataExporter.export(
+                    index_map, maps_dir, first_map_id, workers=1, incremental=not rewrite
+                )
+                result['outputs'].append(maps_dir)
+                result['maps'] = (exported.written, exported.unchanged)
+            if bom:
+                materials = MaterialEstimator.estimate(index_map)
+                bom_path = os.path.join(output_dir, f"materials_{stem}_{suffix}.csv")
+                MaterialEstimator.write_csv(materials, bom_path)
+                result['outputs'].append(bom_path)
+                result['materials'] = (materials.total_blocks, materials.cost, materials.max_height)
+        finished = time.perf_counter()
+
+        result.update({
+            'size': target_size,
+            'load_time': loaded - started,
+            'scale_time': scaled - loaded,
+            'quantize_time': quantized - scaled,
+            'total_time': finished - started,
+            'price': ImageProcessor.calculate_price(width_multiple, height_multiple),
+        })
+    except Exception as e:
+        result['error'] = str(e)
+    return result
+
+
+def run_batch(files: Iterable[str], output_dir: str, width_multiple: int, height_multiple: int,
+              output_format: str, mode: str, workers: int, dither: str = 'none',
+              metric: str = DEFAULT_METRIC, dat: bool = False, first_map_id: int = 0,
+              bom: bool = False, rewrite: bool = False) -> Iterator[Dict]:
+    """Convert files across a process pool, yielding results as they finish
+
+    Only a bounded number of files is in flight at once, so huge directories
+    are streamed rather than queued up front.
+    """
+    if mode in ('map', 'both') or dat or bom:
+        # Build the lookup table once here instead of in every worker
+        get_quantizer(metric=metric).prepare()
+
+    max_in_flight = workers * 2
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        pending = set()
+        for path in files:
+            pending.add(executor.submit(
+                convert_file, path, output_dir, width_multiple, height_multiple, output_format, mode, dither, metric,
+                dat, first_map_id, bom, rewrite
+            ))
+            if len(pending) >= max_in_flight:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield future.result()
+        for future in wait(pending).done:
+            yield future.result()
+
+
+def format_result(result: Dict) -> str:
+    name = os.path.basename(result['path'])
+    if result['error']:
+        return f"[失败] {name}: {result['error']}"
+    width, height = result['size']
+    line = (
+        f"[完成] {name}: {width}x{height}  "
+        f"读取 {result['load_time']:.2f}s  缩放 {result['scale_time']:.2f}s  "
+        f"量化 {result['quantize_time']:.2f}s  总计 {result['total_time']:.2f}s  "
+        f"价格 {result['price']} DCB"
+    )
+    if 'maps' in result:
+        written, unchanged = result['maps']
+        line += f"  地图文件 写入 {written} 个、未变化 {unchanged} 个"
+    if 'materials' in result:
+        blocks, cost, max_height = result['materials']
+        line += f"  方块 {blocks} 个  材料 {cost:.0f} DCB  高差 {max_height} 格"
+    return line
+
+
+def parse_args(argv: List[str]) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="批量将图片缩放并转换为 Minecraft 地图画")
+    parser.add_argument('inputs', nargs='+', help="图片文件、目录或通配符（如 'art/*.png'）")
+    parser.add_argument('-o', '--output-dir', default='output', help="输出目录（默认: output）")
+    parser.add_argument('-W', '--width-multiple', type=int, default=2, help="宽度倍数，1 = 128px（默认: 2）")
+    parser.add_argument('-H', '--height-multiple', type=int, default=2, help="高度倍数，1 = 128px（默认: 2）")
+    parser.add_argument('-j', '--workers', type=int, default=os.cpu_count() or 1, help="并行进程数（默认: CPU 核数）")
+    parser.add_argument('-f', '--format', default='png', help="输出格式扩展名（默认: png）")
+    parser.add_argument('--mode', choices=('map', 'scaled', 'both'), default='map',
+                        help="输出地图画、仅缩放图或两者（默认: map）")
+    parser.add_argument('--metric', choices=tuple(METRICS), default=DEFAULT_METRIC,
+                        help="颜色距离：rgb、redmean（加权 RGB）或 lab（CIELAB ΔE）（默认: rgb）")
+    parser.add_argument('--dat', action='store_true',
+                        help="同时为每个 128x128 分块导出 map_N.dat 到 <输出目录>/<文件名>_maps/")
+    parser.add_argument('--bom', action='store_true',
+                        help="同时输出材料清单 CSV（每个分块及总计的方块数量、阶梯高差）")
+    parser.add_argument('--rewrite', action='store_true',
+                        help="忽略 map_manifest.json，重写全部 map_N.dat（默认只写出内容有变化的分块）")
+    parser.add_argument('--map-id', type=int, default=0, help="第一张地图的编号（默认: 0）")
+    parser.add_argument('--dither', choices=DITHER_MODES, default='none', help="抖动算法（默认: none）")
+    args = parser.parse_args(argv)
+
+    if args.width_multiple <= 0 or args.height_multiple <= 0:
+        parser.error("倍数必须是正整数")
+    if args.workers <= 0:
+        parser.error("进程数必须是正整数")
+    if args.map_id < 0:
+        parser.error("地图编号不能为负数")
+    args.format = args.format.lower().lstrip('.')
+    return args
+
+
+def main(argv: List[str] = None) -> int:
+    args = parse_args(sys.argv[1:] if argv is None else argv)
+    os.makedirs(args.output_dir, exist_ok=True)
+
+    started = time.perf_counter()
+    converted = 0
+    failed = 0
+    total_price = 0
+    total_pixels = 0
+
+    for result in run_batch(
+        iter_input_files(args.inputs), args.output_dir, args.width_multiple,
+        args.height_multiple, args.format, args.mode, args.workers, args.dither, args.metric,
+        args.dat, args.map_id, args.bom, args.rewrite
+    ):
+        print(format_result(result), flush=True)
+        if result['error']:
+            failed += 1
+        else:
+            converted += 1
+            total_price += result['price']
+            total_pixels += result['size'][0] * result['size'][1]
+
+    elapsed = time.perf_counter() - started
+    print(
+        f"共处理 {converted + failed} 个文件（成功 {converted}，失败 {failed}），"
+        f"耗时 {elapsed:.2f}s，{total_pixels / max(elapsed, 1e-9) / 1e6:.1f} 百万像素/秒，"
+        f"总价格 {total_price} DCB"
+    )
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
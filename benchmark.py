@@ -0,0 +1,329 @@
+"""Benchmark suite for scaling, quantization and export
+
+Every backend runs on synthetic images that are reproducible from the seed,
+for each requested size in map multiples. Results give latency percentiles,
+throughput and peak traced memory, and can be saved as JSON and compared
+against a stored baseline.
+
+Example:
+    python benchmark.py --sizes 1-20,32x32 -o bench.json
+    python benchmark.py --backends map-preview,dither-bayer --compare bench.json
+"""
+import argparse
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+import tracemalloc
+from typing import Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+from PIL import Image, __version__ as PILLOW_VERSION
+
+from bill_of_materials import MaterialEstimator
+from color_mapper import MAP_COLORS
+from color_metrics import DEFAULT_METRIC, METRICS
+from dithering import DIFFUSION_KERNELS, Ditherer
+from image_utils import ImageProcessor
+from map_exporter import MapDataExporter
+from minecraft_map_processor import MinecraftMapProcessor
+from palette_quantizer import get_quantizer
+from tile_processor import TileProcessor
+
+DEFAULT_SIZES = '1x1,2x2,4x4,10x10,20x20'
+DEFAULT_REPEAT = 5
+DEFAULT_SEED = 1234
+# Slowdown of the median latency against the baseline that counts as a regression
+DEFAULT_THRESHOLD = 0.10
+# Pixels looked up one at a time by the nearest-color backend
+NEAREST_COLOR_SAMPLES = 2000
+# Source images are this much larger than the output, as for a typical photo
+SOURCE_SCALE = 1.5
+# Every 8th MAP_COLORS id, so the subset backend uses the grid index instead of the lookup table
+SUBSET_COLORS = tuple(sorted(MAP_COLORS))[1::8]
+
+
+def synthetic_image(width: int, height: int, seed: int = DEFAULT_SEED) -> np.ndarray:
+    """A reproducible (height, width, 3) uint8 test image
+
+    Smooth gradients with seeded noise, so quantization and dithering see both
+    flat regions and many distinct colors, like a photo.
+    """
+    rng = np.random.default_rng([seed, width, height])
+    y, x = np.mgrid[0:height, 0:width].astype(np.float32)
+    gradient = np.stack([
+        x * 255 / max(width - 1, 1),
+        y * 255 / max(height - 1, 1),
+        (np.sin(x / 37) * np.cos(y / 53) + 1) * 127.5,
+    ], axis=-1)
+    noise = rng.normal(0, 12, gradient.shape).astype(np.float32)
+    return np.clip(gradient + noise, 0, 255).astype(np.uint8)
+
+
+def parse_sizes(text: str) -> List[Tuple[int, int]]:
+    """Parse '1x1,4x3,10', where N means NxN and 'A-B' every square from AxA to BxB"""
+    sizes = []
+    for part in filter(None, (part.strip() for part in text.split(','))):
+        if 'x' in part:
+            width, height = part.split('x', 1)
+            sizes.append((int(width), int(height)))
+        elif '-' in part:
+            first, last = part.split('-', 1)
+            sizes.extend((n, n) for n in range(int(first), int(last) + 1))
+        else:
+            sizes.append((int(part), int(part)))
+    for width, height in sizes:
+        if width <= 0 or height <= 0:
+            raise ValueError(f"Invalid size: {width}x{height}")
+    return list(dict.fromkeys(sizes))
+
+
+class Case:
+    """One backend at one size: setup() builds the inputs, run() is what gets timed"""
+
+    def __init__(self, backend: str, size: Optional[Tuple[int, int]], pixels: int,
+                 setup: Callable[[], object], run: Callable[[object], object]):
+        self.backend = backend
+        self.size = size
+        self.pixels = pixels
+        self.setup = setup
+        self.run = run
+
+    @property
+    def size_label(self) -> str:
+        return f"{self.size[0]}x{self.size[1]}" if self.size else '-'
+
+
+def _scaled_input(size: Tuple[int, int], seed: int) -> Image.Image:
+    return Image.fromarray(synthetic_image(128 * size[0], 128 * size[1], seed))
+
+
+def _source_input(size: Tuple[int, int], seed: int) -> Image.Image:
+    width = int(128 * size[0] * SOURCE_SCALE)
+    height = int(128 * size[1] * SOURCE_SCALE)
+    return Image.fromarray(synthetic_image(width, height, seed))
+
+
+def _export(index_map: np.ndarray):
+    with tempfile.TemporaryDirectory() as output_dir:
+        MapDataExporter.export(index_map, output_dir)
+
+
+def _sized_cases(size: Tuple[int, int], metric: str, seed: int) -> Dict[str, Case]:
+    pixels = 128 * size[0] * 128 * size[1]
+    scaled = lambda: _scaled_input(size, seed)
+    index_map = lambda: MinecraftMapProcessor.quantize_image(scaled(), metric=metric)[1]
+
+    cases = {
+        'scale': Case('scale', size, pixels, lambda: _source_input(size, seed),
+                      lambda image: ImageProcessor.scale_image(image, *size)),
+        'map-preview': Case('map-preview', size, pixels, scaled,
+                            lambda image: MinecraftMapProcessor.create_map_preview(image, metric=metric)),
+        'map-preview-parallel': Case('map-preview-parallel', size, pixels, scaled,
+                                     lambda image: MinecraftMapProcessor.create_map_preview(
+                                         image, parallel=True, metric=metric)),
+        'subset': Case('subset', size, pixels, scaled,
+                       lambda image: MinecraftMapProcessor.create_map_preview(
+                           image, allowed_colors=SUBSET_COLORS, metric=metric)),
+        'export-dat': Case('export-dat', size, pixels, index_map, _export),
+        'bom': Case('bom', size, pixels, index_map, MaterialEstimator.estimate),
+    }
+    for mode in ('bayer',) + tuple(DIFFUSION_KERNELS):
+        cases[f'dither-{mode}'] = Case(
+            f'dither-{mode}', size, pixels, lambda: np.asarray(scaled()),
+            lambda array, mode=mode: Ditherer.quantize(array, get_quantizer(metric=metric), mode)
+        )
+    return cases
+
+
+def _nearest_color_case(metric: str, seed: int) -> Case:
+    def run(samples):
+        for pixel in samples:
+            MinecraftMapProcessor.find_nearest_color(pixel, metric=metric)
+
+    def setup():
+        rng = np.random.default_rng(seed)
+        return [tuple(int(v) for v in pixel) for pixel in rng.integers(0, 256, (NEAREST_COLOR_SAMPLES, 3))]
+
+    return Case('nearest-color', None, NEAREST_COLOR_SAMPLES, setup, run)
+
+
+BACKENDS = tuple(_sized_cases((1, 1), DEFAULT_METRIC, DEFAULT_SEED)) + ('nearest-color',)
+
+
+def build_cases(backends: List[str], sizes: List[Tuple[int, int]], metric: str, seed: int) -> List[Case]:
+    """Cases in backend order, each over all sizes; size-independent backends run once"""
+    by_size = [_sized_cases(size, metric, seed) for size in sizes]
+    cases = []
+    for backend in backends:
+        if backend == 'nearest-color':
+            cases.append(_nearest_color_case(metric, seed))
+        else:
+            cases.extend(sized[backend] for sized in by_size)
+    return cases
+
+
+def measure(case: Case, repeat: int, warmup: int = 1) -> Dict:
+    """Time case.run on inputs built once and trace its peak memory in a separate run
+
+    tracemalloc sees NumPy and Python allocations but not Pillow's internal
+    image buffers, and tracing slows the run, so it is kept out of the timings.
+    """
+    data = case.setup()
+    for _ in range(warmup):
+        case.run(data)
+
+    latencies = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        case.run(data)
+        latencies.append(time.perf_counter() - started)
+
+    tracemalloc.start()
+    try:
+        case.run(data)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    latencies = np.array(latencies) * 1000
+    median = float(np.percentile(latencies, 50))
+    return {
+        'backend': case.backend,
+        'size': case.size_label,
+        'pixels': case.pixels,
+        'repeat': repeat,
+        'latency_ms': {
+            'min': float(latencies.min()),
+            'mean': float(latencies.mean()),
+            'p50': median,
+            'p90': float(np.percentile(latencies, 90)),
+            'p99': float(np.percentile(latencies, 99)),
+        },
+        'pixels_per_s': case.pixels / (median / 1000) if median > 0 else float('inf'),
+        'peak_mb': peak / (1024 * 1024),
+    }
+
+
+def environment(args: argparse.Namespace) -> Dict:
+    return {
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'pillow': PILLOW_VERSION,
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'workers': TileProcessor.default_workers(),
+        'metric': args.metric,
+        'seed': args.seed,
+        'repeat': args.repeat,
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+    }
+
+
+def compare(results: List[Dict], baseline: Dict, threshold: float) -> List[Dict]:
+    """Median latency of every result relative to the same backend and size in the baseline"""
+    previous = {(entry['backend'], entry['size']): entry for entry in baseline.get('results', [])}
+    comparisons = []
+    for result in results:
+        entry = previous.get((result['backend'], result['size']))
+        if entry is None:
+            continue
+        ratio = result['latency_ms']['p50'] / max(entry['latency_ms']['p50'], 1e-9)
+        comparisons.append({
+            'backend': result['backend'],
+            'size': result['size'],
+            'baseline_p50_ms': entry['latency_ms']['p50'],
+            'p50_ms': result['latency_ms']['p50'],
+            'ratio': ratio,
+            'regression': ratio > 1 + threshold,
+        })
+    return comparisons
+
+
+def format_result(result: Dict) -> str:
+    latency = result['latency_ms']
+    return (
+        f"{result['backend']:>26} {result['size']:>7}  "
+        f"p50 {latency['p50']:9.1f} ms  p90 {latency['p90']:9.1f} ms  p99 {latency['p99']:9.1f} ms  "
+        f"{result['pixels_per_s'] / 1e6:8.1f} 百万像素/秒  峰值内存 {result['peak_mb']:7.1f} MB"
+    )
+
+
+def format_comparison(comparison: Dict) -> str:
+    flag = "  变慢" if comparison['regression'] else ""
+    return (
+        f"{comparison['backend']:>26} {comparison['size']:>7}  "
+        f"{comparison['baseline_p50_ms']:9.1f} ms -> {comparison['p50_ms']:9.1f} ms  "
+        f"({comparison['ratio']:5.2f}x){flag}"
+    )
+
+
+def parse_args(argv: List[str]) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="缩放、量化和导出的性能基准测试")
+    parser.add_argument('--sizes', default=DEFAULT_SIZES,
+                        help=f"地图倍数列表，如 '1x1,4x3'，'10' 表示 10x10，'1-20' 表示 1x1 到 20x20（默认: {DEFAULT_SIZES}）")
+    parser.add_argument('--backends', default=','.join(BACKENDS),
+                        help=f"逗号分隔的测试项（默认全部: {', '.join(BACKENDS)}）")
+    parser.add_argument('--metric', choices=tuple(METRICS), default=DEFAULT_METRIC, help="颜色距离（默认: rgb）")
+    parser.add_argument('-n', '--repeat', type=int, default=DEFAULT_REPEAT, help=f"每项计时次数（默认: {DEFAULT_REPEAT}）")
+    parser.add_argument('--seed', type=int, default=DEFAULT_SEED, help=f"合成图片的随机种子（默认: {DEFAULT_SEED}）")
+    parser.add_argument('-o', '--output', help="将结果写入 JSON 文件")
+    parser.add_argument('--compare', metavar='BASELINE', help="与基线 JSON 比较，中位延迟变慢超过阈值时返回 1")
+    parser.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD,
+                        help=f"判定为变慢的中位延迟增幅（默认: {DEFAULT_THRESHOLD}）")
+    args = parser.parse_args(argv)
+
+    try:
+        args.sizes = parse_sizes(args.sizes)
+    except ValueError:
+        parser.error(f"无效的尺寸: {args.sizes}")
+    args.backends = [backend.strip() for backend in args.backends.split(',') if backend.strip()]
+    unknown = [backend for backend in args.backends if backend not in BACKENDS]
+    if unknown:
+        parser.error(f"未知的测试项: {', '.join(unknown)}")
+    if args.repeat <= 0:
+        parser.error("计时次数必须是正整数")
+    return args
+
+
+def main(argv: List[str] = None) -> int:
+    args = parse_args(sys.argv[1:] if argv is None else argv)
+
+    # Lookup tables and indexes are built or loaded up front, not inside the timings
+    get_quantizer(metric=args.metric).prepare()
+    get_quantizer(SUBSET_COLORS, args.metric).prepare()
+
+    results = []
+    try:
+        for case in build_cases(args.backends, args.sizes, args.metric, args.seed):
+            result = measure(case, args.repeat)
+            results.append(result)
+            print(format_result(result), flush=True)
+    finally:
+        TileProcessor.shutdown()
+
+    report = {'environment': environment(args), 'results': results}
+    regressions = 0
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f:
+            baseline = json.load(f)
+        report['comparison'] = compare(results, baseline, args.threshold)
+        print("与基线比较（中位延迟）:")
+        for comparison in report['comparison']:
+            print(format_comparison(comparison))
+        regressions = sum(comparison['regression'] for comparison in report['comparison'])
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+
+    if regressions:
+        print(f"{regressions} 项变慢超过 {args.threshold:.0%}")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
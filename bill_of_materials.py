@@ -0,0 +1,211 @@
+import csv
+import numpy as np
+from typing import Dict, List, NamedTuple, Optional
+
+from color_mapper import MAP_PALETTE
+from instrumentation import timed
+
+# Side length of one in-game map in pixels
+TILE_SIZE = 128
+
+# Number of Minecraft base map colors (1..61); index 0 is "no block"
+BASE_COLOR_COUNT = MAP_PALETTE.base_count
+
+# A commonly used block for each base map color
+BASE_COLOR_BLOCKS = {
+    1: "草方块", 2: "桦木木板", 3: "蘑菇柄", 4: "红石块", 5: "浮冰", 6: "铁块",
+    7: "橡树树叶", 8: "白色羊毛", 9: "黏土块", 10: "泥土", 11: "圆石", 12: "水",
+    13: "橡木木板", 14: "石英块", 15: "橙色羊毛", 16: "品红色羊毛", 17: "淡蓝色羊毛",
+    18: "黄色羊毛", 19: "黄绿色羊毛", 20: "粉红色羊毛", 21: "灰色羊毛", 22: "淡灰色羊毛",
+    23: "青色羊毛", 24: "紫色羊毛", 25: "蓝色羊毛", 26: "棕色羊毛", 27: "绿色羊毛",
+    28: "红色羊毛", 29: "黑色羊毛", 30: "金块", 31: "钻石块", 32: "青金石块",
+    33: "绿宝石块", 34: "云杉木板", 35: "下界岩", 36: "白色陶瓦", 37: "橙色陶瓦",
+    38: "品红色陶瓦", 39: "淡蓝色陶瓦", 40: "黄色陶瓦", 41: "黄绿色陶瓦", 42: "粉红色陶瓦",
+    43: "灰色陶瓦", 44: "淡灰色陶瓦", 45: "青色陶瓦", 46: "紫色陶瓦", 47: "蓝色陶瓦",
+    48: "棕色陶瓦", 49: "绿色陶瓦", 50: "红色陶瓦", 51: "黑色陶瓦", 52: "绯红菌岩",
+    53: "绯红菌柄", 54: "绯红菌核", 55: "诡异菌岩", 56: "诡异菌柄", 57: "诡异菌核",
+    58: "诡异疣块", 59: "深板岩", 60: "粗铁块", 61: "发光地衣",
+}
+
+# Estimated price of one block when no price list is given, in DCB
+DEFAULT_BLOCK_PRICE = 1.0
+
+# Blocks per stack and per shulker box
+STACK_SIZE = 64
+SHULKER_SIZE = 27 * STACK_SIZE
+
+
+def _build_id_tables():
+    """MAP_COLORS id -> base color one-hot, height step and whether blocks can produce it"""
+    ids = MAP_PALETTE.ids
+    base = np.zeros((256, BASE_COLOR_COUNT), dtype=np.int64)
+    step = np.zeros(256, dtype=np.int16)
+    unplaceable = np.zeros(256, dtype=np.int64)
+    base[ids, MAP_PALETTE.base_ids] = 1
+    # Shade 0 (darker) sits one block lower than its northern neighbour,
+    # 1 level with it and 2 (brightest) one block higher. Shade 3 cannot be
+    # produced by blocks at all, so it is built flat and reported.
+    placed = ids > 0
+    step[ids[placed]] = np.array([-1, 0, 1, 0], dtype=np.int16)[MAP_PALETTE.shades[placed]]
+    unplaceable[ids[placed]] = MAP_PALETTE.shades[placed] == 3
+    return base, step, unplaceable
+
+
+_ID_BASE, _ID_STEP, _ID_UNPLACEABLE = _build_id_tables()
+
+
+class MaterialReport(NamedTuple):
+    """Block counts and staircase heights for a quantized mural"""
+    # (tile_rows, tile_columns, BASE_COLOR_COUNT) blocks per map tile and base color
+    tile_counts: np.ndarray
+    # (BASE_COLOR_COUNT,) blocks of each base color over the whole mural
+    total_counts: np.ndarray
+    # (height, width) int16 block elevation above the lowest block of its column within its tile
+    heights: np.ndarray
+    # (tile_rows, tile_columns) highest elevation needed inside each map tile
+    tile_max_heights: np.ndarray
+    # Pixels using shade 3, which blocks cannot produce
+    unplaceable: int
+    # Estimated cost of all blocks, in DCB
+    cost: float
+
+    @property
+    def total_blocks(self) -> int:
+        return int(self.total_counts[1:].sum())
+
+    @property
+    def max_height(self) -> int:
+        return int(self.tile_max_heights.max()) if self.tile_max_heights.size else 0
+
+    def materials(self) -> List[Dict]:
+        """Blocks needed over the whole mural, most used first"""
+        rows = []
+        for base in np.argsort(-self.total_counts, kind='stable'):
+            count = int(self.total_counts[base])
+            if base == 0 or count == 0:
+                continue
+            rows.append({
+                'base_color': int(base),
+                'block': BASE_COLOR_BLOCKS.get(int(base), f"颜色 {base}"),
+                'count': count,
+                'stacks': count / STACK_SIZE,
+                'shulker_boxes': count / SHULKER_SIZE,
+            })
+        return rows
+
+
+class MaterialEstimator:
+    """Bill of materials and staircase height map computed from a palette index map
+
+    Counting is one bincount per row of map tiles and the staircase is a
+    running sum over rows, so even a 20x20 map mural takes only tens of
+    milliseconds.
+    """
+
+    @staticmethod
+    def count_colors(index_map: np.ndarray) -> np.ndarray:
+        """Return (tile_rows, tile_columns, 256) pixel counts per map tile and MAP_COLORS id"""
+        height, width = index_map.shape
+        columns = -(-width // TILE_SIZE)
+        # Offset every id by its tile column so one bincount per tile row covers all its tiles
+        offsets = (np.arange(width, dtype=np.intp) // TILE_SIZE) * 256
+        rows = []
+        for top in range(0, height, TILE_SIZE):
+            codes = index_map[top:top + TILE_SIZE] + offsets
+            rows.append(np.bincount(codes.ravel(), minlength=columns * 256).reshape(columns, 256))
+        return np.stack(rows) if rows else np.zeros((0, columns, 256), dtype=np.int64)
+
+    @staticmethod
+    def count_blocks(index_map: np.ndarray) -> np.ndarray:
+        """Return (tile_rows, tile_columns, BASE_COLOR_COUNT) block counts"""
+        return MaterialEstimator.count_colors(index_map) @ _ID_BASE
+
+    @staticmethod
+    def height_map(index_map: np.ndarray) -> np.ndarray:
+        """Block elevations that produce each pixel's shade, as an int16 array
+
+        A map shades a block by comparing it with the block to its north, so
+        every column is a staircase: the running sum of the per-pixel steps.
+        Each map tile is built as its own area with a reference row just north
+        of it, and every column is shifted so its lowest block sits at 0.
+        """
+        heights = _ID_STEP[index_map]
+        for top in range(0, len(heights), TILE_SIZE):
+            stairs = heights[top:top + TILE_SIZE]
+            # Row by row is much faster than cumsum along axis 0; the reference
+            # row is at elevation 0, so the first row already steps from it
+            for row in range(1, len(stairs)):
+                np.add(stairs[row], stairs[row - 1], out=stairs[row])
+            stairs -= np.minimum(stairs.min(axis=0), 0)
+        return heights
+
+    @staticmethod
+    @timed('bill_of_materials')
+    def estimate(index_map: np.ndarray, block_prices: Optional[Dict[int, float]] = None,
+                 default_price: float = DEFAULT_BLOCK_PRICE) -> MaterialReport:
+        """Build the full report for an index map
+
+        block_prices maps base color ids to a price per block; colors without
+        an entry cost default_price.
+        """
+        index_map = np.asarray(index_map, dtype=np.uint8)
+        color_counts = MaterialEstimator.count_colors(index_map)
+        tile_counts = color_counts @ _ID_BASE
+        total_counts = tile_counts.sum(axis=(0, 1))
+
+        heights = MaterialEstimator.height_map(index_map)
+        tile_starts = np.arange(0, index_map.shape[1], TILE_SIZE)
+        tile_max_heights = np.stack([
+            np.maximum.reduceat(heights[top:top + TILE_SIZE].max(axis=0), tile_starts)
+            for top in range(0, index_map.shape[0], TILE_SIZE)
+        ]) if index_map.size else np.zeros(tile_counts.shape[:2], dtype=np.int16)
+
+        prices = np.full(BASE_COLOR_COUNT, default_price, dtype=np.float64)
+        prices[0] = 0
+        for base, price in (block_prices or {}).items():
+            prices[base] = price
+
+        return MaterialReport(
+            tile_counts=tile_counts,
+            total_counts=total_counts,
+            heights=heights,
+            tile_max_heights=tile_max_heights,
+            unplaceable=int(color_counts.sum(axis=(0, 1)) @ _ID_UNPLACEABLE),
+            cost=float(total_counts @ prices),
+        )
+
+    @staticmethod
+    def format_report(report: MaterialReport) -> str:
+        """Human readable summary of a report"""
+        lines = [
+            f"共需 {report.total_blocks} 个方块，预计材料成本 {report.cost:.0f} DCB，"
+            f"最大高差 {report.max_height} 格"
+        ]
+        if report.unplaceable:
+            lines.append(f"警告: {report.unplaceable} 个像素使用了方块无法实现的最暗色调，已按平铺计算")
+        for row in report.materials():
+            lines.append(
+                f"  {row['block']}: {row['count']}（{row['stacks']:.1f} 组，{row['shulker_boxes']:.2f} 潜影盒）"
+            )
+        return "\n".join(lines)
+
+    @staticmethod
+    def write_csv(report: MaterialReport, path: str):
+        """Write per-tile and total block counts as CSV"""
+        with open(path, 'w', newline='', encoding='utf-8-sig') as f:
+            writer = csv.writer(f)
+            writer.writerow(['tile_row', 'tile_column', 'base_color', 'block', 'count', 'max_height'])
+            rows, columns = report.tile_counts.shape[:2]
+            for row in range(rows):
+                for column in range(columns):
+                    counts = report.tile_counts[row, column]
+                    for base in np.flatnonzero(counts[1:]) + 1:
+                        writer.writerow([
+                            row, column, int(base), BASE_COLOR_BLOCKS.get(int(base), ''),
+                            int(counts[base]), int(report.tile_max_heights[row, column])
+                        ])
+            for material in report.materials():
+                writer.writerow([
+                    'total', 'total', material['base_color'], material['block'], material['count'],
+                    report.max_height
+                ])
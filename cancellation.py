@@ -0,0 +1,25 @@
+import threading
+
+
+class CancelledError(Exception):
+    """Raised inside a job when its cancellation token has been triggered"""
+
+
+class CancellationToken:
+    """Flag shared between a job and its owner so the job can stop between chunks"""
+
+    def __init__(self):
+        self._event = threading.Event()
+
+    def cancel(self):
+        """Request the job to stop at its next check"""
+        self._event.set()
+
+    @property
+    def cancelled(self):
+        return self._event.is_set()
+
+    def raise_if_cancelled(self):
+        """Raise CancelledError if cancellation was requested"""
+        if self._event.is_set():
+            raise CancelledError()
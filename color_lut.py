@@ -0,0 +1,140 @@
+import hashlib
+import os
+import tempfile
+import numpy as np
+from typing import Optional
+from color_metrics import DEFAULT_METRIC, ColorMetric, get_metric
+
+# Directory the cached tables are written to: next to the application
+DEFAULT_CACHE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Bump when the table layout or build algorithm changes
+LUT_FORMAT_VERSION = 1
+
+
+class ColorLookupTable:
+    """Precomputed RGB -> palette position table covering all 256^3 colors"""
+
+    # Build works on 8x8x8 cells of RGB space (32 cells per axis)
+    CELL_BITS = 3
+    # Upper bound on the scratch distance buffer used while building
+    BUILD_CHUNK_ELEMENTS = 1 << 22
+
+    def __init__(self, table: np.ndarray, palette_hash: str):
+        self.table = table
+        self.palette_hash = palette_hash
+
+    @staticmethod
+    def hash_palette(palette: np.ndarray, metric: str = DEFAULT_METRIC) -> str:
+        """Hash a (n, 3) uint8 palette together with the distance metric and table format version"""
+        digest = hashlib.sha1()
+        digest.update(f"lut-v{LUT_FORMAT_VERSION}".encode("ascii"))
+        if metric != DEFAULT_METRIC:
+            # RGB tables keep their original hash so existing caches stay valid
+            digest.update(f"metric:{metric}".encode("ascii"))
+        digest.update(np.ascontiguousarray(palette, dtype=np.uint8).tobytes())
+        return digest.hexdigest()
+
+    @staticmethod
+    def cache_path(palette_hash: str, cache_dir: Optional[str] = None) -> str:
+        """Return the cache file path for a palette hash"""
+        return os.path.join(cache_dir or DEFAULT_CACHE_DIR, f"map_colors_lut_{palette_hash[:16]}.npy")
+
+    @classmethod
+    def load_or_build(cls, palette: np.ndarray, cache_dir: Optional[str] = None,
+                      metric: Optional[ColorMetric] = None) -> "ColorLookupTable":
+        """Memory-map the cached table for a palette, building and saving it if needed"""
+        metric = metric or get_metric()
+        palette_hash = cls.hash_palette(palette, metric.name)
+        path = cls.cache_path(palette_hash, cache_dir)
+
+        try:
+            table = np.load(path, mmap_mode='r')
+            if table.shape == (1 << 24,) and table.dtype == np.uint8:
+                return cls(table, palette_hash)
+        except (OSError, ValueError):
+            pass
+
+        table = cls.build(palette, metric)
+        try:
+            cls._save(table, path)
+            table = np.load(path, mmap_mode='r')
+        except OSError:
+            # Read-only install directory: keep the in-memory table for this session
+            pass
+        return cls(table, palette_hash)
+
+    @staticmethod
+    def _save(table: np.ndarray, path: str):
+        """Write the table atomically so a crashed build never leaves a bad cache"""
+        directory = os.path.dirname(path)
+        fd, tmp_path = tempfile.mkstemp(suffix=".npy.tmp", dir=directory)
+        try:
+            with os.fdopen(fd, "wb") as f:
+                np.save(f, table)
+            os.chmod(tmp_path, 0o644)
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    @classmethod
+    def build(cls, palette: np.ndarray, metric: Optional[ColorMetric] = None) -> np.ndarray:
+        """Compute the exact nearest palette position for every RGB value
+
+        RGB space is split into the same cells as PaletteIndex and the points
+        of each cell are resolved exactly against that cell's short candidate
+        list, so the build never compares a point with the whole palette.
+        """
+        metric = metric or get_metric()
+        palette = np.asarray(palette, dtype=np.uint8).reshape(-1, 3)
+        cell_size = 1 << cls.CELL_BITS
+        cells_per_axis = 256 // cell_size
+
+        candidates = metric.cell_candidates(palette, cls.CELL_BITS)
+        weights, bias = metric.palette_terms(palette)
+
+        # Offsets of every point inside a cell, and the origin of every cell
+        offsets = np.stack(np.meshgrid(
+            np.arange(cell_size), np.arange(cell_size), np.arange(cell_size), indexing='ij'
+        ), axis=-1).reshape(-1, 3).astype(np.int32)
+        cell_index = np.arange(cells_per_axis ** 3)
+        origins = np.stack([
+            cell_index // (cells_per_axis ** 2),
+            (cell_index // cells_per_axis) % cells_per_axis,
+            cell_index % cells_per_axis
+        ], axis=-1).astype(np.int32) * cell_size
+
+        table = np.empty(1 << 24, dtype=np.uint8)
+        counts = candidates.sum(axis=1)
+
+        # Cells with the same number of candidates are resolved together
+        for count in np.unique(counts):
+            cells = np.nonzero(counts == count)[0]
+            # Candidate positions are listed in ascending order, so argmin keeps
+            # the same tie-breaking as a full scan of the palette
+            cell_candidates = np.nonzero(candidates[cells])[1].reshape(len(cells), count)
+            step = max(1, cls.BUILD_CHUNK_ELEMENTS // (len(offsets) * count * weights.shape[1]))
+
+            for start in range(0, len(cells), step):
+                chunk = slice(start, start + step)
+                points = origins[cells[chunk]][:, None, :] + offsets[None, :, :]
+                chunk_candidates = cell_candidates[chunk]
+                distances = np.einsum(
+                    'cpk,cjk->cpj', metric.features(points.astype(np.uint8)), weights[chunk_candidates]
+                )
+                distances += bias[chunk_candidates][:, None, :]
+                nearest = np.take_along_axis(
+                    cell_candidates[chunk], distances.argmin(axis=2), axis=1
+                )
+                codes = (points[..., 0] << 16) | (points[..., 1] << 8) | points[..., 2]
+                table[codes] = nearest
+
+        return table
+
+    def lookup(self, pixels: np.ndarray) -> np.ndarray:
+        """Return the nearest palette position for each RGB pixel of an (..., 3) array"""
+        pixels = np.asarray(pixels, dtype=np.uint8)
+        codes = (pixels[..., 0].astype(np.int32) << 16) | (pixels[..., 1].astype(np.int32) << 8) | pixels[..., 2]
+        return self.table[codes]
@@ -1,5 +1,13 @@
+import hashlib
 import json
-from math import sqrt
+import numpy as np
+from typing import Dict, Iterable, Iterator, Mapping, Sequence, Tuple, Union
+
+from color_metrics import srgb_to_lab
+
+# Map color id the game draws as transparent ("no block"); its (0, 0, 0)
+# entry is never a color a pixel can be matched to
+TRANSPARENT_ID = 0
 
 # Minecraft map colors (base colors from minecraft 1.12+)
 MAP_COLORS = {
@@ -248,4 +256,150 @@ MAP_COLORS = {
     242: (109, 144, 129),
     243: (127, 167, 150),
     244: (67, 88, 79),
-}
\ No newline at end of file
+}
+
+
+class Palette:
+    """Immutable palette of map color ids and their RGB values, as contiguous arrays
+
+    Colors are sorted by id, so palette positions follow id order. The
+    squared norms, Lab values, id tables, base colors and shades are computed
+    once here and used as they are by the color metrics, the grid index, the
+    quantizers and the material estimator; every array is read-only. Palettes
+    compare and hash by their colors (not their name), so they can be used
+    as cache keys.
+    """
+
+    __slots__ = (
+        'name', 'ids', 'colors', 'squared_norms', 'lab', 'id_colors', 'positions',
+        'base_ids', 'shades', 'base_count', 'digest'
+    )
+
+    def __init__(self, colors: Mapping[int, Sequence[int]], name: str = 'custom'):
+        items = sorted((int(color_id), tuple(int(v) for v in rgb)) for color_id, rgb in colors.items())
+        if not items:
+            raise ValueError("A palette needs at least one color")
+        for color_id, rgb in items:
+            if not 0 <= color_id <= 255:
+                raise ValueError(f"Map color id out of range 0-255: {color_id}")
+            if len(rgb) != 3 or not all(0 <= v <= 255 for v in rgb):
+                raise ValueError(f"Color {color_id} must be three values in 0-255, got {rgb}")
+
+        ids = np.array([color_id for color_id, _ in items], dtype=np.uint8)
+        rgb = np.array([rgb for _, rgb in items], dtype=np.uint8).reshape(-1, 3)
+        # Map color id -> RGB, for expanding index maps back to pixels
+        id_colors = np.zeros((256, 3), dtype=np.uint8)
+        id_colors[ids] = rgb
+        # Map color id -> palette position, -1 for ids not in the palette
+        positions = np.full(256, -1, dtype=np.intp)
+        positions[ids] = np.arange(len(ids))
+
+        # Id k >= 1 is shade (k - 1) % 4 of base color (k - 1) // 4 + 1; id 0 is "no block"
+        wide = ids.astype(np.int16)
+        base_ids = np.where(wide > 0, (wide - 1) // 4 + 1, 0)
+        shades = np.where(wide > 0, (wide - 1) % 4, 0)
+        base_count = int(base_ids.max()) + 1
+
+        digest = hashlib.sha1(ids.tobytes() + rgb.tobytes()).hexdigest()
+        fields = {
+            'name': name,
+            'ids': ids,
+            'colors': rgb,
+            'squared_norms': (rgb.astype(np.int32) ** 2).sum(axis=1),
+            'lab': srgb_to_lab(rgb),
+            'id_colors': id_colors,
+            'positions': positions,
+            'base_ids': base_ids,
+            'shades': shades,
+            'base_count': base_count,
+            'digest': digest,
+        }
+        for field, value in fields.items():
+            if isinstance(value, np.ndarray):
+                value = np.ascontiguousarray(value)
+                value.setflags(write=False)
+            object.__setattr__(self, field, value)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("Palette is immutable")
+
+    def __delattr__(self, name):
+        raise AttributeError("Palette is immutable")
+
+    def __reduce__(self):
+        return Palette, (self.as_dict(), self.name)
+
+    def __eq__(self, other) -> bool:
+        return isinstance(other, Palette) and self.digest == other.digest
+
+    def __hash__(self) -> int:
+        return hash(self.digest)
+
+    def __repr__(self) -> str:
+        return f"Palette({self.name!r}, {len(self)} colors)"
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def __iter__(self) -> Iterator[int]:
+        return (int(color_id) for color_id in self.ids)
+
+    def __contains__(self, color_id) -> bool:
+        return isinstance(color_id, (int, np.integer)) and 0 <= color_id <= 255 and self.positions[color_id] >= 0
+
+    def __getitem__(self, color_id: int) -> Tuple[int, int, int]:
+        if color_id not in self:
+            raise KeyError(color_id)
+        return tuple(int(v) for v in self.id_colors[color_id])
+
+    def as_dict(self) -> Dict[int, Tuple[int, int, int]]:
+        """Color id -> (r, g, b), in id order"""
+        return {int(color_id): tuple(int(v) for v in rgb) for color_id, rgb in zip(self.ids, self.colors)}
+
+    def subset(self, color_ids: Iterable[int]) -> "Palette":
+        """Palette of only the given ids, which must all be in this palette"""
+        color_ids = sorted({int(color_id) for color_id in color_ids})
+        unknown = [color_id for color_id in color_ids if color_id not in self]
+        if unknown:
+            raise ValueError(f"Unknown map color ids: {unknown}")
+        if len(color_ids) == len(self):
+            return self
+        return Palette({color_id: self[color_id] for color_id in color_ids}, self.name)
+
+    @classmethod
+    def from_json(cls, source: Union[str, Mapping]) -> "Palette":
+        """Load a palette from a JSON file path or an already parsed object
+
+        The JSON holds {"name": ..., "colors": {id: color}} or just the
+        {id: color} mapping, where a color is [r, g, b] or "#rrggbb".
+        """
+        if isinstance(source, str):
+            with open(source, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            default_name = source
+        else:
+            data = source
+            default_name = 'custom'
+        if not isinstance(data, Mapping):
+            raise ValueError("A palette must be a JSON object")
+        name = data.get('name', default_name) if 'colors' in data else default_name
+        entries = data['colors'] if 'colors' in data else data
+        if not isinstance(entries, Mapping):
+            raise ValueError("Palette colors must be a JSON object of id: color")
+
+        colors = {}
+        for color_id, value in entries.items():
+            try:
+                if isinstance(value, str):
+                    text = value.lstrip('#')
+                    if len(text) != 6:
+                        raise ValueError(value)
+                    value = (int(text[0:2], 16), int(text[2:4], 16), int(text[4:6], 16))
+                colors[int(color_id)] = tuple(int(v) for v in value)
+            except (TypeError, ValueError):
+                raise ValueError(f"Invalid palette entry {color_id!r}: {value!r}") from None
+        return cls(colors, name)
+
+
+# The standard map palette, shared by every quantizer
+MAP_PALETTE = Palette(MAP_COLORS, 'minecraft')
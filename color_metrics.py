@@ -0,0 +1,223 @@
+import numpy as np
+from functools import lru_cache
+from typing import Dict, Tuple
+
+DEFAULT_METRIC = 'rgb'
+
+
+@lru_cache(maxsize=1)
+def _srgb_linear_table() -> np.ndarray:
+    """Linear-light value of every 8-bit sRGB level"""
+    levels = np.arange(256, dtype=np.float64) / 255
+    return np.where(levels <= 0.04045, levels / 12.92, ((levels + 0.055) / 1.055) ** 2.4)
+
+
+# sRGB (D65) -> XYZ, with each row divided by the D65 white point
+_RGB_TO_XYZ_D65 = np.array([
+    [0.4124564, 0.3575761, 0.1804375],
+    [0.2126729, 0.7151522, 0.0721750],
+    [0.0193339, 0.1191920, 0.9503041],
+]) / np.array([[0.95047], [1.0], [1.08883]])
+
+
+def srgb_to_lab(pixels: np.ndarray) -> np.ndarray:
+    """Convert an (..., 3) uint8 sRGB array to float32 CIELAB in bulk"""
+    pixels = np.asarray(pixels, dtype=np.uint8)
+    linear = _srgb_linear_table().astype(np.float32)[pixels]
+    xyz = linear @ _RGB_TO_XYZ_D65.T.astype(np.float32)
+    delta = 6 / 29
+    f = np.where(xyz > delta ** 3, np.cbrt(xyz), xyz / (3 * delta ** 2) + 4 / 29)
+    lab = np.empty_like(f)
+    lab[..., 0] = 116 * f[..., 1] - 16
+    lab[..., 1] = 500 * (f[..., 0] - f[..., 1])
+    lab[..., 2] = 200 * (f[..., 1] - f[..., 2])
+    return lab
+
+
+def palette_colors(palette) -> np.ndarray:
+    """(n, 3) uint8 colors of a palette given as an array or a color_mapper.Palette"""
+    return np.asarray(getattr(palette, 'colors', palette), dtype=np.uint8).reshape(-1, 3)
+
+
+def palette_lab(palette) -> np.ndarray:
+    """float32 CIELAB colors of a palette, precomputed when it is a color_mapper.Palette"""
+    lab = getattr(palette, 'lab', None)
+    return lab if lab is not None else srgb_to_lab(palette_colors(palette))
+
+
+def _cell_axis_bounds(palette: np.ndarray, cell_bits: int):
+    """Per-axis (cells_per_axis, colors) minimum and maximum squared distances to each cell"""
+    cell_size = 1 << cell_bits
+    cells_per_axis = 256 // cell_size
+    low = np.arange(cells_per_axis, dtype=np.int64)[:, None] * cell_size
+    high = low + cell_size - 1
+    axis_min = []
+    axis_max = []
+    for axis in range(3):
+        channel = palette[:, axis][None, :].astype(np.int64)
+        gap = np.maximum(np.maximum(low - channel, channel - high), 0)
+        axis_min.append(gap ** 2)
+        axis_max.append(np.maximum((channel - low) ** 2, (channel - high) ** 2))
+    return low, high, axis_min, axis_max
+
+
+def _combine_axes(red: np.ndarray, green: np.ndarray, blue: np.ndarray) -> np.ndarray:
+    """Sum per-axis (cells_per_axis, colors) terms into a (cells, colors) array"""
+    return (red[:, None, None, :] + green[None, :, None, :] + blue[None, None, :, :]).reshape(-1, red.shape[-1])
+
+
+class ColorMetric:
+    """Nearest-color distance expressed as score(p, c) = features(p) . weights(c) + bias(c)
+
+    score differs from the true distance only by terms that depend on the
+    pixel alone, so the nearest color is the argmin of the score. The palette
+    side (weights and bias) is computed once per palette, the pixel side is
+    converted in bulk, and a search is then one matrix product.
+    Palettes may be (n, 3) uint8 arrays or color_mapper.Palette objects,
+    whose precomputed squared norms and Lab values are used as they are.
+    """
+
+    name = DEFAULT_METRIC
+    # Precision of features and weights; float32 is exact for the integer RGB terms
+    dtype = np.float32
+
+    def features(self, pixels: np.ndarray) -> np.ndarray:
+        """Return the (..., k) pixel features for an (..., 3) uint8 array"""
+        return np.asarray(pixels).astype(self.dtype)
+
+    def palette_terms(self, palette: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """Return the (colors, k) weights and (colors,) bias for a palette"""
+        colors = palette_colors(palette).astype(self.dtype)
+        norms = getattr(palette, 'squared_norms', None)
+        bias = norms.astype(self.dtype) if norms is not None else (colors ** 2).sum(axis=1)
+        return -2 * colors, bias
+
+    def cell_candidates(self, palette: np.ndarray, cell_bits: int) -> np.ndarray:
+        """Return a (cells, colors) mask of the colors that can be nearest within each RGB cell
+
+        A color is kept when its minimum distance to the cell does not exceed
+        the smallest maximum distance of any color, which keeps the result
+        exact.
+        """
+        _, _, axis_min, axis_max = _cell_axis_bounds(palette_colors(palette), cell_bits)
+        min_dist = _combine_axes(*axis_min)
+        max_dist = _combine_axes(*axis_max)
+        return min_dist <= max_dist.min(axis=1, keepdims=True)
+
+
+class RedmeanMetric(ColorMetric):
+    """Low-cost weighted RGB distance where the weights follow the mean red level
+
+    d = (2 + r/256) dR^2 + 4 dG^2 + (2 + (255 - r)/256) dB^2 with r the mean
+    red of both colors. Scaled by 512 and with the pixel-only terms dropped
+    this is linear in (R, G, B, R^2, B^2, RB) of the pixel.
+    """
+
+    name = 'redmean'
+    # The scaled integer terms exceed 2^24, so float64 keeps them exact
+    dtype = np.float64
+
+    def features(self, pixels: np.ndarray) -> np.ndarray:
+        pixels = np.asarray(pixels).astype(self.dtype)
+        red = pixels[..., 0]
+        blue = pixels[..., 2]
+        return np.concatenate([pixels, np.stack([red * red, blue * blue, red * blue], axis=-1)], axis=-1)
+
+    def palette_terms(self, palette: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        colors = palette_colors(palette).astype(self.dtype)
+        red, green, blue = colors[:, 0], colors[:, 1], colors[:, 2]
+        weights = np.stack([
+            -2048 * red - red * red - blue * blue,
+            -4096 * green,
+            -3068 * blue + 2 * red * blue,
+            -red,
+            -red,
+            2 * blue,
+        ], axis=1)
+        bias = 1024 * red ** 2 + 2048 * green ** 2 + 1534 * blue ** 2 + red ** 3 - red * blue ** 2
+        return weights, bias
+
+    def cell_candidates(self, palette: np.ndarray, cell_bits: int) -> np.ndarray:
+        # Bound the red and blue weights over each red slab, then bound the distance as in RGB
+        palette = palette_colors(palette)
+        low, high, axis_min, axis_max = _cell_axis_bounds(palette, cell_bits)
+        red = palette[:, 0][None, :].astype(np.int64)
+        mean_low = low + red
+        mean_high = high + red
+        count = len(palette)
+        # The blue weight depends on the red slab, so that term spans both axes
+        min_dist = ((1024 + mean_low) * axis_min[0])[:, None, None, :] \
+            + (2048 * axis_min[1])[None, :, None, :] \
+            + (1534 - mean_high)[:, None, None, :] * axis_min[2][None, None, :, :]
+        max_dist = ((1024 + mean_high) * axis_max[0])[:, None, None, :] \
+            + (2048 * axis_max[1])[None, :, None, :] \
+            + (1534 - mean_low)[:, None, None, :] * axis_max[2][None, None, :, :]
+        min_dist = min_dist.reshape(-1, count)
+        max_dist = max_dist.reshape(-1, count)
+        return min_dist <= max_dist.min(axis=1, keepdims=True)
+
+
+class LabMetric(ColorMetric):
+    """CIE76 Delta E: Euclidean distance between CIELAB colors"""
+
+    name = 'lab'
+
+    def features(self, pixels: np.ndarray) -> np.ndarray:
+        return srgb_to_lab(pixels)
+
+    def palette_terms(self, palette: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        lab = palette_lab(palette).astype(np.float64)
+        return (-2 * lab).astype(self.dtype), (lab ** 2).sum(axis=1).astype(self.dtype)
+
+    def cell_candidates(self, palette: np.ndarray, cell_bits: int) -> np.ndarray:
+        # Lab is Euclidean, so with each cell's centre and radius the triangle
+        # inequality bounds the distance of every point in it
+        centres, radii = _lab_cells(cell_bits)
+        lab = palette_lab(palette).astype(np.float64)
+        distances = np.sqrt(((centres[:, None, :] - lab[None, :, :]) ** 2).sum(axis=-1))
+        nearest = distances.min(axis=1, keepdims=True)
+        # The small slack absorbs float32 rounding in the search itself
+        return distances <= nearest + 2 * radii[:, None] + 1e-3
+
+
+@lru_cache(maxsize=4)
+def _lab_cells(cell_bits: int) -> Tuple[np.ndarray, np.ndarray]:
+    """CIELAB centre and enclosing radius of every RGB cell, independent of any palette"""
+    cell_size = 1 << cell_bits
+    cells_per_axis = 256 // cell_size
+    offsets = np.stack(np.meshgrid(
+        np.arange(cell_size), np.arange(cell_size), np.arange(cell_size), indexing='ij'
+    ), axis=-1).reshape(-1, 3)
+    centre_offset = cell_size // 2
+
+    centres = np.empty((cells_per_axis ** 3, 3), dtype=np.float64)
+    radii = np.empty(cells_per_axis ** 3, dtype=np.float64)
+    red_cells = np.arange(cells_per_axis)
+    for red_cell in red_cells:
+        # One red slab of cells at a time keeps the scratch buffers small
+        grid = np.stack(np.meshgrid(
+            [red_cell], red_cells, red_cells, indexing='ij'
+        ), axis=-1).reshape(-1, 3) * cell_size
+        points = (grid[:, None, :] + offsets[None, :, :]).astype(np.uint8)
+        lab = srgb_to_lab(points).astype(np.float64)
+        centre = srgb_to_lab((grid + centre_offset).astype(np.uint8)).astype(np.float64)
+        radius = np.sqrt(((lab - centre[:, None, :]) ** 2).sum(axis=-1)).max(axis=1)
+        rows = slice(red_cell * cells_per_axis ** 2, (red_cell + 1) * cells_per_axis ** 2)
+        centres[rows] = centre
+        radii[rows] = radius
+    return centres, radii
+
+
+METRICS: Dict[str, ColorMetric] = {
+    metric.name: metric for metric in (ColorMetric(), RedmeanMetric(), LabMetric())
+}
+
+
+def get_metric(name: str = None) -> ColorMetric:
+    """Return the metric registered under name ('rgb', 'redmean' or 'lab')"""
+    if name is None:
+        name = DEFAULT_METRIC
+    try:
+        return METRICS[name]
+    except KeyError:
+        raise ValueError(f"Unknown color metric: {name} (expected one of {', '.join(METRICS)})") from None
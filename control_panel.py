@@ -1,10 +1,14 @@
 import tkinter as tk
 from tkinter import ttk, filedialog
+from color_metrics import DEFAULT_METRIC
 from image_utils import ImageProcessor
 from preview_state import PreviewState
 
+# The GUI keeps the scaled image in memory, so cap multiples where that stays small
+MAX_MULTIPLE = 20
+
 class ControlPanel(ttk.Frame):
-    def __init__(self, parent, on_image_selected, on_scale_changed, on_save_clicked, on_preview_mode_changed, **kwargs):
+    def __init__(self, parent, on_image_selected, on_scale_changed, on_save_clicked, on_preview_mode_changed, on_cancel_clicked=None, on_export_clicked=None, on_metric_changed=None, on_export_dat_clicked=None, on_profiling_toggled=None, on_export_trace_clicked=None, **kwargs):
         super().__init__(parent, **kwargs)
         
         # Initialize preview state
@@ -15,6 +19,12 @@ class ControlPanel(ttk.Frame):
         self.on_scale_changed = on_scale_changed
         self.on_save_clicked = on_save_clicked
         self.on_preview_mode_changed = on_preview_mode_changed
+        self.on_cancel_clicked = on_cancel_clicked
+        self.on_export_clicked = on_export_clicked
+        self.on_metric_changed = on_metric_changed
+        self.on_export_dat_clicked = on_export_dat_clicked
+        self.on_profiling_toggled = on_profiling_toggled
+        self.on_export_trace_clicked = on_export_trace_clicked
         
         # File selection
         self.file_path = tk.StringVar()
@@ -42,6 +52,26 @@ class ControlPanel(ttk.Frame):
             command=self._on_preview_mode_change
         ).pack(anchor=tk.W)
         
+        # Color distance used when converting to map colors
+        ttk.Label(preview_frame, text="颜色距离:").pack(anchor=tk.W, pady=(5, 0))
+        self.metric_labels = {
+            "RGB 欧氏距离": "rgb",
+            "加权 RGB (redmean)": "redmean",
+            "CIELAB ΔE（感知）": "lab",
+        }
+        self.metric = tk.StringVar(value=next(
+            label for label, metric in self.metric_labels.items() if metric == DEFAULT_METRIC
+        ))
+        metric_box = ttk.Combobox(
+            preview_frame,
+            textvariable=self.metric,
+            values=list(self.metric_labels),
+            state="readonly",
+            width=20
+        )
+        metric_box.pack(anchor=tk.W, pady=(0, 5))
+        metric_box.bind("<<ComboboxSelected>>", self._on_metric_change)
+        
         # Scale controls frame
         scale_frame = ttk.LabelFrame(self, text="缩放设置", padding=(10, 5))
         scale_frame.pack(fill=tk.X, pady=(0, 20))
@@ -51,7 +81,7 @@ class ControlPanel(ttk.Frame):
         self.width_multiple = ttk.Spinbox(
             scale_frame,
             from_=1,
-            to=20,
+            to=MAX_MULTIPLE,
             width=10,
             command=self._on_scale_change
         )
@@ -63,7 +93,7 @@ class ControlPanel(ttk.Frame):
         self.height_multiple = ttk.Spinbox(
             scale_frame,
             from_=1,
-            to=20,
+            to=MAX_MULTIPLE,
             width=10,
             command=self._on_scale_change
         )
@@ -91,13 +121,74 @@ class ControlPanel(ttk.Frame):
             command=self.on_save_clicked
         ).pack(side=tk.LEFT)
         
+        if self.on_export_clicked:
+            ttk.Button(
+                button_frame,
+                text="导出地图画",
+                command=self.on_export_clicked
+            ).pack(side=tk.LEFT, padx=(10, 0))
+        
+        if self.on_export_dat_clicked:
+            ttk.Button(
+                self,
+                text="导出地图文件 (map_*.dat)",
+                command=self.on_export_dat_clicked
+            ).pack(anchor=tk.W, pady=(0, 20))
+        
+        # Background progress (shown only while a map preview is rendering)
+        self.progress_frame = ttk.Frame(self)
+        self.progress_var = tk.DoubleVar()
+        ttk.Progressbar(
+            self.progress_frame,
+            variable=self.progress_var,
+            maximum=100,
+            length=200,
+            mode='determinate'
+        ).pack(side=tk.LEFT)
+        ttk.Button(
+            self.progress_frame,
+            text="取消",
+            command=self._on_cancel_click
+        ).pack(side=tk.LEFT, padx=(10, 0))
+        self.progress_text = tk.StringVar()
+        self.progress_label = ttk.Label(self, textvariable=self.progress_text)
+        
         # Status
         self.status_var = tk.StringVar()
-        ttk.Label(
+        self.status_label = ttk.Label(
             self,
             textvariable=self.status_var,
             wraplength=350
-        ).pack(anchor=tk.W, pady=(20, 0))
+        )
+        self.status_label.pack(anchor=tk.W, pady=(20, 0))
+        
+        # Latest duration of each pipeline stage
+        self.timing_var = tk.StringVar()
+        ttk.Label(
+            self,
+            textvariable=self.timing_var,
+            wraplength=350,
+            foreground='#666666'
+        ).pack(anchor=tk.W, pady=(5, 0))
+        
+        # Profiling capture and trace export
+        if self.on_profiling_toggled or self.on_export_trace_clicked:
+            profiling_frame = ttk.Frame(self)
+            profiling_frame.pack(anchor=tk.W, pady=(10, 0))
+            self.profiling = tk.BooleanVar(value=False)
+            if self.on_profiling_toggled:
+                ttk.Checkbutton(
+                    profiling_frame,
+                    text="性能分析 (cProfile/tracemalloc)",
+                    variable=self.profiling,
+                    command=lambda: self.on_profiling_toggled(self.profiling.get())
+                ).pack(side=tk.LEFT)
+            if self.on_export_trace_clicked:
+                ttk.Button(
+                    profiling_frame,
+                    text="导出性能跟踪",
+                    command=self.on_export_trace_clicked
+                ).pack(side=tk.LEFT, padx=(10, 0))
         
         # Initial price calculation
         self._update_price()
@@ -113,6 +204,25 @@ class ControlPanel(ttk.Frame):
             self._enable_size_controls()
         self.on_preview_mode_changed(mode)
     
+    def _on_metric_change(self, event=None):
+        """Handle color distance change"""
+        if self.on_metric_changed:
+            self.on_metric_changed(self.get_metric())
+    
+    def get_metric(self):
+        """Return the selected color_metrics name"""
+        return self.metric_labels[self.metric.get()]
+    
+    def set_preview_mode(self, mode):
+        """Switch the preview mode from code without notifying the app"""
+        self.preview_mode.set(mode)
+        if mode == "minecraft":
+            self.preview_state.start_preview()
+            self._disable_size_controls()
+        else:
+            self.preview_state.end_preview()
+            self._enable_size_controls()
+    
     def _disable_size_controls(self):
         """Disable size controls during preview"""
         self.width_multiple.configure(state="disabled")
@@ -158,6 +268,28 @@ class ControlPanel(ttk.Frame):
         except ValueError:
             self.price_var.set("Invalid input")
     
+    def _on_cancel_click(self):
+        """Handle progress cancel button click"""
+        if self.on_cancel_clicked:
+            self.on_cancel_clicked()
+    
+    def show_progress(self, value, text):
+        """Show background progress above the status message"""
+        if not self.progress_frame.winfo_ismapped():
+            self.progress_frame.pack(anchor=tk.W, before=self.status_label)
+            self.progress_label.pack(anchor=tk.W, pady=(5, 0), before=self.status_label)
+        self.progress_var.set(value)
+        self.progress_text.set(text)
+    
+    def hide_progress(self):
+        """Hide the background progress row"""
+        self.progress_frame.pack_forget()
+        self.progress_label.pack_forget()
+    
     def set_status(self, message):
         """Update status message"""
-        self.status_var.set(message)
\ No newline at end of file
+        self.status_var.set(message)
+    
+    def set_timings(self, text):
+        """Show the latest per-stage timings below the status message"""
+        self.timing_var.set(text)
\ No newline at end of file
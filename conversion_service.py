@@ -0,0 +1,700 @@
+"""Local conversion service: convert uploaded images to map art over HTTP
+
+Jobs are queued and run on a process pool with a bounded queue; a full queue
+answers 503 with Retry-After instead of accepting more work. Every job has a
+deadline, progress is streamed as newline-delimited JSON, and /health and
+/metrics report the state of the service. It listens on localhost or on a
+Unix socket and needs nothing beyond the standard library.
+
+Example:
+    python conversion_service.py --unix /tmp/mapart.sock -j 4
+    curl --unix-socket /tmp/mapart.sock --data-binary @art.png "http://localhost/jobs?width=4&height=3"
+    curl --unix-socket /tmp/mapart.sock http://localhost/jobs/1/events
+    curl --unix-socket /tmp/mapart.sock -o map.png http://localhost/jobs/1/result
+"""
+import argparse
+import asyncio
+import io
+import json
+import multiprocessing
+import os
+import signal
+import sys
+import tempfile
+import threading
+import time
+import zipfile
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from http import HTTPStatus
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import parse_qs, urlsplit
+
+from cancellation import CancellationToken, CancelledError
+from color_metrics import DEFAULT_METRIC, METRICS
+from dithering import DITHER_MODES
+from image_utils import ImageProcessor
+from instrumentation import Instrumentation
+from map_exporter import MapDataExporter
+from minecraft_map_processor import MinecraftMapProcessor
+from palette_quantizer import get_quantizer
+
+# Result formats: map art PNG, scaled PNG, or a zip of map_N.dat files
+KINDS = {
+    'map': 'image/png',
+    'scaled': 'image/png',
+    'dat': 'application/zip',
+}
+# Job states after which nothing changes any more
+FINAL_STATES = ('done', 'failed', 'cancelled', 'timeout')
+# Finished jobs kept for their results; the oldest are forgotten first
+MAX_FINISHED_JOBS = 64
+# Time a client gets to send its request line, headers and body
+REQUEST_TIMEOUT_S = 30
+# Progress streams repeat the current state this often when nothing changes
+EVENT_HEARTBEAT_S = 15
+# Recent queue and run times kept for /metrics
+LATENCY_SAMPLES = 512
+# Results are written in slices of this size, waiting for the client in between
+WRITE_CHUNK = 64 * 1024
+
+# Set in every pool worker by _init_worker
+_progress_queue = None
+_cancel_flags = None
+
+
+class HttpError(Exception):
+    """Ends a request with an error status and a JSON {"error": message} body"""
+
+    def __init__(self, status: HTTPStatus, message: str, headers: Optional[Dict[str, str]] = None):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+        self.headers = headers or {}
+
+
+def _init_worker(progress_queue, cancel_flags):
+    global _progress_queue, _cancel_flags
+    _progress_queue = progress_queue
+    _cancel_flags = cancel_flags
+
+
+class WorkerToken(CancellationToken):
+    """Cancellation token of a job running in a pool worker
+
+    The service cancels a job by setting the job's slot in a shared flag
+    array; a job also stops by itself once its deadline (time.time()) passes.
+    """
+
+    def __init__(self, slot: int, deadline: float):
+        super().__init__()
+        self.slot = slot
+        self.deadline = deadline
+
+    @property
+    def cancelled(self):
+        return bool(_cancel_flags[self.slot]) or time.time() > self.deadline
+
+    def raise_if_cancelled(self):
+        if self.cancelled:
+            raise CancelledError()
+
+
+def _reporter(job_id: int, stage: str, start: float, end: float):
+    """Progress callback mapping a stage's 0-100% onto start-end of the job
+
+    Only whole percent changes are sent, so the queue carries at most a
+    hundred messages per stage.
+    """
+    last = [-1]
+
+    def report(percent: float):
+        value = int(start + (end - start) * percent / 100)
+        if value != last[0]:
+            last[0] = value
+            _progress_queue.put((job_id, stage, value))
+    return report
+
+
+def convert_job(job_id: int, slot: int, deadline: float, data: bytes, params: Dict) -> Dict:
+    """Decode, scale and convert one upload; runs inside a pool worker"""
+    token = WorkerToken(slot, deadline)
+    width_multiple, height_multiple = params['width'], params['height']
+    target_size = (128 * width_multiple, 128 * height_multiple)
+    kind = params['kind']
+    started = time.perf_counter()
+
+    _reporter(job_id, 'decode', 0, 5)(0)
+    with ImageProcessor.open_image(io.BytesIO(data), target_size) as image:
+        image.load()
+        token.raise_if_cancelled()
+        scaled = ImageProcessor.scale_image(image, width_multiple, height_multiple, cancel_token=token)
+    scaled_at = time.perf_counter()
+    _reporter(job_id, 'scale', 5, 30)(100)
+
+    info = {
+        'size': target_size,
+        'price': ImageProcessor.calculate_price(width_multiple, height_multiple),
+        'scale_time': scaled_at - started,
+    }
+    if kind == 'scaled':
+        result = scaled
+    else:
+        result, index_map = MinecraftMapProcessor.quantize_image(
+            scaled,
+            _reporter(job_id, 'quantize', 30, 90),
+            cancel_token=token,
+            dither=params['dither'],
+            metric=params['metric']
+        )
+        info['quantize_time'] = time.perf_counter() - scaled_at
+    token.raise_if_cancelled()
+
+    _reporter(job_id, 'encode', 90, 100)(0)
+    buffer = io.BytesIO()
+    if kind == 'dat':
+        with tempfile.TemporaryDirectory() as output_dir:
+            exported = MapDataExporter.export(
+                index_map, output_dir, params['map_id'], workers=1, cancel_token=token, incremental=False
+            )
+            # map_N.dat files are gzip-compressed already
+            with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_STORED) as archive:
+                for path in exported.paths:
+                    archive.write(path, os.path.basename(path))
+        info['maps'] = len(exported.paths)
+    else:
+        result.save(buffer, 'PNG')
+    info['total_time'] = time.perf_counter() - started
+    return {'data': buffer.getvalue(), 'info': info}
+
+
+class Job:
+    """One upload and its conversion, as tracked by the service"""
+
+    def __init__(self, job_id: int, slot: int, data: bytes, params: Dict):
+        self.id = job_id
+        self.slot = slot
+        self.data = data
+        self.params = params
+        self.status = 'queued'
+        self.stage = 'queued'
+        self.progress = 0
+        self.error = None
+        self.info = None
+        self.result = None
+        self.cancel_requested = False
+        self.created = time.monotonic()
+        self.started = None
+        self.finished = None
+        self.changed = asyncio.Event()
+
+    @property
+    def done(self) -> bool:
+        return self.status in FINAL_STATES
+
+    def update(self, **fields):
+        """Change fields and wake everyone waiting for a change"""
+        for name, value in fields.items():
+            setattr(self, name, value)
+        if self.done and self.finished is None:
+            self.finished = time.monotonic()
+            self.data = None
+        self.changed.set()
+        self.changed = asyncio.Event()
+
+    def describe(self) -> Dict:
+        state = {
+            'id': self.id,
+            'status': self.status,
+            'stage': self.stage,
+            'progress': self.progress,
+            'params': self.params,
+        }
+        if self.started is not None:
+            state['queue_time'] = self.started - self.created
+        if self.finished is not None and self.started is not None:
+            state['run_time'] = self.finished - self.started
+        if self.error:
+            state['error'] = self.error
+        if self.info:
+            state['info'] = self.info
+        return state
+
+
+class ConversionService:
+    """Job queue, process pool and HTTP front end of the conversion service
+
+    workers pool processes run jobs; up to queue_size more wait in a bounded
+    queue. Each accepted job holds one slot of the shared cancellation
+    array until its worker has returned, so slots never exceed
+    workers + queue_size.
+    """
+
+    def __init__(self, workers: int = 1, queue_size: int = 16, timeout: float = 120.0,
+                 max_upload: int = 32 * 1024 * 1024, max_multiple: int = 16):
+        self.workers = workers
+        self.queue_size = queue_size
+        self.timeout = timeout
+        self.max_upload = max_upload
+        self.max_multiple = max_multiple
+        self.instruments = Instrumentation()
+        self.latencies = {name: deque(maxlen=LATENCY_SAMPLES) for name in ('job_wait', 'job_run')}
+        self.jobs: 'OrderedDict[int, Job]' = OrderedDict()
+        self.stopping = False
+        self._next_id = 1
+        self._running = 0
+        self._free_slots = list(range(workers + queue_size))
+        # Spawned workers do not inherit the service's threads and event loop
+        self._context = multiprocessing.get_context('spawn')
+        self._progress_queue = self._context.Queue()
+        self._cancel_flags = self._context.Array('b', workers + queue_size, lock=False)
+        self._executor = None
+        self._queue = None
+        self._loop = None
+        self._server = None
+        self._unix_path = None
+        self._tasks: List[asyncio.Task] = []
+        self._progress_thread = None
+        self._started = time.monotonic()
+
+    def _start_pool(self):
+        self._executor = ProcessPoolExecutor(
+            max_workers=self.workers,
+            mp_context=self._context,
+            initializer=_init_worker,
+            initargs=(self._progress_queue, self._cancel_flags)
+        )
+
+    async def start(self, host: str = '127.0.0.1', port: int = 8765, unix_path: Optional[str] = None):
+        """Start the pool, the dispatchers and the listening socket"""
+        self._loop = asyncio.get_running_loop()
+        # Build the default lookup table once so workers only memory-map it
+        get_quantizer(metric=DEFAULT_METRIC).prepare()
+        self._start_pool()
+        # Unbounded: the slots are the bound. A bounded queue can still be full
+        # right after a dispatcher was woken but before it took its job
+        self._queue = asyncio.Queue()
+        self._tasks = [asyncio.ensure_future(self._dispatch()) for _ in range(self.workers)]
+        self._progress_thread = threading.Thread(target=self._forward_progress, daemon=True)
+        self._progress_thread.start()
+        if unix_path:
+            if os.path.exists(unix_path):
+                os.unlink(unix_path)
+            self._server = await asyncio.start_unix_server(self._handle, path=unix_path)
+            self._unix_path = unix_path
+        else:
+            self._server = await asyncio.start_server(self._handle, host, port)
+
+    @property
+    def addresses(self) -> List:
+        return [sock.getsockname() for sock in self._server.sockets] if self._server else []
+
+    async def close(self):
+        """Stop accepting, cancel all unfinished jobs and shut the pool down"""
+        self.stopping = True
+        if self._server:
+            self._server.close()
+            await self._server.wait_closed()
+        for job in self.jobs.values():
+            if not job.done:
+                self._cancel(job)
+        if self._executor:
+            # Running jobs see their cancellation flag at the next chunk; the
+            # dispatchers are still awaiting them, so every result is consumed
+            await self._loop.run_in_executor(None, self._executor.shutdown)
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._progress_queue.put(None)
+        if self._progress_thread:
+            self._progress_thread.join()
+        if self._unix_path and os.path.exists(self._unix_path):
+            os.unlink(self._unix_path)
+
+    # Jobs
+
+    def _forward_progress(self):
+        """Thread moving progress messages from the workers to the event loop"""
+        while True:
+            message = self._progress_queue.get()
+            if message is None:
+                return
+            self._loop.call_soon_threadsafe(self._on_progress, *message)
+
+    def _on_progress(self, job_id: int, stage: str, progress: int):
+        job = self.jobs.get(job_id)
+        if job is not None and job.status == 'running':
+            job.update(stage=stage, progress=progress)
+
+    def _retry_after(self) -> int:
+        """Seconds until a queue slot is likely to be free, from recent run times"""
+        runs = self.latencies['job_run']
+        average = sum(runs) / len(runs) if runs else 1.0
+        return max(1, int(average * (self._queue.qsize() + 1) / self.workers + 0.5))
+
+    def submit(self, data: bytes, params: Dict) -> Job:
+        """Queue a job, or raise HttpError 503 when the queue is full"""
+        if self.stopping:
+            raise HttpError(HTTPStatus.SERVICE_UNAVAILABLE, "service is stopping")
+        if not self._free_slots:
+            self.instruments.count('jobs_rejected')
+            raise HttpError(
+                HTTPStatus.SERVICE_UNAVAILABLE, "queue is full",
+                {'Retry-After': str(self._retry_after())}
+            )
+        slot = self._free_slots.pop()
+        self._cancel_flags[slot] = 0
+        job = Job(self._next_id, slot, data, params)
+        self._next_id += 1
+        self.jobs[job.id] = job
+        self._queue.put_nowait(job)
+        self.instruments.count('jobs_submitted')
+        self.instruments.count('bytes_received', len(data))
+        self._prune()
+        return job
+
+    def _prune(self):
+        """Forget the oldest finished jobs beyond MAX_FINISHED_JOBS"""
+        finished = [job_id for job_id, job in self.jobs.items() if job.done]
+        for job_id in finished[:max(0, len(finished) - MAX_FINISHED_JOBS)]:
+            del self.jobs[job_id]
+
+    def _cancel(self, job: Job):
+        job.cancel_requested = True
+        self._cancel_flags[job.slot] = 1
+        if job.status == 'queued':
+            job.update(status='cancelled', stage='cancelled')
+            self.instruments.count('jobs_cancelled')
+
+    def _restart_pool(self, broken: ProcessPoolExecutor):
+        """Replace a broken pool, once however many dispatchers noticed it"""
+        if self._executor is not broken or self.stopping:
+            return
+        broken.shutdown(wait=False)
+        self._start_pool()
+
+    async def _dispatch(self):
+        """Take queued jobs one at a time; one dispatcher runs per pool worker"""
+        while True:
+            job = await self._queue.get()
+            try:
+                if not job.done:
+                    await self._run(job)
+            except Exception as e:
+                # One bad job must not end the dispatcher
+                if not job.done:
+                    job.update(status='failed', error=str(e) or type(e).__name__)
+                    self.instruments.count('jobs_failed')
+            finally:
+                self._free_slots.append(job.slot)
+                self._queue.task_done()
+                self._prune()
+
+    async def _run(self, job: Job):
+        job.update(status='running', stage='decode', started=time.monotonic())
+        self._record('job_wait', job.started - job.created)
+        deadline = time.time() + self.timeout
+        executor = self._executor
+        self._running += 1
+        try:
+            # Submitting raises BrokenProcessPool right away when a worker has died
+            future = self._loop.run_in_executor(
+                executor, convert_job, job.id, job.slot, deadline, job.data, job.params
+            )
+            job.data = None
+            done, _ = await asyncio.wait({future}, timeout=self.timeout)
+            if not done:
+                # Past the deadline the worker stops at its next chunk; the slot
+                # is only reused once it has
+                self._cancel_flags[job.slot] = 1
+                job.update(status='timeout', error=f"job exceeded {self.timeout:g} s")
+                self.instruments.count('jobs_timed_out')
+                await asyncio.wait({future})
+            result = future.result()
+        except CancelledError:
+            if not job.done:
+                status = 'cancelled' if job.cancel_requested else 'timeout'
+                job.update(status=status, stage=status)
+                self.instruments.count('jobs_cancelled' if job.cancel_requested else 'jobs_timed_out')
+        except BrokenProcessPool:
+            # A worker died (for example out of memory); start a fresh pool
+            if not job.done:
+                job.update(status='failed', error="worker process died")
+                self.instruments.count('jobs_failed')
+            self._restart_pool(executor)
+        except Exception as e:
+            if not job.done:
+                job.update(status='failed', error=str(e) or type(e).__name__)
+                self.instruments.count('jobs_failed')
+        else:
+            if not job.done:
+                job.update(
+                    status='done', stage='done', progress=100,
+                    result=result['data'], info=result['info']
+                )
+                self.instruments.count('jobs_completed')
+        finally:
+            self._running -= 1
+            if job.finished is not None:
+                self._record('job_run', job.finished - job.started)
+
+    def _record(self, name: str, seconds: float):
+        self.latencies[name].append(seconds)
+
+    def health(self) -> Dict:
+        if self.stopping:
+            status = 'stopping'
+        elif not self._free_slots:
+            status = 'saturated'
+        else:
+            status = 'ok'
+        return {
+            'status': status,
+            'workers': self.workers,
+            'running': self._running,
+            'queued': self._queue.qsize(),
+            'queue_size': self.queue_size,
+        }
+
+    def metrics(self) -> Dict:
+        """Counters, queue state and recent latency percentiles in milliseconds"""
+        latencies = {}
+        for name, samples in self.latencies.items():
+            ordered = sorted(samples)
+            if ordered:
+                latencies[name] = {
+                    f"p{q}": ordered[min(len(ordered) - 1, len(ordered) * q // 100)] * 1000
+                    for q in (50, 90, 99)
+                }
+                latencies[name]['count'] = len(ordered)
+        states = {}
+        for job in self.jobs.values():
+            states[job.status] = states.get(job.status, 0) + 1
+        metrics = self.health()
+        metrics.update({
+            'uptime_s': time.monotonic() - self._started,
+            'timeout_s': self.timeout,
+            'counters': dict(self.instruments.counters),
+            'jobs': states,
+            'latency_ms': latencies,
+        })
+        return metrics
+
+    # HTTP
+
+    def _parse_params(self, query: Dict[str, List[str]]) -> Dict:
+        """Job parameters from the query string, or HttpError 400"""
+        def value(name, default):
+            values = query.get(name)
+            return values[-1] if values else default
+
+        try:
+            params = {
+                'width': int(value('width', 2)),
+                'height': int(value('height', 2)),
+                'kind': value('kind', 'map'),
+                'metric': value('metric', DEFAULT_METRIC),
+                'dither': value('dither', 'none'),
+                'map_id': int(value('map_id', 0)),
+            }
+        except ValueError as e:
+            raise HttpError(HTTPStatus.BAD_REQUEST, str(e))
+        for name in ('width', 'height'):
+            if not 1 <= params[name] <= self.max_multiple:
+                raise HttpError(HTTPStatus.BAD_REQUEST, f"{name} must be between 1 and {self.max_multiple}")
+        if params['kind'] not in KINDS:
+            raise HttpError(HTTPStatus.BAD_REQUEST, f"kind must be one of {', '.join(KINDS)}")
+        if params['metric'] not in METRICS:
+            raise HttpError(HTTPStatus.BAD_REQUEST, f"metric must be one of {', '.join(METRICS)}")
+        if params['dither'] not in DITHER_MODES:
+            raise HttpError(HTTPStatus.BAD_REQUEST, f"dither must be one of {', '.join(DITHER_MODES)}")
+        if params['map_id'] < 0:
+            raise HttpError(HTTPStatus.BAD_REQUEST, "map_id must not be negative")
+        return params
+
+    async def _read_request(self, reader: asyncio.StreamReader) -> Tuple[str, str, Dict, Dict, bytes]:
+        """Method, path, query, lower-case headers and body of one request"""
+        try:
+            head = await reader.readuntil(b'\r\n\r\n')
+        except asyncio.LimitOverrunError:
+            raise HttpError(HTTPStatus.REQUEST_HEADER_FIELDS_TOO_LARGE, "headers too large")
+        lines = head.decode('latin-1').split('\r\n')
+        try:
+            method, target, _ = lines[0].split(' ', 2)
+        except ValueError:
+            raise HttpError(HTTPStatus.BAD_REQUEST, "malformed request line")
+        headers = {}
+        for line in lines[1:]:
+            if ':' in line:
+                name, _, field = line.partition(':')
+                headers[name.strip().lower()] = field.strip()
+
+        if 'chunked' in headers.get('transfer-encoding', ''):
+            raise HttpError(HTTPStatus.LENGTH_REQUIRED, "chunked uploads are not supported")
+        try:
+            length = int(headers.get('content-length', 0))
+        except ValueError:
+            raise HttpError(HTTPStatus.BAD_REQUEST, "invalid Content-Length")
+        if length > self.max_upload:
+            self.instruments.count('uploads_too_large')
+            raise HttpError(HTTPStatus.REQUEST_ENTITY_TOO_LARGE, f"uploads are limited to {self.max_upload} bytes")
+        body = await reader.readexactly(length) if length > 0 else b''
+        url = urlsplit(target)
+        return method.upper(), url.path, parse_qs(url.query), headers, body
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        """Serve one request per connection"""
+        try:
+            try:
+                request = await asyncio.wait_for(self._read_request(reader), REQUEST_TIMEOUT_S)
+                await self._route(writer, *request)
+            except HttpError as e:
+                await self._send_json(writer, e.status, {'error': e.message}, e.headers)
+            except asyncio.TimeoutError:
+                await self._send_json(writer, HTTPStatus.REQUEST_TIMEOUT, {'error': "request timed out"})
+            except (ConnectionError, asyncio.IncompleteReadError):
+                raise
+            except Exception as e:
+                self.instruments.count('internal_errors')
+                await self._send_json(writer, HTTPStatus.INTERNAL_SERVER_ERROR, {'error': str(e)})
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def _route(self, writer, method: str, path: str, query: Dict, headers: Dict, body: bytes):
+        parts = [part for part in path.split('/') if part]
+        if parts == ['health'] and method == 'GET':
+            health = self.health()
+            status = HTTPStatus.SERVICE_UNAVAILABLE if self.stopping else HTTPStatus.OK
+            await self._send_json(writer, status, health)
+        elif parts == ['metrics'] and method == 'GET':
+            await self._send_json(writer, HTTPStatus.OK, self.metrics())
+        elif parts == ['jobs'] and method == 'POST':
+            if not body:
+                raise HttpError(HTTPStatus.BAD_REQUEST, "the request body must be an image")
+            job = self.submit(body, self._parse_params(query))
+            await self._send_json(
+                writer, HTTPStatus.ACCEPTED, job.describe(), {'Location': f"/jobs/{job.id}"}
+            )
+        elif len(parts) >= 2 and parts[0] == 'jobs':
+            try:
+                job = self.jobs[int(parts[1])]
+            except (ValueError, KeyError):
+                raise HttpError(HTTPStatus.NOT_FOUND, "no such job")
+            action = parts[2:]
+            if action == [] and method == 'GET':
+                await self._send_json(writer, HTTPStatus.OK, job.describe())
+            elif action == [] and method == 'DELETE':
+                if not job.done:
+                    self._cancel(job)
+                await self._send_json(writer, HTTPStatus.OK, job.describe())
+            elif action == ['events'] and method == 'GET':
+                await self._stream_events(writer, job)
+            elif action == ['result'] and method == 'GET':
+                if job.status != 'done':
+                    raise HttpError(HTTPStatus.CONFLICT, f"job is {job.status}")
+                await self._send(writer, HTTPStatus.OK, job.result, KINDS[job.params['kind']])
+            else:
+                raise HttpError(HTTPStatus.NOT_FOUND, "not found")
+        else:
+            raise HttpError(HTTPStatus.NOT_FOUND, "not found")
+
+    async def _send(self, writer, status: HTTPStatus, body: bytes, content_type: str,
+                    headers: Optional[Dict[str, str]] = None):
+        """Write a complete response in slices, waiting for slow clients"""
+        head = [
+            f"HTTP/1.1 {status.value} {status.phrase}",
+            f"Content-Type: {content_type}",
+            f"Content-Length: {len(body)}",
+            "Connection: close",
+        ]
+        head.extend(f"{name}: {field}" for name, field in (headers or {}).items())
+        writer.write(('\r\n'.join(head) + '\r\n\r\n').encode('latin-1'))
+        view = memoryview(body)
+        for start in range(0, len(body), WRITE_CHUNK):
+            writer.write(view[start:start + WRITE_CHUNK])
+            await writer.drain()
+        await writer.drain()
+        self.instruments.count('bytes_sent', len(body))
+
+    async def _send_json(self, writer, status: HTTPStatus, payload: Dict, headers: Optional[Dict[str, str]] = None):
+        await self._send(writer, status, json.dumps(payload).encode('utf-8'), 'application/json', headers)
+
+    async def _stream_events(self, writer, job: Job):
+        """Stream the job state as chunked newline-delimited JSON until it is final"""
+        writer.write(
+            f"HTTP/1.1 200 OK\r\nContent-Type: application/x-ndjson\r\n"
+            f"Transfer-Encoding: chunked\r\nConnection: close\r\n\r\n".encode('latin-1')
+        )
+        while True:
+            # Take the event before writing so no change is missed while waiting on the client
+            changed = job.changed
+            line = json.dumps(job.describe()).encode('utf-8') + b'\n'
+            writer.write(b'%x\r\n%s\r\n' % (len(line), line))
+            await writer.drain()
+            if job.done or self.stopping:
+                break
+            try:
+                await asyncio.wait_for(changed.wait(), EVENT_HEARTBEAT_S)
+            except asyncio.TimeoutError:
+                pass
+        writer.write(b'0\r\n\r\n')
+        await writer.drain()
+
+
+def parse_args(argv: List[str]) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="本地地图画转换服务（HTTP / Unix 套接字）")
+    parser.add_argument('--host', default='127.0.0.1', help="监听地址（默认: 127.0.0.1，仅本机）")
+    parser.add_argument('--port', type=int, default=8765, help="监听端口（默认: 8765）")
+    parser.add_argument('--unix', metavar='PATH', help="改为监听 Unix 套接字文件")
+    parser.add_argument('-j', '--workers', type=int, default=os.cpu_count() or 1,
+                        help="同时转换的进程数（默认: CPU 核数）")
+    parser.add_argument('--queue', type=int, default=16, help="最多排队的任务数，超出时返回 503（默认: 16）")
+    parser.add_argument('--timeout', type=float, default=120.0, help="每个任务的超时秒数（默认: 120）")
+    parser.add_argument('--max-upload-mb', type=float, default=32.0, help="上传图片大小上限，单位 MB（默认: 32）")
+    parser.add_argument('--max-multiple', type=int, default=16, help="允许的最大宽高倍数（默认: 16）")
+    args = parser.parse_args(argv)
+
+    if args.workers <= 0:
+        parser.error("进程数必须是正整数")
+    if args.queue < 0:
+        parser.error("队列长度不能为负数")
+    if args.timeout <= 0 or args.max_upload_mb <= 0 or args.max_multiple <= 0:
+        parser.error("超时、上传上限和最大倍数必须为正数")
+    return args
+
+
+async def serve(args: argparse.Namespace):
+    service = ConversionService(
+        args.workers, args.queue, args.timeout, int(args.max_upload_mb * 1024 * 1024), args.max_multiple
+    )
+    await service.start(args.host, args.port, args.unix)
+    print(f"转换服务已启动: {args.unix or '%s:%d' % (args.host, args.port)}（{args.workers} 个进程）", flush=True)
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(signum, stop.set)
+        except (NotImplementedError, RuntimeError):
+            # Windows: Ctrl+C still ends the process through KeyboardInterrupt
+            pass
+    try:
+        await stop.wait()
+    finally:
+        await service.close()
+
+
+def main(argv: List[str] = None) -> int:
+    args = parse_args(sys.argv[1:] if argv is None else argv)
+    try:
+        asyncio.run(serve(args))
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,196 @@
+import numpy as np
+from typing import Callable, Optional, Tuple
+
+from cancellation import CancellationToken
+from instrumentation import count
+from tile_index import TileIndex
+
+# Side length of one in-game map; error diffusion never crosses map borders
+TILE_SIZE = 128
+
+# Error diffusion kernels as (dx, dy, weight) relative to the current pixel
+DIFFUSION_KERNELS = {
+    'floyd-steinberg': [(1, 0, 7 / 16), (-1, 1, 3 / 16), (0, 1, 5 / 16), (1, 1, 1 / 16)],
+    'atkinson': [(1, 0, 1 / 8), (2, 0, 1 / 8), (-1, 1, 1 / 8), (0, 1, 1 / 8), (1, 1, 1 / 8), (0, 2, 1 / 8)],
+    'jarvis-judice-ninke': [
+        (1, 0, 7 / 48), (2, 0, 5 / 48),
+        (-2, 1, 3 / 48), (-1, 1, 5 / 48), (0, 1, 7 / 48), (1, 1, 5 / 48), (2, 1, 3 / 48),
+        (-2, 2, 1 / 48), (-1, 2, 3 / 48), (0, 2, 5 / 48), (1, 2, 3 / 48), (2, 2, 1 / 48),
+    ],
+    'stucki': [
+        (1, 0, 8 / 42), (2, 0, 4 / 42),
+        (-2, 1, 2 / 42), (-1, 1, 4 / 42), (0, 1, 8 / 42), (1, 1, 4 / 42), (2, 1, 2 / 42),
+        (-2, 2, 1 / 42), (-1, 2, 2 / 42), (0, 2, 4 / 42), (1, 2, 2 / 42), (2, 2, 1 / 42),
+    ],
+    'sierra-lite': [(1, 0, 2 / 4), (-1, 1, 1 / 4), (0, 1, 1 / 4)],
+}
+
+DITHER_MODES = ('none', 'bayer') + tuple(DIFFUSION_KERNELS)
+
+
+def _bayer_matrix(order: int) -> np.ndarray:
+    matrix = np.zeros((1, 1), dtype=np.float32)
+    for _ in range(order):
+        matrix = np.block([
+            [4 * matrix, 4 * matrix + 2],
+            [4 * matrix + 3, 4 * matrix + 1]
+        ])
+    return matrix
+
+
+# 8x8 Bayer thresholds centred on zero, in the range [-0.5, 0.5)
+BAYER_8X8 = (_bayer_matrix(3) + 0.5) / 64 - 0.5
+
+
+class Ditherer:
+    """Ordered and error-diffusion dithering against a PaletteQuantizer"""
+
+    # Amplitude of the ordered dither offsets in RGB levels
+    BAYER_SPREAD = 32.0
+
+    @staticmethod
+    def is_diffusion(mode: Optional[str]) -> bool:
+        return mode in DIFFUSION_KERNELS
+
+    @staticmethod
+    def validate(mode: Optional[str]):
+        if mode is not None and mode not in DITHER_MODES:
+            raise ValueError(f"Unknown dither mode: {mode} (expected one of {', '.join(DITHER_MODES)})")
+
+    @staticmethod
+    def ordered(pixels: np.ndarray, origin: Tuple[int, int] = (0, 0), spread: float = BAYER_SPREAD) -> np.ndarray:
+        """Offset pixels by the tiled Bayer pattern; quantize the result as usual
+
+        origin is the (x, y) position of pixels[0, 0] in the full image, so
+        separately processed tiles line up with the same pattern.
+        """
+        height, width = pixels.shape[:2]
+        size = len(BAYER_8X8)
+        rows = (np.arange(height) + origin[1]) % size
+        columns = (np.arange(width) + origin[0]) % size
+        offsets = BAYER_8X8[rows[:, None], columns[None, :]] * spread
+        dithered = pixels.astype(np.float32) + offsets[..., None]
+        return np.clip(np.rint(dithered), 0, 255).astype(np.uint8)
+
+    @staticmethod
+    def diffuse_tiles(
+        tiles: np.ndarray,
+        valid: np.ndarray,
+        quantizer,
+        mode: str,
+        progress_callback: Callable[[float], None] = None,
+        cancel_token: Optional[CancellationToken] = None
+    ) -> np.ndarray:
+        """Error-diffuse a stack of (count, size, size, 3) tiles at once
+
+        Pixels are visited in wavefronts x + skew * y = step, where skew is
+        chosen so every kernel target lies on a later wavefront. All pixels of
+        a wavefront, in every tile of the stack, are then independent and are
+        handled as one NumPy operation, so the Python loop runs only about
+        width + skew * height times instead of once per pixel.
+        valid masks padding so it never spreads error into real pixels.
+        Returns the (count, size, size) palette positions.
+        """
+        kernel = DIFFUSION_KERNELS[mode]
+        count, height, width = tiles.shape[:3]
+        margin = 2
+        skew = max(-(-(1 - dx) // dy) for dx, dy, _ in kernel if dy > 0)
+
+        # Working buffer with room for the kernel to spill past the edges
+        work = np.zeros((count, height + margin, width + 2 * margin, 3), dtype=np.float32)
+        work[:, :height, margin:margin + width] = tiles
+        palette = quantizer.palette.astype(np.float32)
+        positions = np.empty((count, height, width), dtype=np.intp)
+
+        rows = np.arange(height)
+        steps = width + skew * (height - 1)
+        for step in range(steps):
+            if cancel_token and step % 16 == 0:
+                cancel_token.raise_if_cancelled()
+            columns = step - skew * rows
+            inside = (columns >= 0) & (columns < width)
+            ys = rows[inside]
+            xs = columns[inside]
+
+            current = np.clip(work[:, ys, xs + margin], 0, 255)
+            nearest = quantizer.nearest_positions(np.rint(current).astype(np.uint8))
+            positions[:, ys, xs] = nearest
+            error = (current - palette[nearest]) * valid[:, ys, xs, None]
+            for dx, dy, weight in kernel:
+                work[:, ys + dy, xs + margin + dx] += error * weight
+
+            if progress_callback:
+                progress_callback(((step + 1) / steps) * 100)
+
+        return positions
+
+    @staticmethod
+    def split_tiles(pixels: np.ndarray, tile_size: int = TILE_SIZE) -> Tuple[np.ndarray, np.ndarray]:
+        """Cut an image into a padded (count, size, size, 3) stack plus a validity mask"""
+        height, width = pixels.shape[:2]
+        rows = -(-height // tile_size)
+        columns = -(-width // tile_size)
+        padded = np.zeros((rows * tile_size, columns * tile_size, 3), dtype=pixels.dtype)
+        padded[:height, :width] = pixels
+        valid = np.zeros(padded.shape[:2], dtype=np.float32)
+        valid[:height, :width] = 1
+
+        def stack(array):
+            shape = (rows, tile_size, columns, tile_size) + array.shape[2:]
+            order = (0, 2, 1, 3) + tuple(range(4, array.ndim + 2))
+            return array.reshape(shape).transpose(order).reshape((rows * columns, tile_size, tile_size) + array.shape[2:])
+
+        return stack(padded), stack(valid)
+
+    @staticmethod
+    def join_tiles(stacked: np.ndarray, height: int, width: int, tile_size: int = TILE_SIZE) -> np.ndarray:
+        """Inverse of split_tiles for a (count, size, size, ...) stack"""
+        rows = -(-height // tile_size)
+        columns = -(-width // tile_size)
+        extra = stacked.shape[3:]
+        joined = stacked.reshape((rows, columns, tile_size, tile_size) + extra)
+        order = (0, 2, 1, 3) + tuple(range(4, joined.ndim))
+        joined = joined.transpose(order).reshape((rows * tile_size, columns * tile_size) + extra)
+        return joined[:height, :width]
+
+    @staticmethod
+    def quantize(
+        pixels: np.ndarray,
+        quantizer,
+        mode: str,
+        origin: Tuple[int, int] = (0, 0),
+        progress_callback: Callable[[float], None] = None,
+        cancel_token: Optional[CancellationToken] = None
+    ) -> np.ndarray:
+        """Dither and quantize an (height, width, 3) array, returning its index map of color ids
+
+        Error diffusion runs independently inside every 128x128 map tile,
+        which matches how the maps are placed in game and lets tiles be
+        processed in parallel; repeated tiles are diffused only once.
+        """
+        Ditherer.validate(mode)
+        if mode in (None, 'none'):
+            return quantizer.quantize_ids(pixels)
+        if mode == 'bayer':
+            return quantizer.quantize_ids(Ditherer.ordered(pixels, origin))
+
+        height, width = pixels.shape[:2]
+        tiles, valid = Ditherer.split_tiles(pixels)
+        # Diffusion never leaves a tile, so identical tiles dither identically
+        unique, inverse = TileIndex.unique_stack(tiles, valid)
+        count('tiles_deduplicated', len(tiles) - len(unique))
+        positions = Ditherer.diffuse_tiles(
+            tiles[unique], valid[unique], quantizer, mode, progress_callback, cancel_token
+        )
+        positions = Ditherer.join_tiles(positions[inverse], height, width)
+        return quantizer.color_ids[positions]
+
+
+if __name__ == "__main__":
+    import sys
+    from benchmark import main
+
+    # Every dithering mode on a 4x4-map image; see benchmark.py for all options
+    sys.exit(main(['--sizes', '4x4', '--backends', 'map-preview,' + ','.join(
+        f'dither-{mode}' for mode in ('bayer',) + tuple(DIFFUSION_KERNELS)
+    )] + sys.argv[1:]))
@@ -1,14 +1,89 @@
+import tempfile
+import numpy as np
 from PIL import Image
 
+from instrumentation import count, timed
+
+# Output rows resampled at a time; bounds the temporary buffers of a resize
+STRIP_ROWS = 256
+# When shrinking by more than this factor, box-reduce by an integer factor before resampling
+REDUCING_GAP = 3.0
+# Scaled outputs from this many pixels on are written to a memory-mapped temporary file
+MEMMAP_MIN_PIXELS = 4096 * 4096
+
 class ImageProcessor:
     @staticmethod
-    def scale_image(image, width_multiple, height_multiple):
-        """Scale image to multiples of 128 pixels"""
+    @timed('open_image')
+    def open_image(path, target_size=None):
+        """Open an image lazily, letting JPEGs decode at a reduced scale
+
+        With target_size, JPEG draft mode decodes at 1/2, 1/4 or 1/8 scale as
+        long as the result still covers target_size, so a 100 megapixel photo
+        never has to be decoded at full resolution for a much smaller mural.
+        """
+        image = Image.open(path)
+        if target_size and image.format == 'JPEG':
+            image.draft('RGB', target_size)
+        return image
+    
+    @staticmethod
+    def output_buffer(width, height):
+        """Allocate an (height, width, 3) uint8 buffer, memory-mapped when it is large"""
+        if width * height < MEMMAP_MIN_PIXELS:
+            return np.empty((height, width, 3), dtype=np.uint8)
+        # The temporary file is unlinked already and goes away with the mapping
+        return np.memmap(tempfile.TemporaryFile(), dtype=np.uint8, mode='w+', shape=(height, width, 3))
+    
+    @staticmethod
+    @timed('scale_image')
+    def scale_image(image, width_multiple, height_multiple, resample=Image.Resampling.LANCZOS, out=None,
+                    cancel_token=None):
+        """Scale image to multiples of 128 pixels
+
+        The output is resampled in horizontal strips, each from its own box of
+        the source, so the temporary buffers stay bounded however large the
+        source or the mural is. Pillow computes the filter positions of each
+        strip from its box offset, so some pixels differ by one level from a
+        whole-image resize. Shrinking by more than REDUCING_GAP first
+        box-reduces the source by an integer factor, which is much faster
+        and differs from a plain LANCZOS resize by a few levels at most.
+        With out, an (height, width, 3) uint8 array such as
+        output_buffer() returns, the RGB result is written there and out is
+        returned instead of an Image. cancel_token is checked between strips.
+        """
         new_width = 128 * width_multiple
         new_height = 128 * height_multiple
-        return image.resize((new_width, new_height), Image.Resampling.LANCZOS)
+        count('pixels_scaled', new_width * new_height)
+        if image.mode in ('1', 'P', 'PA'):
+            # Palette images would otherwise only be resampled with NEAREST
+            image = image.convert('RGBA' if image.has_transparency_data else 'RGB')
+        if out is not None and image.mode != 'RGB':
+            image = image.convert('RGB')
+        
+        if out is None:
+            result = Image.new(image.mode, (new_width, new_height))
+            count('bytes_allocated', new_width * new_height * len(result.getbands()))
+        else:
+            result = out
+        scale_y = image.height / new_height
+        for top in range(0, new_height, STRIP_ROWS):
+            if cancel_token:
+                cancel_token.raise_if_cancelled()
+            bottom = min(top + STRIP_ROWS, new_height)
+            strip = image.resize(
+                (new_width, bottom - top),
+                resample,
+                box=(0, top * scale_y, image.width, bottom * scale_y),
+                reducing_gap=REDUCING_GAP
+            )
+            if out is None:
+                result.paste(strip, (0, top))
+            else:
+                out[top:bottom] = np.asarray(strip)
+        return result
     
     @staticmethod
+    @timed('create_preview')
     def create_preview(image, canvas_width, canvas_height):
         """Create a preview that fits the canvas while maintaining aspect ratio"""
         if not image:
@@ -22,7 +97,19 @@ class ImageProcessor:
         preview_width = int(image.width * scale_factor)
         preview_height = int(image.height * scale_factor)
         
-        return image.resize((preview_width, preview_height), Image.Resampling.LANCZOS)
+        if image.mode == 'P':
+            if (preview_width, preview_height) == image.size:
+                return image
+            # Palette images are expanded only here, for display; LANCZOS needs RGB
+            image = image.convert('RGB')
+        return image.resize((preview_width, preview_height), Image.Resampling.LANCZOS, reducing_gap=REDUCING_GAP)
+    
+    @staticmethod
+    def save_image(image, path):
+        """Save an image, expanding palette images for formats that cannot store them"""
+        if image.mode == 'P' and path.lower().endswith(('.jpg', '.jpeg')):
+            image = image.convert('RGB')
+        image.save(path)
     
     @staticmethod
     def calculate_price(width_multiple, height_multiple):
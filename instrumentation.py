@@ -0,0 +1,216 @@
+import cProfile
+import functools
+import json
+import os
+import pstats
+import threading
+import time
+import tracemalloc
+from collections import deque
+from contextlib import contextmanager, nullcontext
+from typing import Callable, Dict, List, NamedTuple, Optional
+
+# Finished spans kept for the trace file; older ones are dropped first
+MAX_SPANS = 20000
+# Allocation sites listed in the trace when tracemalloc capture is on
+TOP_ALLOCATIONS = 25
+
+
+class Span(NamedTuple):
+    name: str
+    # perf_counter_ns() at the start and the duration, in nanoseconds
+    start: int
+    duration: int
+    thread: int
+    args: Dict
+
+
+class Instrumentation:
+    """Per-stage timing spans and counters shared by the whole pipeline
+
+    A span costs two clock reads and one deque append, so the stages of the
+    pipeline are always timed. cProfile and tracemalloc capture are much more
+    expensive and only run between start_capture() and stop_capture().
+    Spans can be written as a Chrome trace file (chrome://tracing, Perfetto).
+    """
+
+    def __init__(self, max_spans: int = MAX_SPANS):
+        self.enabled = True
+        self.spans = deque(maxlen=max_spans)
+        self.counters: Dict[str, int] = {}
+        # Duration in seconds of the latest span of each stage
+        self.last_durations: Dict[str, float] = {}
+        # Bumped by every finished span, so readers can skip unchanged readouts
+        self.version = 0
+        self.capturing = False
+        self._profiles: List[cProfile.Profile] = []
+        self._memory_snapshot = None
+        self._memory_peak = 0
+        self._lock = threading.Lock()
+        self._origin = time.perf_counter_ns()
+
+    @contextmanager
+    def _span(self, name: str, args: Dict):
+        started = time.perf_counter_ns()
+        try:
+            yield
+        finally:
+            duration = time.perf_counter_ns() - started
+            self.spans.append(Span(name, started, duration, threading.get_ident(), args))
+            self.last_durations[name] = duration / 1e9
+            self.version += 1
+
+    def span(self, name: str, **args):
+        """Context manager timing one stage; args are stored with the span"""
+        if not self.enabled:
+            return nullcontext()
+        return self._span(name, args)
+
+    def count(self, name: str, value: int = 1):
+        """Add value to a counter such as pixels processed or cache hits"""
+        if self.enabled:
+            with self._lock:
+                self.counters[name] = self.counters.get(name, 0) + value
+
+    def reset(self):
+        """Forget all spans, counters and captured profiles"""
+        with self._lock:
+            self.spans.clear()
+            self.counters.clear()
+            self.last_durations.clear()
+            self._profiles.clear()
+            self._memory_snapshot = None
+            self._memory_peak = 0
+            self.version += 1
+
+    def describe(self, stages: List[str]) -> str:
+        """Latest duration of each stage that has run, such as 'scale_image 85 ms'"""
+        parts = [
+            f"{stage} {self.last_durations[stage] * 1000:.0f} ms"
+            for stage in stages if stage in self.last_durations
+        ]
+        return "  ".join(parts)
+
+    def start_capture(self):
+        """Profile the calls made through profile_call and trace allocations"""
+        if self.capturing:
+            return
+        with self._lock:
+            self._profiles.clear()
+            self._memory_snapshot = None
+            self._memory_peak = 0
+        tracemalloc.start()
+        self.capturing = True
+
+    def stop_capture(self):
+        """Stop capturing; the results stay available to export_trace()"""
+        if not self.capturing:
+            return
+        self.capturing = False
+        if tracemalloc.is_tracing():
+            self._memory_snapshot = tracemalloc.take_snapshot()
+            self._memory_peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+
+    def profile_call(self, func: Callable, *args, **kwargs):
+        """Call func, under cProfile while capture is on
+
+        cProfile only sees the thread it runs in, so worker jobs are wrapped
+        individually and their profiles merged on export.
+        """
+        if not self.capturing:
+            return func(*args, **kwargs)
+        profile = cProfile.Profile()
+        try:
+            return profile.runcall(func, *args, **kwargs)
+        finally:
+            with self._lock:
+                self._profiles.append(profile)
+
+    def memory_usage(self) -> Optional[Dict]:
+        """Peak traced bytes and the largest allocation sites of the last capture"""
+        if self.capturing and tracemalloc.is_tracing():
+            snapshot = tracemalloc.take_snapshot()
+            peak = tracemalloc.get_traced_memory()[1]
+        elif self._memory_snapshot is not None:
+            snapshot = self._memory_snapshot
+            peak = self._memory_peak
+        else:
+            return None
+        top = snapshot.statistics('lineno')[:TOP_ALLOCATIONS]
+        return {
+            'peak_bytes': peak,
+            'top_allocations': [
+                {'location': str(stat.traceback), 'bytes': stat.size, 'count': stat.count} for stat in top
+            ],
+        }
+
+    def trace_events(self) -> List[Dict]:
+        """Spans as Chrome trace 'complete' events, in microseconds"""
+        pid = os.getpid()
+        return [
+            {
+                'name': span.name,
+                'ph': 'X',
+                'ts': (span.start - self._origin) / 1000,
+                'dur': span.duration / 1000,
+                'pid': pid,
+                'tid': span.thread,
+                'args': span.args,
+            }
+            for span in list(self.spans)
+        ]
+
+    def export_trace(self, path: str) -> List[str]:
+        """Write the spans, counters and memory capture as a Chrome trace JSON file
+
+        When profiles were captured they are also written next to it as
+        <path>.prof for pstats or snakeviz. Returns the written paths.
+        """
+        trace = {
+            'traceEvents': self.trace_events(),
+            'displayTimeUnit': 'ms',
+            'otherData': {
+                'counters': dict(self.counters),
+                'memory': self.memory_usage(),
+            },
+        }
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(trace, f)
+        written = [path]
+
+        with self._lock:
+            profiles = list(self._profiles)
+        if profiles:
+            stats = pstats.Stats(profiles[0])
+            for profile in profiles[1:]:
+                stats.add(profile)
+            profile_path = os.path.splitext(path)[0] + '.prof'
+            stats.dump_stats(profile_path)
+            written.append(profile_path)
+        return written
+
+
+# Shared by the GUI, the processors and the caches
+instruments = Instrumentation()
+
+
+def span(name: str, **args):
+    """Time one stage of the pipeline on the shared instrumentation"""
+    return instruments.span(name, **args)
+
+
+def count(name: str, value: int = 1):
+    """Add to a counter on the shared instrumentation"""
+    instruments.count(name, value)
+
+
+def timed(name: str):
+    """Decorator timing every call of a function as a span named name"""
+    def decorate(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with instruments.span(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorate
@@ -1,15 +1,39 @@
 import tkinter as tk
-from tkinter import ttk, messagebox, filedialog
+from tkinter import ttk, messagebox, filedialog, simpledialog
 import tkinterdnd2 as tkdnd
 from PIL import Image
 import os
+from collections import OrderedDict
+from queue import SimpleQueue, Empty
 
 from image_utils import ImageProcessor
 from minecraft_map_processor import MinecraftMapProcessor
+from map_exporter import MapDataExporter
+from bill_of_materials import MaterialEstimator
 from preview_canvas import PreviewCanvas
-from control_panel import ControlPanel
-from progress_dialog import ProgressDialog
+from control_panel import ControlPanel, MAX_MULTIPLE
+from progress_channel import ProgressChannel
 from threaded_processor import ThreadedProcessor
+from result_cache import ResultCache
+from palette_quantizer import IncrementalQuantizer, get_quantizer
+from color_metrics import DEFAULT_METRIC
+from instrumentation import instruments, span
+
+# UI refresh interval for progress and finished jobs (~30 frames per second)
+FRAME_INTERVAL_MS = 33
+# Finished tiles painted per frame, so a burst of tiles never stalls the UI
+MAX_TILES_PER_FRAME = 64
+# Quiet period after the last size change before a preview is computed
+PREVIEW_DEBOUNCE_MS = 150
+# Previews whose distinct colors are kept for re-quantizing with another metric
+MAX_REQUANTIZERS = 4
+# Jobs that write files; previews wait for them instead of preempting them
+EXPORT_JOBS = ('export', 'export_dat')
+# Pipeline stages shown in the timing readout, in pipeline order
+TIMED_STAGES = (
+    'open_image', 'decode_image', 'scale_image', 'quantize_image', 'create_preview',
+    'render_view', 'photo_image', 'export_dat', 'bill_of_materials'
+)
 
 class ImageScalerApp:
     def __init__(self, root: tkdnd.Tk):
@@ -34,31 +58,99 @@ class ImageScalerApp:
         self.control_panel = ControlPanel(
             main_frame,
             on_image_selected=self.load_image,
-            on_scale_changed=self.update_preview,
+            on_scale_changed=self.schedule_preview,
             on_save_clicked=self.save_image,
-            on_preview_mode_changed=self.change_preview_mode
+            on_preview_mode_changed=self.change_preview_mode,
+            on_cancel_clicked=self.cancel_job,
+            on_export_clicked=self.export_map_art,
+            on_metric_changed=self.change_metric,
+            on_export_dat_clicked=self.export_map_data,
+            on_profiling_toggled=self.toggle_profiling,
+            on_export_trace_clicked=self.export_trace
         )
         self.control_panel.grid(row=0, column=0, sticky="nw", padx=(0, 20))
 
         # Create preview canvas
-        self.preview_canvas = PreviewCanvas(main_frame)
+        self.preview_canvas = PreviewCanvas(main_frame, on_detail_needed=self.request_detail)
         self.preview_canvas.grid(row=0, column=1, sticky="nsew")
 
         # Initialize variables
         self.original_image = None
+        self.source_path = None
+        self.source_hash = None
         self.scaled_image = None
+        # (source hash, width multiple, height multiple, resample) of scaled_image
+        self.scale_key = None
         self.preview_mode = "normal"
+        self.color_metric = DEFAULT_METRIC
+        # Pending debounced preview update, from root.after
+        self.preview_after_id = None
+        # (width, height) multiples of a preview requested while an export runs
+        self.deferred_preview = None
         
-        # Initialize threaded processor
+        # Scaled images and map previews keyed by source content and settings,
+        # so switching modes or revisiting multiples skips the recomputation
+        self.result_cache = ResultCache()
+        self.resample = Image.Resampling.LANCZOS
+        # Distinct colors of recent previews and their matches, keyed like
+        # the previews, so a metric change only re-matches colors
+        self.requantizers = OrderedDict()
+        
+        # Initialize threaded processor; workers report progress through the
+        # channel and never touch Tk themselves
         self.processor = ThreadedProcessor(self.on_processing_complete)
+        self.progress_channel = ProgressChannel()
+        
+        # Finished map tiles streamed from the worker to the canvas, tagged with
+        # the cancellation token of the job that produced them
+        self.tile_queue = SimpleQueue()
+        self.job_token = None
+        self.job_kind = None
+        
+        # Instrumentation version shown in the timing readout
+        self.timings_version = None
         
         # Schedule periodic updates
-        self.root.after(100, self.check_processing)
+        self.root.after(FRAME_INTERVAL_MS, self.check_processing)
 
     def check_processing(self):
-        """Check for completed processing tasks"""
+        """Refresh progress and check for completed processing tasks once per frame"""
+        if self.job_token is not None:
+            snapshot = self.progress_channel.snapshot()
+            self.control_panel.show_progress(snapshot.percent, snapshot.describe())
+            self._paint_tiles()
         self.processor.update()
-        self.root.after(100, self.check_processing)
+        if instruments.version != self.timings_version:
+            self.timings_version = instruments.version
+            self.control_panel.set_timings(instruments.describe(TIMED_STAGES))
+        self.root.after(FRAME_INTERVAL_MS, self.check_processing)
+
+    def _paint_tiles(self):
+        """Move finished tiles of the current job from the worker queue onto the canvas"""
+        tiles = []
+        while len(tiles) < MAX_TILES_PER_FRAME:
+            try:
+                token, tile = self.tile_queue.get_nowait()
+            except Empty:
+                break
+            if token is self.job_token:
+                tiles.append(tile)
+        if tiles:
+            self.preview_canvas.paste_tiles(tiles)
+
+    def _start_job(self, kind, total_pixels, func, *args):
+        """Run a worker job whose progress is shown in the control panel"""
+        self.progress_channel.reset(total_pixels)
+        self.processor.process(func, *args)
+        self.job_token = self.processor.current_token
+        self.job_kind = kind
+
+    def _stop_progressive(self):
+        """Forget the running job and hide its progress"""
+        self.job_token = None
+        self.job_kind = None
+        self.preview_canvas.end_progressive()
+        self.control_panel.hide_progress()
 
     def change_preview_mode(self, mode):
         """Change the preview mode between normal and minecraft"""
@@ -66,6 +158,12 @@ class ImageScalerApp:
         self.preview_canvas.set_preview_mode(mode)
         self.update_preview()
 
+    def change_metric(self, metric):
+        """Change the color distance used for map previews and exports"""
+        self.color_metric = metric
+        if self.preview_mode == "minecraft":
+            self.update_preview()
+
     def on_drag_drop(self, event):
         file_path = event.data
         self.control_panel.update_filepath(file_path)
@@ -74,26 +172,107 @@ class ImageScalerApp:
     def load_image(self, file_path):
         """Load and display the selected image"""
         try:
-            self.original_image = Image.open(file_path)
+            # Opening only reads the header; pixels are decoded when the image is scaled
+            self.original_image = ImageProcessor.open_image(file_path)
+            self.source_path = file_path
+            self.source_hash = ResultCache.hash_file(file_path)
+            # Exports wait for the new file's first preview instead of using the old image
+            self.scaled_image = None
+            self.scale_key = None
             self.control_panel.set_status("图片加载成功")
             self.update_preview()
         except Exception as e:
             messagebox.showerror("错误", f"加载图片失败: {str(e)}")
             self.original_image = None
+            self.source_path = None
+            self.source_hash = None
+
+    def cancel_job(self):
+        """Cancel the job shown in the control panel"""
+        if self.job_kind in EXPORT_JOBS:
+            self.processor.cancel()
+            self._stop_progressive()
+            self.control_panel.set_status("已取消导出")
+            self._run_deferred_preview()
+        else:
+            self.cancel_preview()
 
     def cancel_preview(self):
         """Cancel the current preview processing"""
         self.processor.cancel()
         self.preview_mode = "normal"
-        self.control_panel.preview_mode.set("normal")
+        self.control_panel.set_preview_mode("normal")
         self.preview_canvas.set_preview_mode("normal")
         self.update_preview()
 
-    def update_preview(self, width_multiple=None, height_multiple=None):
-        """Update the preview with current scale settings"""
+    def _scale_source(self, source_path, scale_key, cancel_token=None):
+        """Scaled image for scale_key, from the cache or by scaling the file
+
+        Runs in the worker. JPEGs decode at the smallest scale that still
+        covers the output.
+        """
+        _, width_multiple, height_multiple, resample = scale_key
+
+        def scale():
+            target_size = (128 * width_multiple, 128 * height_multiple)
+            with ImageProcessor.open_image(source_path, target_size) as source:
+                with span('decode_image', path=os.path.basename(source_path)):
+                    source.load()
+                return ImageProcessor.scale_image(
+                    source, width_multiple, height_multiple, resample, cancel_token=cancel_token
+                )
+
+        return self.result_cache.get_or_compute(('scaled',) + scale_key, scale)
+
+    def schedule_preview(self, width_multiple=None, height_multiple=None):
+        """Update the preview once the size settings have been quiet for a moment
+
+        Every call restarts the wait, so clicking through multiples only
+        computes the last configuration. During an export the request is
+        only remembered and shown once the export ends.
+        """
+        if self.preview_after_id is not None:
+            self.root.after_cancel(self.preview_after_id)
+            self.preview_after_id = None
+        if self.job_kind in EXPORT_JOBS:
+            self.deferred_preview = (width_multiple, height_multiple)
+            return
+        self.preview_after_id = self.root.after(
+            PREVIEW_DEBOUNCE_MS, self._run_scheduled_preview, width_multiple, height_multiple
+        )
+
+    def _run_scheduled_preview(self, width_multiple, height_multiple):
+        self.preview_after_id = None
+        self.update_preview(width_multiple, height_multiple)
+
+    def _run_deferred_preview(self):
+        """Show the preview that was requested while an export was running"""
+        if self.deferred_preview is None:
+            return
+        width_multiple, height_multiple = self.deferred_preview
+        self.deferred_preview = None
+        # Keep the export's outcome in the status line
+        self.update_preview(width_multiple, height_multiple, show_price=False)
+
+    def update_preview(self, width_multiple=None, height_multiple=None, show_price=True):
+        """Update the preview with current scale settings
+
+        Scaling and preview rendering run in the worker; a new update preempts
+        the running preview and only the latest result is shown. A running
+        export is never preempted: the update is deferred until it ends.
+        """
         if not self.original_image:
             return
 
+        if self.preview_after_id is not None:
+            self.root.after_cancel(self.preview_after_id)
+            self.preview_after_id = None
+
+        if self.job_kind in EXPORT_JOBS:
+            self.deferred_preview = (width_multiple, height_multiple)
+            self.control_panel.set_status("正在导出，完成后将更新预览")
+            return
+
         try:
             # Get current scale values if not provided
             if width_multiple is None:
@@ -105,61 +284,317 @@ class ImageScalerApp:
             if width_multiple <= 0 or height_multiple <= 0:
                 messagebox.showerror("错误", "倍数必须是正整数")
                 return
+            if width_multiple > MAX_MULTIPLE or height_multiple > MAX_MULTIPLE:
+                messagebox.showerror("错误", f"倍数不能超过 {MAX_MULTIPLE}")
+                return
 
-            # Scale image
-            self.scaled_image = ImageProcessor.scale_image(
-                self.original_image,
-                width_multiple,
-                height_multiple
+            scale_key = (self.source_hash, width_multiple, height_multiple, int(self.resample))
+            scaled_size = (128 * width_multiple, 128 * height_multiple)
+            canvas_size = (
+                self.preview_canvas.canvas.winfo_width(),
+                self.preview_canvas.canvas.winfo_height()
             )
 
             # Create preview based on mode
             if self.preview_mode == "minecraft":
-                # Show progress dialog and process in thread
-                self.progress_dialog = ProgressDialog(
-                    self.root,
-                    on_cancel=self.cancel_preview
-                )
-                self.processor.process(
-                    MinecraftMapProcessor.create_map_preview,
-                    self.scaled_image,
-                    self.progress_dialog.update_progress
-                )
+                # Quantize only at canvas resolution; the full resolution map
+                # art is computed when it is exported
+                palette_version = get_quantizer(metric=self.color_metric).palette_version
+                preview_key = ('map_preview',) + scale_key + (palette_version,) + canvas_size
+                scaled_image = self.result_cache.get(('scaled',) + scale_key)
+                map_preview = self.result_cache.get(preview_key) if scaled_image is not None else None
+                if map_preview is not None:
+                    # Already converted with these settings: show it right away
+                    self.processor.cancel()
+                    self.on_processing_complete(True, ('preview', (scale_key, scaled_image, map_preview)))
+                else:
+                    # A new job preempts the running one
+                    scale = min(canvas_size[0] / scaled_size[0], canvas_size[1] / scaled_size[1], 1.0)
+                    preview_pixels = int(scaled_size[0] * scale) * int(scaled_size[1] * scale)
+                    self._start_job(
+                        'preview',
+                        preview_pixels,
+                        self._build_map_preview,
+                        self.source_path,
+                        scale_key,
+                        preview_key,
+                        canvas_size,
+                        self.color_metric,
+                        self._requantizer(scale_key + canvas_size)
+                    )
             else:
-                # Normal preview
-                preview = ImageProcessor.create_preview(
-                    self.scaled_image,
-                    self.preview_canvas.canvas.winfo_width(),
-                    self.preview_canvas.canvas.winfo_height()
-                )
-                self.preview_canvas.update_preview(preview)
+                # Normal preview; no progress is shown for this short job. Only
+                # a preview's progress is cleared, never an export's
+                if self.job_kind == 'preview':
+                    self._stop_progressive()
+                self.processor.process(self._build_normal_preview, self.source_path, scale_key, canvas_size)
 
             # Calculate price
             price = ImageProcessor.calculate_price(width_multiple, height_multiple)
 
             # Update status
-            self.control_panel.set_status(
-                f"图片像素: {self.scaled_image.width}x{self.scaled_image.height} pixels (生成地图画将需要花费: {price} DCB)"
-            )
+            if show_price:
+                self.control_panel.set_status(
+                    f"图片像素: {scaled_size[0]}x{scaled_size[1]} pixels (生成地图画将需要花费: {price} DCB)"
+                )
 
         except Exception as e:
             messagebox.showerror("错误", str(e))
 
+    def _requantizer(self, key):
+        """IncrementalQuantizer for key, evicting the least recently used one"""
+        requantizer = self.requantizers.pop(key, None)
+        if requantizer is None:
+            requantizer = IncrementalQuantizer()
+        self.requantizers[key] = requantizer
+        while len(self.requantizers) > MAX_REQUANTIZERS:
+            self.requantizers.popitem(last=False)
+        return requantizer
+
+    def _build_normal_preview(self, source_path, scale_key, canvas_size, cancel_token=None):
+        """Worker job: scale the source and fit it to the canvas"""
+        scaled_image = self._scale_source(source_path, scale_key, cancel_token)
+        cancel_token.raise_if_cancelled()
+        preview = ImageProcessor.create_preview(scaled_image, *canvas_size)
+        return 'normal', (scale_key, scaled_image, preview)
+
+    def _build_map_preview(self, source_path, scale_key, cache_key, canvas_size, metric, requantizer,
+                           cancel_token=None):
+        """Worker job: quantize the canvas-sized preview and remember the result"""
+        scaled_image = self._scale_source(source_path, scale_key, cancel_token)
+        map_preview = MinecraftMapProcessor.create_canvas_preview(
+            scaled_image,
+            *canvas_size,
+            progress_callback=self.progress_channel.report,
+            cancel_token=cancel_token,
+            metric=metric,
+            incremental=requantizer
+        )
+        self.result_cache.put(cache_key, map_preview)
+        return 'preview', (scale_key, scaled_image, map_preview)
+
+    def _build_map_art(self, image, cache_key, save_path, metric, cancel_token=None):
+        """Worker job: quantize at full resolution and save the map art
+
+        Every finished tile is queued for the main loop, which paints it over
+        the canvas-resolution preview when the map preview is on screen.
+        """
+        map_art = self.result_cache.get(cache_key)
+        if map_art is None:
+            map_art = MinecraftMapProcessor.create_map_preview(
+                image,
+                self.progress_channel.report,
+                parallel=True,
+                cancel_token=cancel_token,
+                tile_callback=lambda box, pixels: self.tile_queue.put((cancel_token, (box, pixels))),
+                metric=metric
+            )
+            self.result_cache.put(cache_key, map_art)
+        ImageProcessor.save_image(map_art, save_path)
+        return 'export', (map_art, save_path)
+
+    def _build_map_data(self, image, output_dir, first_map_id, metric, cancel_token=None):
+        """Worker job: quantize at full resolution and write one map_N.dat per tile"""
+        report = self.progress_channel.report
+        _, index_map = MinecraftMapProcessor.quantize_image(
+            image,
+            lambda percent: report(percent * 0.8),
+            parallel=True,
+            cancel_token=cancel_token,
+            tile_callback=lambda box, pixels: self.tile_queue.put((cancel_token, (box, pixels))),
+            metric=metric
+        )
+        exported = MapDataExporter.export(
+            index_map,
+            output_dir,
+            first_map_id,
+            progress_callback=lambda percent: report(80 + percent * 0.2),
+            cancel_token=cancel_token
+        )
+        materials = MaterialEstimator.estimate(index_map)
+        MaterialEstimator.write_csv(materials, os.path.join(output_dir, "materials.csv"))
+        return 'export_dat', (exported, first_map_id, materials)
+
     def on_processing_complete(self, success, result):
         """Handle completion of threaded processing"""
-        if hasattr(self, 'progress_dialog'):
-            self.progress_dialog.close()
-            delattr(self, 'progress_dialog')
+        finished_export = self.job_kind in EXPORT_JOBS
+        self._stop_progressive()
+        self._show_result(success, result)
+        if finished_export:
+            self._run_deferred_preview()
+
+    def _show_result(self, success, result):
+        """Show the outcome of a finished job"""
+        if not success:
+            messagebox.showerror("错误", f"处理失败: {result}")
+            return
 
-        if success:
-            preview = ImageProcessor.create_preview(
-                result,
-                self.preview_canvas.canvas.winfo_width(),
-                self.preview_canvas.canvas.winfo_height()
+        kind, payload = result
+        if kind == 'export_dat':
+            exported, first_map_id, materials = payload
+            paths = exported.paths
+            self.control_panel.set_status(
+                f"已导出 {len(paths)} 个地图文件: map_{first_map_id}.dat ~ map_{first_map_id + len(paths) - 1}.dat，"
+                f"其中 {exported.written} 个已写入、{exported.unchanged} 个与上次导出相同未改动，材料清单见 materials.csv"
             )
-            self.preview_canvas.update_preview(preview)
+            messagebox.showinfo("材料清单", MaterialEstimator.format_report(materials))
+            return
+        if kind == 'detail':
+            scale_key, metric, box, detail = payload
+            if scale_key == self.scale_key and metric == self.color_metric and self.preview_mode == "minecraft":
+                self.preview_canvas.set_detail(box, detail)
+            return
+        if kind == 'export':
+            map_art, save_path = payload
+            self.control_panel.set_status(f"地图画已导出: {os.path.basename(save_path)}")
+            if self.preview_mode != "minecraft":
+                return
+            result = map_art
+            full_image = map_art
         else:
-            messagebox.showerror("错误", f"处理失败: {result}")
+            # The scaled image the exports work from follows the latest preview
+            self.scale_key, self.scaled_image, result = payload
+            if kind == 'normal':
+                self.preview_canvas.update_preview(result, full_image=self.scaled_image)
+                return
+            # Zoom into the full resolution map art if it has been computed already
+            full_image = self.result_cache.get(self._map_art_key())
+
+        preview = ImageProcessor.create_preview(
+            result,
+            self.preview_canvas.canvas.winfo_width(),
+            self.preview_canvas.canvas.winfo_height()
+        )
+        self.preview_canvas.update_preview(preview, full_image=full_image, source_size=self.scaled_image.size)
+
+    def _map_art_key(self):
+        """Cache key of the full resolution map art for the current settings"""
+        return ('map',) + self.scale_key + (get_quantizer(metric=self.color_metric).palette_version,)
+
+    def request_detail(self, box):
+        """Quantize a region at full resolution when the map preview is zoomed in on it
+
+        Runs as a short worker job, so it never preempts an export or a
+        preview that is still being computed.
+        """
+        if self.preview_mode != "minecraft" or not self.scaled_image or self.processor.is_processing:
+            return
+        self.processor.process(self._build_detail, self.scaled_image, self.scale_key, box, self.color_metric)
+
+    def _build_detail(self, image, scale_key, box, metric, cancel_token=None):
+        """Worker job: quantize one region of the scaled image"""
+        detail, _ = MinecraftMapProcessor.quantize_image(image.crop(box), cancel_token=cancel_token, metric=metric)
+        return 'detail', (scale_key, metric, box, detail)
+
+    def _export_running(self):
+        """Tell the user and return True while an export is still running
+
+        A new job would preempt it and leave a missing PNG or a partial set
+        of map files behind.
+        """
+        if self.job_kind not in EXPORT_JOBS:
+            return False
+        messagebox.showinfo("提示", "正在导出，请等待当前导出完成或先取消")
+        return True
+
+    def export_map_art(self):
+        """Quantize the scaled image at full resolution and save the map art"""
+        if self._export_running():
+            return
+        if not self.scaled_image:
+            messagebox.showerror("错误", "您还没有加载图片呢")
+            return
+
+        file_types = [
+            ('PNG files', '*.png'),
+            ('All files', '*.*')
+        ]
+        save_path = filedialog.asksaveasfilename(
+            defaultextension=".png",
+            filetypes=file_types,
+            initialfile=f"map_{self.scaled_image.width}x{self.scaled_image.height}"
+        )
+        if not save_path:
+            return
+
+        # Refine the on-screen map preview with full resolution tiles as they finish
+        if self.preview_mode == "minecraft" and self.preview_canvas.current_preview:
+            self.preview_canvas.start_progressive(
+                self.preview_canvas.current_preview, self.scaled_image.size
+            )
+        map_key = self._map_art_key()
+        self._start_job(
+            'export',
+            self.scaled_image.width * self.scaled_image.height,
+            self._build_map_art,
+            self.scaled_image,
+            map_key,
+            save_path,
+            self.color_metric
+        )
+
+    def export_map_data(self):
+        """Write the map art as map_N.dat files for a world's data folder"""
+        if self._export_running():
+            return
+        if not self.scaled_image:
+            messagebox.showerror("错误", "您还没有加载图片呢")
+            return
+
+        output_dir = filedialog.askdirectory(title="选择地图文件保存目录（世界存档的 data 文件夹）")
+        if not output_dir:
+            return
+        first_map_id = simpledialog.askinteger(
+            "起始地图编号",
+            "第一张地图的编号（不要与存档中已有的地图重复）:",
+            initialvalue=0,
+            minvalue=0,
+            parent=self.root
+        )
+        if first_map_id is None:
+            return
+
+        if self.preview_mode == "minecraft" and self.preview_canvas.current_preview:
+            self.preview_canvas.start_progressive(
+                self.preview_canvas.current_preview, self.scaled_image.size
+            )
+        self._start_job(
+            'export_dat',
+            self.scaled_image.width * self.scaled_image.height,
+            self._build_map_data,
+            self.scaled_image,
+            output_dir,
+            first_map_id,
+            self.color_metric
+        )
+
+    def toggle_profiling(self, enabled):
+        """Start or stop cProfile and tracemalloc capture of worker jobs"""
+        if enabled:
+            instruments.start_capture()
+            self.control_panel.set_status("性能分析已开启，之后的预览和导出任务会被记录")
+        else:
+            instruments.stop_capture()
+            self.control_panel.set_status("性能分析已关闭，可导出性能跟踪")
+
+    def export_trace(self):
+        """Save the recorded spans, counters and profiles"""
+        save_path = filedialog.asksaveasfilename(
+            defaultextension=".json",
+            filetypes=[('Chrome trace', '*.json'), ('All files', '*.*')],
+            initialfile="trace.json"
+        )
+        if not save_path:
+            return
+        try:
+            written = instruments.export_trace(save_path)
+        except Exception as e:
+            messagebox.showerror("错误", f"导出性能跟踪失败: {str(e)}")
+            return
+        self.control_panel.set_status(
+            "性能跟踪已导出: " + "、".join(os.path.basename(path) for path in written)
+            + "（可在 chrome://tracing 或 Perfetto 中打开）"
+        )
 
     def save_image(self):
         """Save the scaled image"""
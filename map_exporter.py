@@ -0,0 +1,266 @@
+import gzip
+import json
+import os
+import struct
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from typing import Callable, Dict, Iterator, List, NamedTuple, Optional, Tuple
+
+import numpy as np
+
+from cancellation import CancellationToken
+from instrumentation import count, timed
+from tile_index import TileIndex
+
+# Side length of one in-game map in pixels
+TILE_SIZE = 128
+
+# Minecraft 1.17.1; the game upgrades older map data when it loads it, and
+# 1.17 is the first version with every color in MAP_COLORS (glow lichen)
+DEFAULT_DATA_VERSION = 2730
+
+# Map id -> tile digest of the files in an output directory, for incremental exports
+MANIFEST_NAME = 'map_manifest.json'
+MANIFEST_VERSION = 1
+
+# NBT tag type ids
+TAG_BYTE = 1
+TAG_INT = 3
+TAG_BYTE_ARRAY = 7
+TAG_STRING = 8
+TAG_LIST = 9
+TAG_COMPOUND = 10
+TAG_END = 0
+
+
+def _nbt_name(name: str) -> bytes:
+    encoded = name.encode('utf-8')
+    return struct.pack('>H', len(encoded)) + encoded
+
+
+def _nbt_tag(tag_type: int, name: str, payload: bytes) -> bytes:
+    """A named tag: type id, name and big-endian payload"""
+    return bytes([tag_type]) + _nbt_name(name) + payload
+
+
+def _nbt_byte(name: str, value: int) -> bytes:
+    return _nbt_tag(TAG_BYTE, name, struct.pack('>b', value))
+
+
+def _nbt_int(name: str, value: int) -> bytes:
+    return _nbt_tag(TAG_INT, name, struct.pack('>i', value))
+
+
+def _nbt_string(name: str, value: str) -> bytes:
+    return _nbt_tag(TAG_STRING, name, _nbt_name(value))
+
+
+def _nbt_byte_array(name: str, value: bytes) -> bytes:
+    return _nbt_tag(TAG_BYTE_ARRAY, name, struct.pack('>i', len(value)) + value)
+
+
+def _nbt_empty_list(name: str) -> bytes:
+    return _nbt_tag(TAG_LIST, name, bytes([TAG_END]) + struct.pack('>i', 0))
+
+
+def _nbt_compound(name: str, *tags: bytes) -> bytes:
+    return _nbt_tag(TAG_COMPOUND, name, b''.join(tags) + bytes([TAG_END]))
+
+
+class ExportResult(NamedTuple):
+    # Every map file of the mural, in map id order
+    paths: List[str]
+    # Files written by this export
+    written: int
+    # Files left alone because the manifest shows the same tile was written before
+    unchanged: int
+
+
+class MapDataExporter:
+    """Writes quantized map art as Minecraft map_N.dat files, one per 128x128 tile"""
+
+    # Tiles encoded ahead of the writes that have finished, per worker
+    IN_FLIGHT_PER_WORKER = 2
+    # gzip level; map colors compress well and level 6 is what the game uses
+    COMPRESS_LEVEL = 6
+
+    @staticmethod
+    def default_workers() -> int:
+        return os.cpu_count() or 1
+
+    @staticmethod
+    def tile_colors(index_tile: np.ndarray) -> bytes:
+        """Convert a tile of MAP_COLORS ids to the 16384 color bytes of a map
+
+        A MAP_COLORS id k >= 1 has base color (k - 1) // 4 + 1 and shade
+        (k - 1) % 4, and the game stores base * 4 + shade, which is k + 3.
+        Id 0 and the padding of partial tiles are transparent; quantizers never
+        produce id 0, so only the padding is.
+        """
+        colors = np.zeros((TILE_SIZE, TILE_SIZE), dtype=np.uint8)
+        height, width = index_tile.shape
+        colors[:height, :width] = np.where(index_tile > 0, index_tile.astype(np.uint16) + 3, 0)
+        return colors.tobytes()
+
+    @staticmethod
+    def encode_map(colors: bytes, data_version: int = DEFAULT_DATA_VERSION,
+                   x_center: int = 0, z_center: int = 0) -> bytes:
+        """Build the gzip-compressed NBT of a locked map with the given color bytes"""
+        nbt = _nbt_compound(
+            '',
+            _nbt_compound(
+                'data',
+                _nbt_byte('scale', 0),
+                _nbt_string('dimension', 'minecraft:overworld'),
+                _nbt_int('xCenter', x_center),
+                _nbt_int('zCenter', z_center),
+                _nbt_byte('trackingPosition', 0),
+                _nbt_byte('unlimitedTracking', 0),
+                # Locked maps never redraw from the world, so the art stays as exported
+                _nbt_byte('locked', 1),
+                _nbt_empty_list('banners'),
+                _nbt_empty_list('frames'),
+                _nbt_byte_array('colors', colors),
+            ),
+            _nbt_int('DataVersion', data_version),
+        )
+        return gzip.compress(nbt, compresslevel=MapDataExporter.COMPRESS_LEVEL, mtime=0)
+
+    @staticmethod
+    def iter_tiles(index_map: np.ndarray) -> Iterator[Tuple[int, int, np.ndarray]]:
+        """Yield (row, column, index_tile) in row-major order, matching map id order"""
+        height, width = index_map.shape
+        for row, top in enumerate(range(0, height, TILE_SIZE)):
+            for column, left in enumerate(range(0, width, TILE_SIZE)):
+                yield row, column, index_map[top:top + TILE_SIZE, left:left + TILE_SIZE]
+
+    @staticmethod
+    def load_manifest(output_dir: str) -> Dict[str, str]:
+        """Map id (as a string) -> tile digest of an output directory, empty if there is none"""
+        try:
+            with open(os.path.join(output_dir, MANIFEST_NAME), encoding='utf-8') as f:
+                manifest = json.load(f)
+        except (OSError, ValueError):
+            return {}
+        if not isinstance(manifest, dict) or manifest.get('version') != MANIFEST_VERSION:
+            return {}
+        return dict(manifest.get('maps', {}))
+
+    @staticmethod
+    def save_manifest(output_dir: str, maps: Dict[str, str]):
+        """Atomically replace the manifest of an output directory"""
+        path = os.path.join(output_dir, MANIFEST_NAME)
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({
+                'version': MANIFEST_VERSION,
+                'maps': dict(sorted(maps.items(), key=lambda item: int(item[0]))),
+            }, f, indent=1)
+        os.replace(tmp_path, path)
+
+    @staticmethod
+    def _write_tiles(index_tile: np.ndarray, paths: List[str], data_version: int) -> List[str]:
+        """Worker task: encode and compress one tile once, then write it to every path"""
+        data = MapDataExporter.encode_map(MapDataExporter.tile_colors(index_tile), data_version)
+        for path in paths:
+            tmp_path = f"{path}.tmp"
+            with open(tmp_path, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        return paths
+
+    @staticmethod
+    @timed('export_dat')
+    def export(
+        index_map: np.ndarray,
+        output_dir: str,
+        first_map_id: int = 0,
+        workers: Optional[int] = None,
+        data_version: int = DEFAULT_DATA_VERSION,
+        progress_callback: Callable[[float], None] = None,
+        cancel_token: Optional[CancellationToken] = None,
+        incremental: bool = True
+    ) -> ExportResult:
+        """Write map_<id>.dat for every 128x128 tile of an index map
+
+        Ids are assigned from first_map_id in row-major tile order, so the maps
+        go into item frames left to right, top to bottom. Tiles are encoded
+        and gzip-compressed on a thread pool (zlib releases the GIL) and each
+        file is written as soon as it is ready; only a bounded number of tiles
+        is in flight, so large murals are never buffered in memory.
+
+        Every tile is hashed. Identical tiles are encoded once and written to
+        each of their files, and the digests are kept per map id in the
+        directory's manifest. With incremental=True a file whose manifest
+        entry matches and that still exists is not written again, so
+        re-exporting a revised mural only rewrites the tiles that changed.
+        Entries of other map ids are kept, so several murals can share one
+        data folder.
+        """
+        if first_map_id < 0:
+            raise ValueError("Map id must not be negative")
+        os.makedirs(output_dir, exist_ok=True)
+
+        workers = workers or MapDataExporter.default_workers()
+        columns = -(-index_map.shape[1] // TILE_SIZE)
+        total = columns * -(-index_map.shape[0] // TILE_SIZE)
+        paths = [None] * total
+        max_in_flight = workers * MapDataExporter.IN_FLIGHT_PER_WORKER
+        manifest = MapDataExporter.load_manifest(output_dir)
+
+        # Group the tiles that need writing by content, keeping map id order
+        salt = f"data_version={data_version}"
+        groups = {}
+        unchanged = 0
+        for row, column, index_tile in MapDataExporter.iter_tiles(index_map):
+            position = row * columns + column
+            map_id = str(first_map_id + position)
+            path = os.path.join(output_dir, f"map_{map_id}.dat")
+            paths[position] = path
+            digest = TileIndex.digest(index_tile, salt)
+            if incremental and manifest.get(map_id) == digest and os.path.exists(path):
+                unchanged += 1
+                continue
+            manifest.pop(map_id, None)
+            group = groups.setdefault(digest, (index_tile, []))
+            group[1].append((map_id, path))
+        count('tiles_unchanged', unchanged)
+        count('tiles_deduplicated', sum(len(entries) for _, entries in groups.values()) - len(groups))
+
+        done_count = unchanged
+        written = 0
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            pending = {}
+
+            def collect(futures):
+                nonlocal done_count, written
+                for future in futures:
+                    digest, entries = pending.pop(future)
+                    future.result()
+                    for map_id, _ in entries:
+                        manifest[map_id] = digest
+                    done_count += len(entries)
+                    written += len(entries)
+                    if progress_callback:
+                        progress_callback((done_count / total) * 100)
+
+            try:
+                for digest, (index_tile, entries) in groups.items():
+                    if cancel_token:
+                        cancel_token.raise_if_cancelled()
+                    future = executor.submit(
+                        MapDataExporter._write_tiles, index_tile, [path for _, path in entries], data_version
+                    )
+                    pending[future] = (digest, entries)
+                    if len(pending) >= max_in_flight:
+                        finished, _ = wait(pending, return_when=FIRST_COMPLETED)
+                        collect(finished)
+                collect(wait(pending).done)
+            finally:
+                for future in pending:
+                    future.cancel()
+                # Record what was written even when cancelled, so the next run resumes
+                MapDataExporter.save_manifest(output_dir, manifest)
+
+        if progress_callback:
+            progress_callback(100)
+        return ExportResult(paths, written, unchanged)
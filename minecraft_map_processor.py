@@ -1,65 +1,166 @@
 from PIL import Image
 import numpy as np
-from typing import Tuple, List, Callable
-from color_mapper import MAP_COLORS
-from math import sqrt
+from typing import Tuple, List, Callable, Iterable, Optional, Union
+from cancellation import CancellationToken
+from dithering import Ditherer
+from image_utils import ImageProcessor
+from instrumentation import count, timed
+from palette_quantizer import IncrementalQuantizer, UniqueColors, get_quantizer
+from tile_processor import TileProcessor
 
 class MinecraftMapProcessor:
     @staticmethod
-    def find_nearest_color(pixel: Tuple[int, int, int]) -> Tuple[int, int, int]:
-        """Find the nearest Minecraft map color for a given pixel"""
-        r, g, b = pixel
-        min_distance = float('inf')
-        closest_color = None
-        
-        for color_name, color_rgb in MAP_COLORS.items():
-            # Calculate Euclidean distance
-            distance = sqrt(
-                (r - color_rgb[0]) ** 2 +
-                (g - color_rgb[1]) ** 2 +
-                (b - color_rgb[2]) ** 2
+    def find_nearest_color(
+        pixel: Tuple[int, int, int],
+        allowed_colors: Optional[Iterable[int]] = None,
+        metric: Optional[str] = None
+    ) -> Tuple[int, int, int]:
+        """Find the nearest Minecraft map color for a given pixel
+
+        allowed_colors restricts the search to a subset of MAP_COLORS ids;
+        metric selects the color distance ('rgb', 'redmean' or 'lab').
+        """
+        return get_quantizer(allowed_colors, metric).nearest_color(pixel)
+
+    @staticmethod
+    @timed('quantize_image')
+    def quantize_image(
+        image: Union[Image.Image, np.ndarray],
+        progress_callback: Callable[[float], None] = None,
+        allowed_colors: Optional[Iterable[int]] = None,
+        parallel: bool = False,
+        workers: Optional[int] = None,
+        cancel_token: Optional[CancellationToken] = None,
+        tile_callback: Optional[Callable[[Tuple[int, int, int, int], np.ndarray], None]] = None,
+        dither: Optional[str] = None,
+        metric: Optional[str] = None,
+        incremental: Optional[IncrementalQuantizer] = None
+    ) -> Tuple[Image.Image, np.ndarray]:
+        """Quantize an image to map colors, returning a 'P' mode image and its index map
+
+        The image holds the MAP_COLORS id of every pixel with the map palette
+        attached, one byte per pixel; the index map is the same ids as an
+        array. RGB is only expanded for display.
+        With parallel=True the image is split into 128x128 map tiles that are
+        quantized across a process pool, with progress reported per tile.
+        cancel_token is checked between chunks and raises CancelledError.
+        tile_callback receives the (left, top, right, bottom) box and RGB
+        pixels of every region as soon as it is finished.
+        dither selects one of dithering.DITHER_MODES; error diffusion is
+        confined to each 128x128 map tile. metric selects the color
+        distance from color_metrics ('rgb', 'redmean' or 'lab').
+        image may also be an (height, width, 3) uint8 array, such as the
+        memory-mapped output of ImageProcessor.scale_image, which is then
+        read in place.
+        incremental keeps the image's distinct colors and their matches
+        between calls, so a later call with another palette or metric only
+        re-matches colors; it must always be given the same image and is not
+        used with dithering.
+        """
+        # The full palette is served by the cached lookup table, subsets by a grid index
+        Ditherer.validate(dither)
+        quantizer = get_quantizer(allowed_colors, metric)
+        if isinstance(image, np.ndarray):
+            pixels = image
+        else:
+            pixels = np.asarray(image if image.mode == 'RGB' else image.convert('RGB'))
+        height, width = pixels.shape[:2]
+        count('pixels_quantized', width * height)
+        count('bytes_allocated', width * height)
+
+        if incremental is not None and dither in (None, 'none'):
+            index_map = incremental.quantize(pixels, quantizer, progress_callback, cancel_token)
+            if tile_callback:
+                tile_callback((0, 0, width, height), quantizer.colors_for_ids(index_map))
+            return quantizer.to_image(index_map), index_map
+
+        if parallel and TileProcessor.should_parallelize(width, height, workers):
+            index_map = TileProcessor.quantize(
+                pixels, progress_callback, allowed_colors, workers, cancel_token, tile_callback, dither, metric
             )
-            
-            if distance < min_distance:
-                min_distance = distance
-                closest_color = color_rgb
-                
-        return closest_color
+            return quantizer.to_image(index_map), index_map
+
+        if dither not in (None, 'none') or quantizer.lookup_table is None:
+            if dither not in (None, 'none'):
+                index_map = Ditherer.quantize(
+                    pixels, quantizer, dither, progress_callback=progress_callback, cancel_token=cancel_token
+                )
+            else:
+                # Without a lookup table, match each distinct color only once
+                unique = UniqueColors.from_pixels(pixels)
+                index_map = quantizer.quantize_unique(unique, progress_callback, cancel_token)
+            if tile_callback:
+                tile_callback((0, 0, width, height), quantizer.colors_for_ids(index_map))
+            if progress_callback:
+                progress_callback(100)
+            return quantizer.to_image(index_map), index_map
+
+        index_map = np.empty((height, width), dtype=np.uint8)
+
+        # Process the image in row blocks so progress can be reported
+        for start, end, indices in quantizer.iter_quantize_rows(pixels):
+            if cancel_token:
+                cancel_token.raise_if_cancelled()
+            index_map[start:end] = indices
+            if tile_callback:
+                tile_callback((0, start, width, end), quantizer.colors_for_ids(indices))
+            if progress_callback:
+                progress_callback((end / height) * 100)
+
+        # Ensure 100% progress is reported
+        if progress_callback:
+            progress_callback(100)
+
+        return quantizer.to_image(index_map), index_map
 
     @staticmethod
     def create_map_preview(
         image: Image.Image,
-        progress_callback: Callable[[float], None] = None
+        progress_callback: Callable[[float], None] = None,
+        allowed_colors: Optional[Iterable[int]] = None,
+        parallel: bool = False,
+        workers: Optional[int] = None,
+        cancel_token: Optional[CancellationToken] = None,
+        tile_callback: Optional[Callable[[Tuple[int, int, int, int], np.ndarray], None]] = None,
+        dither: Optional[str] = None,
+        metric: Optional[str] = None,
+        incremental: Optional[IncrementalQuantizer] = None
     ) -> Image.Image:
-        """Convert an image to Minecraft map style with progress updates"""
+        """Convert an image to Minecraft map style with progress updates, as a 'P' mode image"""
         if not image:
             return None
 
-        # Convert image to RGB mode
-        rgb_image = image.convert('RGB')
-        pixels = rgb_image.load()
-        width, height = rgb_image.size
-        total_pixels = width * height
-        
-        # Create new image for the map preview
-        map_preview = Image.new('RGB', (width, height))
-        map_pixels = map_preview.load()
-
-        # Process each pixel
-        processed_pixels = 0
-        for y in range(height):
-            for x in range(width):
-                original_color = pixels[x, y]
-                map_color = MinecraftMapProcessor.find_nearest_color(original_color)
-                map_pixels[x, y] = map_color
-                
-                processed_pixels += 1
-                if progress_callback and processed_pixels % 1000 == 0:
-                    progress = (processed_pixels / total_pixels) * 100
-                    progress_callback(progress)
+        map_preview, _ = MinecraftMapProcessor.quantize_image(
+            image, progress_callback, allowed_colors, parallel, workers, cancel_token, tile_callback, dither, metric,
+            incremental
+        )
+        return map_preview
 
-        # Ensure 100% progress is reported
-        if progress_callback:
-            progress_callback(100)
 
-        return map_preview
\ No newline at end of file
+    @staticmethod
+    def create_canvas_preview(
+        image: Image.Image,
+        canvas_width: int,
+        canvas_height: int,
+        progress_callback: Callable[[float], None] = None,
+        allowed_colors: Optional[Iterable[int]] = None,
+        cancel_token: Optional[CancellationToken] = None,
+        dither: Optional[str] = None,
+        metric: Optional[str] = None,
+        incremental: Optional[IncrementalQuantizer] = None
+    ) -> Image.Image:
+        """Map preview at canvas resolution for interactive display
+
+        The image is first fitted to the canvas like ImageProcessor.create_preview
+        and only those pixels are quantized, instead of quantizing the full
+        resolution image and shrinking the result afterwards. incremental
+        must belong to this image at this canvas size.
+        """
+        if not image:
+            return None
+
+        preview = ImageProcessor.create_preview(image, canvas_width, canvas_height)
+        return MinecraftMapProcessor.create_map_preview(
+            preview, progress_callback, allowed_colors, cancel_token=cancel_token, dither=dither, metric=metric,
+            incremental=incremental
+        )
@@ -0,0 +1,95 @@
+import numpy as np
+from typing import Optional, Tuple
+from color_metrics import ColorMetric, get_metric, palette_colors
+
+
+class PaletteIndex:
+    """Bucketed grid over RGB space for exact nearest-color search
+
+    RGB space is split into cubic cells. Each cell lists only the palette
+    colors that can be nearest to some point inside it: a color is kept when
+    its minimum distance to the cell does not exceed the smallest maximum
+    distance of any color. A lookup then only compares against the few
+    candidates of the pixel's cell, and stays exact for any palette.
+    Distances follow the given ColorMetric (squared RGB by default).
+    """
+
+    # 8x8x8 cells (32 per axis); the full map palette averages under 3 candidates per cell
+    CELL_BITS = 3
+    # Upper bound on the scratch (pixels x candidates x features) buffer used per lookup block
+    BLOCK_ELEMENTS = 1 << 21
+
+    def __init__(self, palette, metric: Optional[ColorMetric] = None):
+        self.palette = palette_colors(palette)
+        if len(self.palette) == 0:
+            raise ValueError("Palette must contain at least one color")
+        self.metric = metric or get_metric()
+
+        # A color_mapper.Palette lends the metric its precomputed terms
+        candidates = self.metric.cell_candidates(palette, self.CELL_BITS)
+
+        # Candidate lists in CSR form. Positions are ascending within a cell so
+        # argmin keeps the same tie-breaking as a full scan of the palette.
+        self._counts = candidates.sum(axis=1)
+        self._starts = np.zeros(len(candidates) + 1, dtype=np.intp)
+        np.cumsum(self._counts, out=self._starts[1:])
+        self._positions = np.nonzero(candidates)[1]
+
+        self._weights, self._bias = self.metric.palette_terms(palette)
+        self._terms = list(zip(self._weights.tolist(), self._bias.tolist()))
+
+    def _cells(self, pixels: np.ndarray) -> np.ndarray:
+        shift = self.CELL_BITS
+        bits = 8 - self.CELL_BITS
+        pixels = pixels.astype(np.intp)
+        return (((pixels[..., 0] >> shift) << (2 * bits))
+                | ((pixels[..., 1] >> shift) << bits)
+                | (pixels[..., 2] >> shift))
+
+    def nearest_position(self, pixel: Tuple[int, int, int]) -> int:
+        """Return the palette position of the nearest color for a single pixel"""
+        r, g, b = pixel
+        shift = self.CELL_BITS
+        bits = 8 - self.CELL_BITS
+        cell = ((r >> shift) << (2 * bits)) | ((g >> shift) << bits) | (b >> shift)
+        features = self.metric.features(np.array(pixel, dtype=np.uint8)).tolist()
+
+        best_position = -1
+        min_distance = None
+        for position in self._positions[self._starts[cell]:self._starts[cell + 1]].tolist():
+            weights, bias = self._terms[position]
+            distance = bias + sum(f * w for f, w in zip(features, weights))
+            if min_distance is None or distance < min_distance:
+                min_distance = distance
+                best_position = position
+        return best_position
+
+    def nearest_positions(self, pixels: np.ndarray) -> np.ndarray:
+        """Return the palette position of the nearest color for each RGB pixel"""
+        flat = np.asarray(pixels).reshape(-1, 3)
+        cells = self._cells(flat)
+        features = self.metric.features(flat)
+        counts = self._counts[cells]
+        positions = np.empty(len(flat), dtype=np.intp)
+
+        # Pixels whose cells have the same number of candidates are resolved together
+        order = np.argsort(counts, kind='stable')
+        sorted_counts = counts[order]
+        bounds = np.flatnonzero(np.diff(sorted_counts)) + 1
+        for group in np.split(order, bounds):
+            if len(group) == 0:
+                continue
+            count = int(counts[group[0]])
+            if count == 1:
+                positions[group] = self._positions[self._starts[cells[group]]]
+                continue
+
+            step = max(1, self.BLOCK_ELEMENTS // (count * features.shape[1]))
+            for start in range(0, len(group), step):
+                chunk = group[start:start + step]
+                candidates = self._positions[self._starts[cells[chunk]][:, None] + np.arange(count)]
+                distances = np.einsum('ik,ijk->ij', features[chunk], self._weights[candidates])
+                distances += self._bias[candidates]
+                positions[chunk] = candidates[np.arange(len(chunk)), distances.argmin(axis=1)]
+
+        return positions.reshape(np.shape(pixels)[:-1])
@@ -0,0 +1,407 @@
+import threading
+import numpy as np
+from functools import lru_cache
+from typing import Dict, FrozenSet, Iterable, Iterator, Optional, Tuple, Union
+from PIL import Image
+from color_mapper import MAP_PALETTE, TRANSPARENT_ID, Palette
+from color_lut import ColorLookupTable
+from color_metrics import get_metric
+from palette_index import PaletteIndex
+
+
+class UniqueColors:
+    """Distinct colors of an image plus the inverse index that rebuilds it"""
+
+    # From this many pixels on, a dense 2^24 presence table is faster than sorting
+    DENSE_MIN_PIXELS = 1 << 20
+
+    def __init__(self, colors: np.ndarray, inverse: np.ndarray, shape: Tuple[int, ...]):
+        self.colors = colors
+        self.inverse = inverse
+        self.shape = shape
+
+    @classmethod
+    def from_pixels(cls, pixels: np.ndarray) -> "UniqueColors":
+        """Collapse an (..., 3) uint8 array to its distinct colors"""
+        flat = np.asarray(pixels, dtype=np.uint8).reshape(-1, 3)
+        codes = (flat[:, 0].astype(np.uint32) << 16) | (flat[:, 1].astype(np.uint32) << 8) | flat[:, 2]
+
+        if len(codes) >= cls.DENSE_MIN_PIXELS:
+            seen = np.zeros(1 << 24, dtype=bool)
+            seen[codes] = True
+            unique_codes = np.flatnonzero(seen).astype(np.uint32)
+            del seen
+            slots = np.empty(1 << 24, dtype=np.int32)
+            slots[unique_codes] = np.arange(len(unique_codes), dtype=np.int32)
+            inverse = slots[codes]
+        else:
+            unique_codes, inverse = np.unique(codes, return_inverse=True)
+
+        colors = np.empty((len(unique_codes), 3), dtype=np.uint8)
+        colors[:, 0] = unique_codes >> 16
+        colors[:, 1] = (unique_codes >> 8) & 0xFF
+        colors[:, 2] = unique_codes & 0xFF
+        return cls(colors, inverse.reshape(-1), np.shape(pixels)[:-1])
+
+    @property
+    def pixel_count(self) -> int:
+        return len(self.inverse)
+
+    @property
+    def dedup_ratio(self) -> float:
+        """Pixels per distinct color; high for flat-color and pixel-art images"""
+        return self.pixel_count / max(len(self.colors), 1)
+
+    def expand(self, values: np.ndarray) -> np.ndarray:
+        """Scatter per-color values back to every pixel"""
+        return values[self.inverse].reshape(self.shape + values.shape[1:])
+
+
+class DedupStats:
+    """Running totals of pixels versus distinct colors actually searched"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.pixels = 0
+        self.unique_colors = 0
+
+    def record(self, unique: UniqueColors):
+        with self._lock:
+            self.pixels += unique.pixel_count
+            self.unique_colors += len(unique.colors)
+
+    @property
+    def ratio(self) -> float:
+        """Pixels per searched color (1.0 means deduplication saved nothing)"""
+        return self.pixels / self.unique_colors if self.unique_colors else 1.0
+
+
+class PaletteQuantizer:
+    """Vectorized nearest-color quantization against a fixed palette
+
+    colors is a color_mapper.Palette (or an id -> RGB dict); its arrays are
+    shared, not copied. metric names the distance from color_metrics ('rgb',
+    'redmean' or 'lab'). The palette side of the metric is computed once
+    here; pixels are converted in bulk per search block.
+    """
+
+    # Pixels handled per distance matrix; bounds the (pixels x colors) scratch buffer
+    BLOCK_PIXELS = 16384
+    # Below this many colors a direct search beats the grid index for bulk lookups
+    INDEX_MIN_COLORS = 64
+    # Below this many pixels deduplication costs more than it saves
+    DEDUP_MIN_PIXELS = 1024
+
+    def __init__(
+        self,
+        colors: Optional[Union[Palette, Dict[int, Tuple[int, int, int]]]] = None,
+        use_lookup_table: bool = False,
+        cache_dir: Optional[str] = None,
+        metric: Optional[str] = None
+    ):
+        if colors is None:
+            colors = MAP_PALETTE
+        elif not isinstance(colors, Palette):
+            colors = Palette(colors)
+        self.map_palette = colors
+        self.metric = get_metric(metric)
+
+        # The lookup table is loaded (or built) on first use, not at construction
+        self.use_lookup_table = use_lookup_table
+        self.cache_dir = cache_dir
+        self._lookup_table = None
+        self._spatial_index = None
+        self._lookup_lock = threading.Lock()
+        self.dedup_stats = DedupStats()
+
+        self.color_ids = colors.ids
+        self.palette = colors.colors
+        # Identifies the palette and metric in cache keys
+        self.palette_version = ColorLookupTable.hash_palette(self.palette, self.metric.name)
+        # Map color id -> RGB, for expanding index maps back to pixels
+        self._id_colors = colors.id_colors
+
+        # For RGB, |p - c|^2 = |p|^2 - 2 p.c + |c|^2 and |p|^2 is constant per
+        # pixel, so the argmin only needs |c|^2 - 2 p.c. Every term is an integer
+        # below 2^24, which float32 represents exactly, so BLAS matmul gives
+        # exact results. The other metrics reduce to the same form.
+        weights, self._bias = self.metric.palette_terms(colors)
+        self._weights_t = np.ascontiguousarray(weights.T)
+
+    @property
+    def lookup_table(self) -> Optional[ColorLookupTable]:
+        """The palette's lookup table, loaded on first access when enabled"""
+        if not self.use_lookup_table:
+            return None
+        if self._lookup_table is None:
+            with self._lookup_lock:
+                if self._lookup_table is None:
+                    self._lookup_table = ColorLookupTable.load_or_build(
+                        self.palette, self.cache_dir, self.metric
+                    )
+        return self._lookup_table
+
+    @property
+    def spatial_index(self) -> PaletteIndex:
+        """Grid index over the palette, built on first access"""
+        if self._spatial_index is None:
+            with self._lookup_lock:
+                if self._spatial_index is None:
+                    self._spatial_index = PaletteIndex(self.map_palette, self.metric)
+        return self._spatial_index
+
+    def prepare(self):
+        """Load or build the lookup structures now instead of on first use"""
+        if self.use_lookup_table:
+            self.lookup_table
+        else:
+            self.spatial_index
+
+    def colors_for_ids(self, index_map: np.ndarray) -> np.ndarray:
+        """Expand an index map of color ids back to RGB pixels"""
+        return self._id_colors[index_map]
+
+    def to_image(self, index_map: np.ndarray) -> Image.Image:
+        """Wrap an index map of color ids as a 'P' mode image with the map palette attached
+
+        The image keeps one byte per pixel; RGB is only produced when it is
+        converted for display or for formats without palette support.
+        """
+        image = Image.fromarray(np.ascontiguousarray(index_map, dtype=np.uint8))
+        image.putpalette(self._id_colors.tobytes())
+        return image
+
+    def nearest_color(self, pixel: Tuple[int, int, int]) -> Tuple[int, int, int]:
+        """Return the nearest palette color for a single pixel"""
+        position = self.spatial_index.nearest_position(pixel)
+        return tuple(int(v) for v in self.palette[position])
+
+    def nearest_positions(self, pixels: np.ndarray) -> np.ndarray:
+        """Return the palette position of the nearest color for each RGB pixel
+
+        The lookup table already answers each pixel in constant time. Without
+        it, pixels are collapsed to their distinct colors first so repeated
+        colors are only searched once.
+        """
+        lookup_table = self.lookup_table
+        if lookup_table is not None:
+            return lookup_table.lookup(pixels)
+
+        if np.size(pixels) // 3 >= self.DEDUP_MIN_PIXELS:
+            unique = UniqueColors.from_pixels(pixels)
+            self.dedup_stats.record(unique)
+            return unique.expand(self._search(unique.colors))
+        return self._search(pixels)
+
+    def _search(self, pixels: np.ndarray) -> np.ndarray:
+        if len(self.palette) >= self.INDEX_MIN_COLORS:
+            return self.spatial_index.nearest_positions(pixels)
+        return self.search_positions(pixels)
+
+    def quantize_unique(
+        self,
+        unique: UniqueColors,
+        progress_callback=None,
+        cancel_token=None
+    ) -> np.ndarray:
+        """Quantize a deduplicated image, returning its index map of color ids
+
+        Only the distinct colors are matched, in blocks so progress can be
+        reported and cancellation checked, then the results are scattered
+        back to every pixel.
+        """
+        positions = self.match_colors(unique.colors, progress_callback, cancel_token)
+        self.dedup_stats.record(unique)
+        return unique.expand(self.color_ids[positions])
+
+    def match_colors(self, colors: np.ndarray, progress_callback=None, cancel_token=None) -> np.ndarray:
+        """Nearest palette positions of an (n, 3) array of distinct colors
+
+        Colors are looked up in blocks so progress can be reported and
+        cancellation checked; the lookup table is used when there is one.
+        """
+        lookup_table = self.lookup_table
+        positions = np.empty(len(colors), dtype=np.intp)
+        for start in range(0, len(colors), self.BLOCK_PIXELS):
+            if cancel_token:
+                cancel_token.raise_if_cancelled()
+            end = min(start + self.BLOCK_PIXELS, len(colors))
+            block = colors[start:end]
+            positions[start:end] = lookup_table.lookup(block) if lookup_table is not None else self._search(block)
+            if progress_callback:
+                progress_callback((end / len(colors)) * 100)
+        return positions
+
+    def search_positions(self, pixels: np.ndarray) -> np.ndarray:
+        """Nearest palette positions by direct distance search, without the lookup table"""
+        flat = pixels.reshape(-1, 3)
+        positions = np.empty(len(flat), dtype=np.intp)
+
+        for start in range(0, len(flat), self.BLOCK_PIXELS):
+            block = self.metric.features(flat[start:start + self.BLOCK_PIXELS])
+            distances = block @ self._weights_t
+            distances += self._bias
+            positions[start:start + len(block)] = distances.argmin(axis=1)
+
+        return positions.reshape(pixels.shape[:-1])
+
+    def quantize(self, pixels: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """Quantize an (..., 3) uint8 array, returning (rgb, index_map)"""
+        positions = self.nearest_positions(pixels)
+        return self.palette[positions], self.color_ids[positions]
+
+    def quantize_ids(self, pixels: np.ndarray) -> np.ndarray:
+        """Quantize an (..., 3) uint8 array to its index map of color ids only"""
+        return self.color_ids[self.nearest_positions(pixels)]
+
+    def iter_quantize_rows(
+        self,
+        pixels: np.ndarray,
+        rows_per_block: Optional[int] = None
+    ) -> Iterator[Tuple[int, int, np.ndarray]]:
+        """Quantize an (height, width, 3) array in row blocks
+
+        Yields (start_row, end_row, index_block) so callers can report
+        progress or stream results while the image is processed.
+        """
+        height, width = pixels.shape[:2]
+        if rows_per_block is None:
+            rows_per_block = max(1, self.BLOCK_PIXELS // max(width, 1))
+
+        for start in range(0, height, rows_per_block):
+            end = min(start + rows_per_block, height)
+            yield start, end, self.quantize_ids(pixels[start:end])
+
+
+class IncrementalQuantizer:
+    """Re-quantizes one image after palette or metric changes, reusing earlier matches
+
+    The image's distinct colors and their inverse index are computed once
+    and every later quantization only matches colors, then expands the ids
+    to pixels. When the metric stays the same and colors are only removed
+    from or added to the palette, a color's old match stays nearest unless
+    it was removed or an added color beats it. So colors whose match was
+    removed are searched against the new palette, and every other color is
+    compared with the added colors only. A metric change, the full palette
+    (served by its lookup table) or many added colors match all distinct
+    colors again, which are still far fewer than the pixels.
+    An instance must always be given the same pixels.
+    """
+
+    def __init__(self):
+        self.unique: Optional[UniqueColors] = None
+        # MAP_COLORS id matched by each distinct color, for self.quantizer
+        self.ids: Optional[np.ndarray] = None
+        self.quantizer: Optional[PaletteQuantizer] = None
+        self._lock = threading.Lock()
+
+    def quantize(self, pixels: np.ndarray, quantizer: PaletteQuantizer,
+                 progress_callback=None, cancel_token=None) -> np.ndarray:
+        """Quantize pixels with quantizer, returning the index map of color ids"""
+        with self._lock:
+            if self.unique is None:
+                self.unique = UniqueColors.from_pixels(pixels)
+            if self.quantizer is None or not self._can_update(quantizer):
+                positions = quantizer.match_colors(self.unique.colors, progress_callback, cancel_token)
+                ids = quantizer.color_ids[positions]
+            elif quantizer is not self.quantizer:
+                ids = self._update(quantizer, cancel_token)
+            else:
+                ids = self.ids
+            # Only a finished update replaces the matches, so a cancelled one leaves them intact
+            self.ids = ids
+            self.quantizer = quantizer
+        if progress_callback:
+            progress_callback(100)
+        return self.unique.expand(ids)
+
+    # Above this share of added colors, comparing with them costs about as much as a full search
+    MAX_ADDED_SHARE = 0.25
+
+    def _can_update(self, quantizer: PaletteQuantizer) -> bool:
+        """Whether updating the old matches beats matching every color again"""
+        if quantizer.metric.name != self.quantizer.metric.name or quantizer.lookup_table is not None:
+            # The lookup table matches every color faster than any comparison
+            return False
+        common = np.intersect1d(quantizer.color_ids, self.quantizer.color_ids)
+        if not np.array_equal(quantizer._id_colors[common], self.quantizer._id_colors[common]):
+            # Another palette that gives the same ids different colors
+            return False
+        added = len(np.setdiff1d(quantizer.color_ids, self.quantizer.color_ids))
+        return added <= self.MAX_ADDED_SHARE * len(quantizer.color_ids)
+
+    def _update(self, quantizer: PaletteQuantizer, cancel_token=None) -> np.ndarray:
+        """Matches for a new palette under the same metric"""
+        colors = self.unique.colors
+        ids = self.ids.copy()
+        removed = np.setdiff1d(self.quantizer.color_ids, quantizer.color_ids)
+        added = np.setdiff1d(quantizer.color_ids, self.quantizer.color_ids)
+
+        stale = np.isin(ids, removed)
+        if stale.any():
+            ids[stale] = quantizer.color_ids[quantizer.match_colors(colors[stale], cancel_token=cancel_token)]
+        if len(added) == 0:
+            return ids
+
+        # Palette positions follow color ids, so argmin and the tie-break below
+        # both prefer the lowest id like a full search does
+        position_of = quantizer.map_palette.positions
+        added_positions = position_of[added]
+        added_weights = quantizer._weights_t[:, added_positions]
+        added_bias = quantizer._bias[added_positions]
+        kept = np.flatnonzero(~stale)
+        for start in range(0, len(kept), quantizer.BLOCK_PIXELS):
+            if cancel_token:
+                cancel_token.raise_if_cancelled()
+            block = kept[start:start + quantizer.BLOCK_PIXELS]
+            features = quantizer.metric.features(colors[block])
+            current_positions = position_of[ids[block]]
+            current = np.einsum('nk,kn->n', features, quantizer._weights_t[:, current_positions])
+            current += quantizer._bias[current_positions]
+            candidates = features @ added_weights
+            candidates += added_bias
+            best = candidates.argmin(axis=1)
+            best_scores = candidates[np.arange(len(block)), best]
+            best_positions = added_positions[best]
+            better = (best_scores < current) | ((best_scores == current) & (best_positions < current_positions))
+            ids[block[better]] = quantizer.color_ids[best_positions[better]]
+        return ids
+
+
+@lru_cache(maxsize=16)
+def _cached_quantizer(palette: Palette, color_ids: FrozenSet[int], metric: str) -> PaletteQuantizer:
+    colors = palette.subset(color_ids)
+    # Only the full palette gets a 256^3 lookup table; subsets use the grid index
+    drawable = frozenset(palette).difference((TRANSPARENT_ID,))
+    return PaletteQuantizer(colors, use_lookup_table=(color_ids == drawable), metric=metric)
+
+
+def get_quantizer(
+    allowed_colors: Optional[Iterable[int]] = None,
+    metric: Optional[str] = None,
+    palette: Optional[Palette] = None
+) -> PaletteQuantizer:
+    """Return the shared quantizer for a subset of palette ids (all colors if None)
+
+    metric selects the color distance ('rgb' by default, 'redmean' or 'lab').
+    palette defaults to the standard MAP_PALETTE; a custom one, such as
+    Palette.from_json(path), gets quantizers and lookup tables of its own.
+    TRANSPARENT_ID is always left out: the game shows it as a hole in the
+    map, so black pixels must match the darkest real shade instead.
+    """
+    if palette is None:
+        palette = MAP_PALETTE
+    if allowed_colors is None:
+        color_ids = frozenset(palette).difference((TRANSPARENT_ID,))
+    else:
+        color_ids = frozenset(int(color_id) for color_id in allowed_colors)
+        unknown = [color_id for color_id in color_ids if color_id not in palette]
+        if unknown:
+            raise ValueError(f"Unknown map color ids: {sorted(unknown)}")
+        color_ids = color_ids.difference((TRANSPARENT_ID,))
+        if not color_ids:
+            raise ValueError("At least one map color must be allowed")
+    return _cached_quantizer(palette, color_ids, get_metric(metric).name)
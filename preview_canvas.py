@@ -1,14 +1,60 @@
 import tkinter as tk
+from collections import OrderedDict
 from tkinter import ttk
-from PIL import ImageTk
+from PIL import Image, ImageTk
+
+from instrumentation import span
+
+# Zoom change per mouse wheel step
+ZOOM_STEP = 1.25
+# Largest zoom in screen pixels per image pixel
+MAX_ZOOM = 16.0
+# Rendered viewports kept as PhotoImages, so zooming back and forth reuses them
+PHOTO_CACHE_SIZE = 8
+# Quiet period after zooming or panning before full-resolution detail is requested
+DETAIL_DELAY_MS = 200
+# Detail regions are aligned to map tiles
+TILE_SIZE = 128
+
+
+class ImagePyramid:
+    """An image and its successive 2x reductions, each built on first use"""
+
+    def __init__(self, image):
+        self.levels = [image]
+
+    @property
+    def base(self):
+        return self.levels[0]
+
+    def level(self, index):
+        while len(self.levels) <= index:
+            previous = self.levels[-1]
+            if previous.mode not in ('RGB', 'RGBA', 'L'):
+                # reduce() does not handle palette images
+                previous = previous.convert('RGB')
+            self.levels.append(previous.reduce(2))
+        return self.levels[index]
+
+    def level_for(self, zoom):
+        """Index of the smallest level with at least zoom pixels per base pixel"""
+        index = 0
+        while zoom * 2 ** (index + 1) <= 1 and self.base.width >> (index + 1) > 0:
+            index += 1
+        return index
+
 
 class PreviewCanvas(ttk.Frame):
-    def __init__(self, parent, **kwargs):
+    def __init__(self, parent, on_detail_needed=None, **kwargs):
         super().__init__(parent, **kwargs)
-        
+
         self.grid_rowconfigure(0, weight=1)
         self.grid_columnconfigure(0, weight=1)
-        
+
+        # Called with a (left, top, right, bottom) box of the source when the
+        # view is zoomed in past the resolution of the preview
+        self.on_detail_needed = on_detail_needed
+
         # Create canvas with gray background
         self.canvas = tk.Canvas(
             self,
@@ -17,38 +63,292 @@ class PreviewCanvas(ttk.Frame):
             highlightbackground='#cccccc'
         )
         self.canvas.grid(row=0, column=0, sticky="nsew")
-        
+
         # Bind resize event
         self.canvas.bind('<Configure>', self.on_resize)
-        
+
+        # Zoom with the mouse wheel, pan by dragging, double click to fit
+        self.canvas.bind('<MouseWheel>', self.on_mouse_wheel)
+        self.canvas.bind('<Button-4>', lambda event: self.zoom_at(event.x, event.y, ZOOM_STEP))
+        self.canvas.bind('<Button-5>', lambda event: self.zoom_at(event.x, event.y, 1 / ZOOM_STEP))
+        self.canvas.bind('<ButtonPress-1>', self.on_pan_start)
+        self.canvas.bind('<B1-Motion>', self.on_pan_move)
+        self.canvas.bind('<Double-Button-1>', lambda event: self.reset_view())
+
         self.photo_image = None
         self.current_preview = None
         self.preview_mode = "normal"
-    
-    def update_preview(self, preview_image):
-        """Update the preview with a new image"""
+        # Scale from full-resolution pixels to the progressive preview, or None
+        self.progressive_scale = None
+
+        # Pyramid of the sharpest image shown, and the size of the source
+        # image it stands for; zoom and center are in source pixels
+        self.pyramid = None
+        self.source_size = None
+        # Screen pixels per source pixel, or None to fit the canvas
+        self.zoom = None
+        self.center = (0.0, 0.0)
+        # Full-resolution (box, image) of part of the source, or None
+        self.detail = None
+
+        # Bumped whenever the shown content changes, invalidating cached renders
+        self._version = 0
+        self._photo_cache = OrderedDict()
+        self._rendered_key = None
+        self._pan_start = None
+        self._detail_after_id = None
+
+    def update_preview(self, preview_image, full_image=None, source_size=None):
+        """Update the preview with a new image
+
+        preview_image fits the canvas. full_image, when given, is the full
+        resolution image the view zooms into; otherwise source_size is the
+        size of the image preview_image was reduced from, so zooming in past
+        the preview asks on_detail_needed for that region. The zoom is kept
+        while the source size stays the same.
+        """
         if not preview_image:
             return
-            
+
         # Store current preview
         self.current_preview = preview_image
-        
-        # Create PhotoImage and keep reference
-        self.photo_image = ImageTk.PhotoImage(preview_image)
-        
+
+        source = full_image or preview_image
+        source_size = source.size if full_image else (source_size or preview_image.size)
+        if source_size != self.source_size:
+            self.zoom = None
+            self.center = (source_size[0] / 2, source_size[1] / 2)
+        self.source_size = source_size
+        self.pyramid = ImagePyramid(source)
+        self.detail = None
+        self._invalidate()
+        self.render()
+
+    def set_detail(self, box, image):
+        """Show a full-resolution region of the source when zoomed in on it"""
+        if self.pyramid is None:
+            return
+        self.detail = (box, image)
+        self._invalidate()
+        self.render()
+
+    def _invalidate(self):
+        self._version += 1
+        self._photo_cache.clear()
+        self._rendered_key = None
+
+    def _canvas_size(self):
+        return self.canvas.winfo_width(), self.canvas.winfo_height()
+
+    def fit_zoom(self):
+        """Zoom at which the canvas-fitted preview is shown"""
+        return self.current_preview.width / self.source_size[0]
+
+    @staticmethod
+    def viewport(source_size, canvas_size, zoom, center):
+        """Visible part of the source for a view
+
+        Returns the (left, top, right, bottom) box in source pixels, the
+        canvas position of its top left corner and its size on screen.
+        """
+        box = []
+        origin = []
+        for axis in range(2):
+            half = canvas_size[axis] / (2 * zoom)
+            low = max(center[axis] - half, 0)
+            high = min(center[axis] + half, source_size[axis])
+            box.append((low, high))
+            origin.append(round(canvas_size[axis] / 2 + (low - center[axis]) * zoom))
+        (left, right), (top, bottom) = box
+        size = (max(round((right - left) * zoom), 1), max(round((bottom - top) * zoom), 1))
+        return (left, top, right, bottom), tuple(origin), size
+
+    def _clamp_center(self, center, zoom):
+        """Keep the source on screen; images smaller than the canvas stay centered"""
+        clamped = []
+        for axis, canvas_length in enumerate(self._canvas_size()):
+            length = self.source_size[axis]
+            half = canvas_length / (2 * zoom)
+            if length <= 2 * half:
+                clamped.append(length / 2)
+            else:
+                clamped.append(min(max(center[axis], half), length - half))
+        return tuple(clamped)
+
+    def render(self):
+        """Draw the visible part of the current view
+
+        At the fitted zoom the canvas-sized preview is drawn as is. Zoomed in,
+        only the viewport is resampled, from the pyramid level closest to the
+        zoom or from the full-resolution detail, and the PhotoImages of recent
+        views are reused.
+        """
+        if self.pyramid is None:
+            return
+        canvas_size = self._canvas_size()
+
+        if self.zoom is None:
+            key = (self._version, canvas_size)
+            if key == self._rendered_key:
+                return
+            # Create PhotoImage and keep reference
+            with span('photo_image', size=self.current_preview.size):
+                self.photo_image = ImageTk.PhotoImage(self.current_preview)
+            # Center image
+            x = (canvas_size[0] - self.current_preview.width) // 2
+            y = (canvas_size[1] - self.current_preview.height) // 2
+        else:
+            box, (x, y), size = self.viewport(self.source_size, canvas_size, self.zoom, self.center)
+            key = (self._version, canvas_size, box)
+            if key == self._rendered_key:
+                return
+            photo = self._photo_cache.get(key)
+            if photo is None:
+                with span('render_view', size=size):
+                    photo = ImageTk.PhotoImage(self._render_view(box, size))
+                self._photo_cache[key] = photo
+                while len(self._photo_cache) > PHOTO_CACHE_SIZE:
+                    self._photo_cache.popitem(last=False)
+            else:
+                self._photo_cache.move_to_end(key)
+            self.photo_image = photo
+
         # Clear canvas and draw new image
         self.canvas.delete("all")
-        
-        # Center image
-        x = (self.canvas.winfo_width() - preview_image.width) // 2
-        y = (self.canvas.winfo_height() - preview_image.height) // 2
         self.canvas.create_image(x, y, anchor=tk.NW, image=self.photo_image)
-    
+        self._rendered_key = key
+
+    def _render_view(self, box, size):
+        """Resample the source box to its on-screen size"""
+        if self.detail is not None:
+            (left, top, right, bottom), image = self.detail
+            if left <= box[0] and top <= box[1] and box[2] <= right and box[3] <= bottom:
+                detail_box = (box[0] - left, box[1] - top, box[2] - left, box[3] - top)
+                return image.resize(size, Image.Resampling.NEAREST, box=detail_box)
+
+        base_scale = self.pyramid.base.width / self.source_size[0]
+        if base_scale < 1 and self.zoom > base_scale:
+            self._schedule_detail(box)
+        level = self.pyramid.level(self.pyramid.level_for(self.zoom / base_scale))
+        level_scale = level.width / self.source_size[0]
+        level_box = tuple(value * level_scale for value in box)
+        # Magnified pixels stay sharp so single map pixels can be inspected
+        resample = Image.Resampling.NEAREST if self.zoom >= level_scale else Image.Resampling.BILINEAR
+        return level.resize(size, resample, box=level_box)
+
+    def _schedule_detail(self, box):
+        """Ask for full-resolution pixels of the view once zooming and panning settle"""
+        if not self.on_detail_needed:
+            return
+        if self._detail_after_id is not None:
+            self.after_cancel(self._detail_after_id)
+        # Whole map tiles, so panning a little stays inside the detail
+        width, height = self.source_size
+        tile_box = (
+            int(box[0]) // TILE_SIZE * TILE_SIZE,
+            int(box[1]) // TILE_SIZE * TILE_SIZE,
+            min(-(-int(box[2] + 1) // TILE_SIZE) * TILE_SIZE, width),
+            min(-(-int(box[3] + 1) // TILE_SIZE) * TILE_SIZE, height)
+        )
+        self._detail_after_id = self.after(DETAIL_DELAY_MS, self._request_detail, tile_box)
+
+    def _request_detail(self, box):
+        self._detail_after_id = None
+        self.on_detail_needed(box)
+
+    def zoom_at(self, x, y, factor):
+        """Zoom by factor, keeping the source pixel under (x, y) in place"""
+        if self.pyramid is None or self.progressive_scale is not None:
+            return
+        fit = self.fit_zoom()
+        zoom = self.zoom or fit
+        new_zoom = min(zoom * factor, MAX_ZOOM)
+        if new_zoom <= fit:
+            self.reset_view()
+            return
+        canvas_width, canvas_height = self._canvas_size()
+        center = self.center if self.zoom else (self.source_size[0] / 2, self.source_size[1] / 2)
+        point = (
+            center[0] + (x - canvas_width / 2) / zoom,
+            center[1] + (y - canvas_height / 2) / zoom
+        )
+        self.zoom = new_zoom
+        self.center = self._clamp_center((
+            point[0] - (x - canvas_width / 2) / new_zoom,
+            point[1] - (y - canvas_height / 2) / new_zoom
+        ), new_zoom)
+        self.render()
+
+    def reset_view(self):
+        """Fit the whole image to the canvas again"""
+        if self.source_size is None:
+            return
+        self.zoom = None
+        self.center = (self.source_size[0] / 2, self.source_size[1] / 2)
+        self.render()
+
+    def on_mouse_wheel(self, event):
+        self.zoom_at(event.x, event.y, ZOOM_STEP if event.delta > 0 else 1 / ZOOM_STEP)
+
+    def on_pan_start(self, event):
+        self._pan_start = (event.x, event.y, self.center)
+
+    def on_pan_move(self, event):
+        if self.zoom is None or self._pan_start is None:
+            return
+        x, y, center = self._pan_start
+        self.center = self._clamp_center((
+            center[0] - (event.x - x) / self.zoom,
+            center[1] - (event.y - y) / self.zoom
+        ), self.zoom)
+        self.render()
+
+    def start_progressive(self, coarse_preview, full_size):
+        """Show a coarse preview that full-resolution tiles will refine
+
+        full_size is the (width, height) of the image the tiles come from.
+        """
+        self.progressive_scale = (
+            coarse_preview.width / full_size[0],
+            coarse_preview.height / full_size[1]
+        )
+        self.zoom = None
+        self.update_preview(coarse_preview.convert('RGB'), source_size=full_size)
+
+    def paste_tiles(self, tiles):
+        """Paste finished full-resolution (box, RGB array) tiles into the progressive preview"""
+        if self.progressive_scale is None or self.current_preview is None:
+            return
+        scale_x, scale_y = self.progressive_scale
+        for (left, top, right, bottom), pixels in tiles:
+            box = (
+                round(left * scale_x), round(top * scale_y),
+                round(right * scale_x), round(bottom * scale_y)
+            )
+            size = (box[2] - box[0], box[3] - box[1])
+            if size[0] <= 0 or size[1] <= 0:
+                continue
+            tile = Image.fromarray(pixels, 'RGB').resize(size, Image.Resampling.BOX)
+            self.current_preview.paste(tile, box[:2])
+        # Refresh the existing PhotoImage in place instead of recreating it;
+        # zooming is off while tiles stream in, so it shows the whole preview
+        self.photo_image.paste(self.current_preview)
+
+    def end_progressive(self):
+        """Stop accepting tiles for the progressive preview"""
+        if self.progressive_scale is not None and self.current_preview is not None:
+            # Pyramid levels were built before the tiles arrived
+            self.pyramid = ImagePyramid(self.current_preview)
+            self._invalidate()
+        self.progressive_scale = None
+
     def set_preview_mode(self, mode):
         """Set the preview mode (normal or minecraft)"""
         self.preview_mode = mode
-    
+
     def on_resize(self, event):
-        """Handle canvas resize events"""
+        """Handle canvas resize events; nothing is redrawn while the size is unchanged"""
         if self.current_preview:
-            self.update_preview(self.current_preview)
\ No newline at end of file
+            if self.zoom is not None:
+                self.center = self._clamp_center(self.center, self.zoom)
+            self.render()
@@ -0,0 +1,56 @@
+import time
+from typing import NamedTuple, Optional
+
+
+class ProgressSnapshot(NamedTuple):
+    percent: float
+    elapsed: float
+    # Work units (e.g. pixels) per second, or None when the total is unknown
+    rate: Optional[float]
+    # Estimated seconds remaining, or None before any progress is made
+    eta: Optional[float]
+
+    def describe(self) -> str:
+        """Short status text such as '42%  3.1 百万像素/秒  剩余 2 秒'"""
+        text = f"{int(self.percent)}%"
+        if self.rate is not None:
+            text += f"  {self.rate / 1e6:.1f} 百万像素/秒"
+        if self.eta is not None:
+            text += f"  剩余 {self.eta:.0f} 秒"
+        return text
+
+
+class ProgressChannel:
+    """Progress slot written by a worker thread and sampled by the Tk main loop
+
+    report() only replaces one tuple reference, which is atomic under the GIL,
+    so the worker never takes a lock or touches Tk. The UI reads snapshot() at
+    its own frame rate, so reporting costs the same whatever the image size.
+    """
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self, total_units: Optional[int] = None):
+        """Start tracking a new job of total_units work units"""
+        self.total_units = total_units
+        self._started = time.monotonic()
+        self._latest = (0.0, self._started)
+
+    def report(self, percent: float):
+        """Record progress from the worker thread"""
+        self._latest = (percent, time.monotonic())
+
+    def snapshot(self) -> ProgressSnapshot:
+        """Return the latest progress with throughput and ETA"""
+        percent, updated = self._latest
+        elapsed = time.monotonic() - self._started
+        worked = updated - self._started
+
+        rate = None
+        eta = None
+        if percent > 0 and worked > 0:
+            if self.total_units:
+                rate = self.total_units * (percent / 100) / worked
+            eta = max(0.0, worked * (100 - percent) / percent - (elapsed - worked))
+        return ProgressSnapshot(percent, elapsed, rate, eta)
@@ -0,0 +1,155 @@
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+from typing import Callable, Hashable, Optional
+
+from PIL import Image
+
+from instrumentation import count
+
+
+class ResultCache:
+    """Content-addressed LRU cache for processed images
+
+    Entries live in memory up to max_bytes, least recently used first out.
+    With disk_dir set, evicted and new entries are also written there as PNG
+    files (bounded by max_disk_bytes) and reloaded on a memory miss.
+    """
+
+    def __init__(self, max_bytes: int = 512 * 1024 * 1024, disk_dir: Optional[str] = None,
+                 max_disk_bytes: int = 2 * 1024 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.disk_dir = disk_dir
+        self.max_disk_bytes = max_disk_bytes
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        if disk_dir:
+            os.makedirs(disk_dir, exist_ok=True)
+
+    @staticmethod
+    def hash_file(path: str) -> str:
+        """Hash a file's content in chunks"""
+        digest = hashlib.sha1()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                digest.update(chunk)
+        return digest.hexdigest()
+
+    @staticmethod
+    def hash_image(image: Image.Image) -> str:
+        """Hash an in-memory image's mode, size and pixels"""
+        digest = hashlib.sha1()
+        digest.update(f"{image.mode}:{image.width}x{image.height}".encode('ascii'))
+        digest.update(image.tobytes())
+        return digest.hexdigest()
+
+    @staticmethod
+    def image_size(image: Image.Image) -> int:
+        """Approximate memory used by an image's pixels"""
+        return image.width * image.height * len(image.getbands())
+
+    def _disk_path(self, key: Hashable) -> str:
+        name = hashlib.sha1(repr(key).encode('utf-8')).hexdigest()
+        return os.path.join(self.disk_dir, f"{name}.png")
+
+    def get(self, key: Hashable) -> Optional[Image.Image]:
+        """Return the cached image for key, or None"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                image = entry[0]
+            else:
+                image = None
+        if image is not None:
+            count('cache_hits')
+            return image
+
+        if self.disk_dir:
+            path = self._disk_path(key)
+            try:
+                with Image.open(path) as cached:
+                    image = cached.copy()
+                os.utime(path)
+            except (OSError, ValueError):
+                image = None
+            if image is not None:
+                self._remember(key, image)
+                with self._lock:
+                    self.hits += 1
+                count('cache_disk_hits')
+                return image
+
+        with self._lock:
+            self.misses += 1
+        count('cache_misses')
+        return None
+
+    def put(self, key: Hashable, image: Image.Image):
+        """Store an image under key"""
+        self._remember(key, image)
+        if self.disk_dir:
+            self._write_disk(key, image)
+
+    def get_or_compute(self, key: Hashable, compute: Callable[[], Image.Image]) -> Image.Image:
+        """Return the cached image for key, computing and storing it on a miss"""
+        image = self.get(key)
+        if image is None:
+            image = compute()
+            if image is not None:
+                self.put(key, image)
+        return image
+
+    def clear(self):
+        """Drop all in-memory entries"""
+        with self._lock:
+            self._entries.clear()
+            self.current_bytes = 0
+
+    def _remember(self, key: Hashable, image: Image.Image):
+        size = self.image_size(image)
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.current_bytes -= old[1]
+            if size > self.max_bytes:
+                return
+            self._entries[key] = (image, size)
+            self.current_bytes += size
+            while self.current_bytes > self.max_bytes:
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self.current_bytes -= evicted_size
+
+    def _write_disk(self, key: Hashable, image: Image.Image):
+        path = self._disk_path(key)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        try:
+            image.save(tmp_path, format='PNG', compress_level=1)
+            os.replace(tmp_path, path)
+            self._trim_disk()
+        except OSError:
+            # The disk tier is best effort; the memory tier already holds the entry
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def _trim_disk(self):
+        """Remove the least recently used files beyond max_disk_bytes"""
+        files = []
+        for entry in os.scandir(self.disk_dir):
+            if entry.is_file() and entry.name.endswith('.png'):
+                stat = entry.stat()
+                files.append((stat.st_mtime, stat.st_size, entry.path))
+        total = sum(size for _, size, _ in files)
+        for _, size, path in sorted(files):
+            if total <= self.max_disk_bytes:
+                break
+            try:
+                os.remove(path)
+                total -= size
+            except OSError:
+                pass
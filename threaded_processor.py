@@ -1,51 +1,77 @@
 import threading
-from queue import Queue
+from queue import Queue, Empty
 import time
 
+from cancellation import CancellationToken, CancelledError
+from instrumentation import instruments
+
 class ThreadedProcessor:
     def __init__(self, callback=None):
         self.callback = callback
         self.queue = Queue()
         self.is_processing = False
         self.current_thread = None
-        self.cancelled = False
+        self.current_job_id = 0
+        self.current_token = None
+    
+    @property
+    def cancelled(self):
+        return self.current_token is not None and self.current_token.cancelled
     
     def process(self, func, *args, **kwargs):
-        """Start processing in a separate thread"""
+        """Start processing in a separate thread, preempting any running job
+
+        func is called with an extra cancel_token keyword argument and should
+        check it between chunks of work. Returns the new job id.
+        """
+        self.cancel()
+        
+        self.current_job_id += 1
+        self.current_token = CancellationToken()
         self.is_processing = True
-        self.cancelled = False
         self.current_thread = threading.Thread(
             target=self._process_wrapper,
-            args=(func, args, kwargs)
+            args=(self.current_job_id, self.current_token, func, args, kwargs)
         )
         self.current_thread.daemon = True
         self.current_thread.start()
-        return self.current_thread
+        return self.current_job_id
     
     def cancel(self):
         """Cancel the current processing"""
-        self.cancelled = True
-        if self.current_thread and self.current_thread.is_alive():
-            self.is_processing = False
+        if self.current_token is not None:
+            self.current_token.cancel()
+        self.is_processing = False
     
-    def _process_wrapper(self, func, args, kwargs):
+    def _process_wrapper(self, job_id, token, func, args, kwargs):
         """Wrapper to handle the processing and callback"""
         try:
-            if not self.cancelled:
-                result = func(*args, **kwargs)
-                if self.callback and not self.cancelled:
-                    self.queue.put((True, result))
+            token.raise_if_cancelled()
+            # Profiled only while a capture is running
+            result = instruments.profile_call(func, *args, cancel_token=token, **kwargs)
+            if self.callback and not token.cancelled:
+                self.queue.put((job_id, True, result))
+        except CancelledError:
+            pass
         except Exception as e:
-            if self.callback and not self.cancelled:
-                self.queue.put((False, str(e)))
+            if self.callback and not token.cancelled:
+                self.queue.put((job_id, False, str(e)))
         finally:
-            self.is_processing = False
+            if job_id == self.current_job_id:
+                self.is_processing = False
     
     def update(self):
-        """Check for completed processing and trigger callback"""
-        if not self.queue.empty():
-            success, result = self.queue.get()
+        """Check for completed processing and trigger callback
+
+        Results of jobs that were cancelled or superseded are dropped.
+        """
+        while True:
+            try:
+                job_id, success, result = self.queue.get_nowait()
+            except Empty:
+                return False
+            if job_id != self.current_job_id or self.cancelled:
+                continue
             if self.callback:
                 self.callback(success, result)
             return True
-        return False
\ No newline at end of file
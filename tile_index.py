@@ -0,0 +1,57 @@
+import hashlib
+import numpy as np
+from collections import OrderedDict
+from typing import Dict, List, Tuple
+
+# Bytes of each tile digest; 128 bits make accidental collisions negligible
+DIGEST_SIZE = 16
+
+Box = Tuple[int, int, int, int]
+
+
+class TileIndex:
+    """Content hashes of map tiles, so identical tiles are processed only once
+
+    Murals often repeat tiles (solid backgrounds, borders) and revisions
+    change only part of the image. A digest covers a tile's dtype, shape and
+    pixels, so tiles of different sizes or types never compare equal.
+    """
+
+    @staticmethod
+    def digest(tile: np.ndarray, salt: str = '') -> str:
+        """Hex digest of a tile; salt mixes in settings that change the result"""
+        digest = hashlib.blake2b(digest_size=DIGEST_SIZE)
+        digest.update(f"{tile.dtype.str}:{tile.shape}:{salt}".encode('utf-8'))
+        digest.update(np.ascontiguousarray(tile).data)
+        return digest.hexdigest()
+
+    @staticmethod
+    def group(array: np.ndarray, boxes: List[Box], salt: str = '') -> Dict[str, List[Box]]:
+        """Group (left, top, right, bottom) boxes of an array by content, in order of first appearance"""
+        groups = OrderedDict()
+        for box in boxes:
+            left, top, right, bottom = box
+            key = TileIndex.digest(array[top:bottom, left:right], salt)
+            groups.setdefault(key, []).append(box)
+        return groups
+
+    @staticmethod
+    def unique_stack(*stacks: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """Deduplicate the tiles of (count, ...) stacks that are compared together
+
+        Returns the positions of the first occurrence of every distinct tile
+        and, for each tile, the index of its distinct tile among them.
+        """
+        keys = [
+            ''.join(TileIndex.digest(stack[position]) for stack in stacks)
+            for position in range(len(stacks[0]))
+        ]
+        first = {}
+        unique = []
+        inverse = np.empty(len(keys), dtype=np.intp)
+        for position, key in enumerate(keys):
+            if key not in first:
+                first[key] = len(unique)
+                unique.append(position)
+            inverse[position] = first[key]
+        return np.array(unique, dtype=np.intp), inverse
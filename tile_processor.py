@@ -0,0 +1,214 @@
+import multiprocessing
+import os
+import threading
+import traceback
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from multiprocessing import shared_memory
+from typing import Callable, Iterable, List, Optional, Tuple
+
+from cancellation import CancellationToken
+from dithering import Ditherer
+from instrumentation import count
+from palette_quantizer import get_quantizer
+from tile_index import TileIndex
+
+# Side length of one in-game map in pixels
+TILE_SIZE = 128
+
+_executor = None
+_executor_workers = 0
+_executor_lock = threading.Lock()
+
+
+def _attach(name: str) -> shared_memory.SharedMemory:
+    """Attach to an existing shared memory block without taking ownership of it"""
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        # Python < 3.13 has no track flag; the parent's unlink cleans up either way
+        return shared_memory.SharedMemory(name=name)
+
+
+def _quantize_tile(
+    source_name: str,
+    index_name: str,
+    shape: Tuple[int, int],
+    tile: Tuple[int, int, int, int],
+    allowed_colors: Optional[Tuple[int, ...]],
+    dither: Optional[str] = None,
+    metric: Optional[str] = None
+) -> Tuple[int, int, int, int]:
+    """Worker entry point: quantize one tile from shared memory into the shared index map"""
+    height, width = shape
+    left, top, right, bottom = tile
+    source_block = _attach(source_name)
+    index_block = _attach(index_name)
+    pixels = index_map = None
+    try:
+        try:
+            pixels = np.ndarray((height, width, 3), dtype=np.uint8, buffer=source_block.buf)
+            index_map = np.ndarray((height, width), dtype=np.uint8, buffer=index_block.buf)
+            indices = Ditherer.quantize(
+                pixels[top:bottom, left:right], get_quantizer(allowed_colors, metric), dither, origin=(left, top)
+            )
+            index_map[top:bottom, left:right] = indices
+        except BaseException as e:
+            # The frames of the traceback still hold views of the tile
+            traceback.clear_frames(e.__traceback__)
+            raise
+        finally:
+            # Drop the views before closing, also when quantizing failed,
+            # otherwise the buffers stay exported and close() raises
+            pixels = index_map = None
+    finally:
+        source_block.close()
+        index_block.close()
+    return tile
+
+
+class TileProcessor:
+    """Quantizes images across a process pool, one 128x128 map tile per task"""
+
+    @staticmethod
+    def default_workers() -> int:
+        return os.cpu_count() or 1
+
+    @staticmethod
+    def get_executor(workers: Optional[int] = None) -> ProcessPoolExecutor:
+        """Return the shared process pool, recreating it if the worker count changes"""
+        global _executor, _executor_workers
+        workers = workers or TileProcessor.default_workers()
+        with _executor_lock:
+            if _executor is None or _executor_workers != workers:
+                if _executor is not None:
+                    _executor.shutdown(wait=False)
+                # Spawned workers never inherit the Tk state or the GUI's threads
+                _executor = ProcessPoolExecutor(
+                    max_workers=workers,
+                    mp_context=multiprocessing.get_context("spawn")
+                )
+                _executor_workers = workers
+            return _executor
+
+    @staticmethod
+    def shutdown():
+        """Stop the shared process pool"""
+        global _executor
+        with _executor_lock:
+            if _executor is not None:
+                _executor.shutdown(wait=True)
+                _executor = None
+
+    @staticmethod
+    def should_parallelize(width: int, height: int, workers: Optional[int] = None) -> bool:
+        """Whether a process pool pays off: more than one worker and more than one tile"""
+        workers = workers or TileProcessor.default_workers()
+        return workers > 1 and len(TileProcessor.split_tiles(width, height)) > 1
+
+    @staticmethod
+    def split_tiles(width: int, height: int, tile_size: int = TILE_SIZE) -> List[Tuple[int, int, int, int]]:
+        """Split an image into (left, top, right, bottom) tiles in row-major order"""
+        return [
+            (left, top, min(left + tile_size, width), min(top + tile_size, height))
+            for top in range(0, height, tile_size)
+            for left in range(0, width, tile_size)
+        ]
+
+    @staticmethod
+    def quantize(
+        pixels: np.ndarray,
+        progress_callback: Callable[[float], None] = None,
+        allowed_colors: Optional[Iterable[int]] = None,
+        workers: Optional[int] = None,
+        cancel_token: Optional[CancellationToken] = None,
+        tile_callback: Optional[Callable[[Tuple[int, int, int, int], np.ndarray], None]] = None,
+        dither: Optional[str] = None,
+        metric: Optional[str] = None
+    ) -> np.ndarray:
+        """Quantize an (height, width, 3) array in parallel, returning its index map of color ids
+
+        The image is copied once into shared memory; workers read their tile
+        from it and write palette ids into a shared index map, so no pixel data
+        is pickled. Progress is reported as each tile finishes, and a
+        cancelled token drops the tiles that have not started yet.
+        tile_callback receives each finished tile's box and RGB pixels.
+        Error diffusion never crosses map borders, so dithered tiles are
+        independent too and match the serial result exactly. Tiles with the
+        same pixels are quantized once and copied to their duplicates.
+        """
+        Ditherer.validate(dither)
+        quantizer = get_quantizer(allowed_colors, metric)
+        if allowed_colors is not None:
+            allowed_colors = tuple(sorted(set(int(color_id) for color_id in allowed_colors)))
+
+        height, width = pixels.shape[:2]
+        tiles = TileProcessor.split_tiles(width, height)
+
+        # Load or build the lookup table before workers map it from disk
+        quantizer.prepare()
+
+        source_block = shared_memory.SharedMemory(create=True, size=max(pixels.nbytes, 1))
+        index_block = shared_memory.SharedMemory(create=True, size=max(height * width, 1))
+        try:
+            index_map = TileProcessor._run_tiles(
+                pixels, tiles, source_block, index_block,
+                progress_callback, allowed_colors, workers, cancel_token,
+                tile_callback, quantizer, dither
+            )
+        finally:
+            source_block.close()
+            source_block.unlink()
+            index_block.close()
+            index_block.unlink()
+
+        return index_map
+
+    @staticmethod
+    def _run_tiles(pixels, tiles, source_block, index_block, progress_callback,
+                   allowed_colors, workers, cancel_token, tile_callback, quantizer, dither):
+        """Fan tiles out to the pool and collect the shared index map"""
+        height, width = pixels.shape[:2]
+        shared_pixels = np.ndarray(pixels.shape, dtype=np.uint8, buffer=source_block.buf)
+        shared_index = np.ndarray((height, width), dtype=np.uint8, buffer=index_block.buf)
+        futures = []
+        try:
+            shared_pixels[:] = pixels
+            executor = TileProcessor.get_executor(workers)
+            # Tiles are aligned to the Bayer pattern, so every mode gives
+            # duplicates the same result
+            groups = {tuple(boxes[0]): boxes for boxes in TileIndex.group(pixels, tiles).values()}
+            count('tiles_deduplicated', len(tiles) - len(groups))
+            futures = [
+                executor.submit(
+                    _quantize_tile, source_block.name, index_block.name,
+                    (height, width), tile, allowed_colors, dither, quantizer.metric.name
+                )
+                for tile in groups
+            ]
+            done = 0
+            for future in as_completed(futures):
+                left, top, right, bottom = future.result()
+                if cancel_token:
+                    cancel_token.raise_if_cancelled()
+                indices = shared_index[top:bottom, left:right]
+                for box in groups[(left, top, right, bottom)]:
+                    shared_index[box[1]:box[3], box[0]:box[2]] = indices
+                    if tile_callback:
+                        tile_callback(box, quantizer.colors_for_ids(indices))
+                done += len(groups[(left, top, right, bottom)])
+                if progress_callback:
+                    progress_callback((done / len(tiles)) * 100)
+            return shared_index.copy()
+        finally:
+            # Never release the shared blocks while a worker may still use them
+            for future in futures:
+                future.cancel()
+            for future in futures:
+                if not future.cancelled():
+                    try:
+                        future.result()
+                    except Exception:
+                        pass
+            # The views must be gone before the blocks can be closed
+            del shared_pixels, shared_index